@@ -0,0 +1,515 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+import atexit
+import signal
+import queue
+import threading
+import numpy as np
+from PIL import Image
+from multiprocessing import shared_memory
+from task import Task
+
+
+FILENAME_DATASET_JSON = r"dataset.json"
+FILENAME_PACKED_NPY = r"dataset.npy"
+FILENAME_PACKED_INDEX = r"dataset.index.json"
+PREFETCH_SIZE = 4 # 推定処理と並行して先読みしておく入力データ数
+
+
+def read_dataset(path_json, answer_value_type=int, multi_data:bool=False, data_type:Task.InputDataType=Task.InputDataType.Image3ch):
+    json_open = open(path_json, 'r', encoding='utf-8')
+    dataset = json.load(json_open)
+
+    filename_list = []
+    input_data_list = [] #入力データ
+    correct_list = [] #正解値
+    num_problem = 0
+
+    for item in dataset["data"]:
+        try:
+            # 正解値
+            correct_list.append(answer_value_type(item["gt"]))
+
+            # 入力データ
+            data = []
+            filename = []
+            if multi_data:
+                for path in item["path"]:
+                    # 画像読み込み
+                    filename.append(path)
+                    data.append(np.array(Image.open(os.path.join(os.path.dirname(path_json), path))))
+            else:
+                # 画像読み込み
+                filename = item["path"]
+                data = np.array(Image.open(os.path.join(os.path.dirname(path_json), item["path"])))
+
+            input_data = np.array(data, dtype=data[0].dtype)
+            input_data_list.append(input_data)
+            filename_list.append(filename)
+
+            num_problem += 1
+        except:
+            print(f"入力データ({num_problem})の読み込みに失敗しました。")
+            continue
+
+    # 正解値リストをnumpyに変換
+    correct_list = np.array(correct_list, dtype=answer_value_type)
+
+    return num_problem, filename_list, input_data_list, correct_list
+
+
+class DatasetReader:
+    # dataset.jsonの一覧だけを読み、入力データ(画像)は必要になったときに1件ずつ読み込む
+    num_problem: int
+    filename_list: list
+    correct_list: np.ndarray
+
+    def __init__(self, path_json, answer_value_type=int, multi_data:bool=False, data_type:Task.InputDataType=Task.InputDataType.Image3ch) -> None:
+        json_open = open(path_json, 'r', encoding='utf-8')
+        dataset = json.load(json_open)
+
+        self.dir = os.path.dirname(path_json)
+        self.multi_data = multi_data
+        self.filename_list = []
+        correct_list = []
+
+        for item in dataset["data"]:
+            try:
+                # 正解値と画像の有無はここで確認し、読み込めないデータは除く
+                correct = answer_value_type(item["gt"])
+                paths = item["path"] if multi_data else [item["path"]]
+                if len(paths) == 0 or not all(os.path.isfile(os.path.join(self.dir, path)) for path in paths):
+                    raise(FileNotFoundError())
+            except:
+                print(f"入力データ({len(correct_list)})の読み込みに失敗しました。")
+                continue
+            correct_list.append(correct)
+            self.filename_list.append(list(item["path"]) if multi_data else item["path"])
+
+        self.num_problem = len(correct_list)
+        self.correct_list = np.array(correct_list, dtype=answer_value_type)
+
+    def read(self, index:int) -> np.ndarray:
+        filename = self.filename_list[index]
+        if self.multi_data:
+            data = [np.array(Image.open(os.path.join(self.dir, path))) for path in filename]
+        else:
+            data = np.array(Image.open(os.path.join(self.dir, filename)))
+        return np.array(data, dtype=data[0].dtype)
+
+
+def stream_inputs(source, indices, prefetch:int=PREFETCH_SIZE):
+    # indicesの順に入力データを返す。sourceは展開済みのリストかDatasetReader
+    if isinstance(source, list):
+        for index in indices:
+            yield source[index]
+        return
+
+    # DatasetReaderは別スレッドで先読みし、画像の読み込みと推定処理を重ねる(先読みはprefetch件まで)
+    items = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_all():
+        for index in indices:
+            try:
+                item = ("data", source.read(int(index)))
+            except Exception as e:
+                print(e)
+                put(("error", ValueError(f"入力データ({source.filename_list[int(index)]})の読み込みに失敗しました。")))
+                return
+            if not put(item):
+                return
+        put(("end", None))
+
+    thread = threading.Thread(target=read_all, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise(value)
+            yield value
+    finally:
+        # 途中で打ち切られた場合も先読みを止める
+        stop.set()
+        thread.join()
+
+
+def dataset_json_path(task_id, data_type:Task.DataType) -> str:
+    return os.path.join(Task.TASKS_DIR, task_id, data_type.name, FILENAME_DATASET_JSON)
+
+
+def answer_type(task:Task):
+    if task.answer_value_type == Task.AnswerValueType.integer:
+        return int
+    elif task.answer_value_type == Task.AnswerValueType.real:
+        return float
+
+
+class SharedDataset:
+    # 共有メモリブロックの構成
+    # [0:8] 書き込み完了フラグ, [8:16] メタデータ長, [16:16+メタデータ長] pickleしたメタデータ, 以降 ALIGN 境界から入力データ
+    READY = 0x53485547474C4531 # "SHUGGLE1"
+    HEADER_SIZE = 16
+    ALIGN = 64
+
+    shm: shared_memory.SharedMemory
+    num_problem: int
+    filename_list: list
+    input_data_list: list
+    correct_list: list
+
+    def __init__(self, shm:shared_memory.SharedMemory, meta:dict, data_offset:int) -> None:
+        self.shm = shm
+        self.num_problem = meta["num_problem"]
+        self.filename_list = meta["filename_list"]
+        self.correct_list = meta["correct_list"]
+
+        # 共有メモリ上のビューを作る(コピーしない)。ユーザ処理から書き換えられないよう読み取り専用にする
+        self.input_data_list = []
+        for offset, shape, dtype in meta["items"]:
+            input_data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=data_offset + offset)
+            input_data.flags.writeable = False
+            self.input_data_list.append(input_data)
+
+    @staticmethod
+    def create(name:str, num_problem, filename_list, input_data_list, correct_list):
+        items = []
+        size = 0
+        for input_data in input_data_list:
+            input_data = np.ascontiguousarray(input_data)
+            items.append((size, input_data.shape, input_data.dtype.str))
+            size += -(-input_data.nbytes // SharedDataset.ALIGN) * SharedDataset.ALIGN
+
+        meta = {
+            "num_problem": num_problem,
+            "filename_list": filename_list,
+            "correct_list": correct_list.tolist(),
+            "items": items,
+        }
+        meta_bytes = pickle.dumps(meta)
+        data_offset = -(-(SharedDataset.HEADER_SIZE + len(meta_bytes)) // SharedDataset.ALIGN) * SharedDataset.ALIGN
+
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=max(data_offset + size, 1))
+        except FileExistsError:
+            # 前回の異常終了で残ったブロックは作り直す
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=max(data_offset + size, 1))
+
+        header = np.ndarray((2,), dtype=np.uint64, buffer=shm.buf)
+        header[1] = len(meta_bytes)
+        shm.buf[SharedDataset.HEADER_SIZE:SharedDataset.HEADER_SIZE + len(meta_bytes)] = meta_bytes
+        for (offset, shape, dtype), input_data in zip(items, input_data_list):
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=data_offset + offset)
+            view[...] = input_data
+            del view
+        # 全て書き終えてから完了フラグを立てる
+        header[0] = SharedDataset.READY
+        del header
+
+        return SharedDataset(shm, meta, data_offset)
+
+    @staticmethod
+    def attach(name:str):
+        shm = shared_memory.SharedMemory(name=name)
+        header = np.ndarray((2,), dtype=np.uint64, buffer=shm.buf)
+        ready, meta_size = int(header[0]), int(header[1])
+        del header
+        if ready != SharedDataset.READY:
+            shm.close()
+            return None
+
+        meta = pickle.loads(shm.buf[SharedDataset.HEADER_SIZE:SharedDataset.HEADER_SIZE + meta_size])
+        data_offset = -(-(SharedDataset.HEADER_SIZE + meta_size) // SharedDataset.ALIGN) * SharedDataset.ALIGN
+
+        return SharedDataset(shm, meta, data_offset)
+
+    def release(self, unlink:bool=False):
+        self.input_data_list = []
+        try:
+            self.shm.close()
+        except BufferError:
+            # ビューが残っている場合は参照が無くなった時点で解放される
+            pass
+        if unlink:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class PackedDataset:
+    # dataset.jsonと画像をまとめて変換したファイル(packコマンドで作成)
+    # dataset.npy: 全入力データを ALIGN 境界に詰めた1次元のuint8配列
+    # dataset.index.json: 各入力データの (オフセット, shape, dtype)、ファイル名、正解値、変換元dataset.jsonの更新時刻
+    ALIGN = 64
+
+    num_problem: int
+    filename_list: list
+    input_data_list: list
+    correct_list: list
+
+    def __init__(self, index:dict, packed:np.ndarray) -> None:
+        self.num_problem = index["num_problem"]
+        self.filename_list = index["filename_list"]
+        self.correct_list = index["correct_list"]
+
+        # メモリマップ上のビューを作る(コピーしない、読み取り専用)
+        packed = packed.view(np.ndarray)
+        self.input_data_list = []
+        for offset, shape, dtype in index["items"]:
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            self.input_data_list.append(packed[offset:offset + size].view(dtype).reshape(shape))
+
+    @staticmethod
+    def paths(task_id, data_type:Task.DataType):
+        dir = os.path.dirname(dataset_json_path(task_id, data_type))
+        return os.path.join(dir, FILENAME_PACKED_NPY), os.path.join(dir, FILENAME_PACKED_INDEX)
+
+    @staticmethod
+    def pack(task:Task, data_type:Task.DataType) -> int:
+        json_path = dataset_json_path(task.id, data_type)
+        source_mtime_ns = os.stat(json_path).st_mtime_ns
+        num_problem, filename_list, input_data_list, correct_list = read_dataset(
+            json_path, answer_type(task), task.multi_input_data, task.input_data_type)
+
+        items = []
+        size = 0
+        for input_data in input_data_list:
+            items.append((size, list(input_data.shape), input_data.dtype.str))
+            size += -(-input_data.nbytes // PackedDataset.ALIGN) * PackedDataset.ALIGN
+
+        npy_path, index_path = PackedDataset.paths(task.id, data_type)
+
+        # 書き終えてからリネームし、評価側が書き込み途中のファイルを開かないようにする
+        temp_path = npy_path + ".tmp.npy"
+        packed = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=(max(size, 1),))
+        for (offset, shape, dtype), input_data in zip(items, input_data_list):
+            input_data = np.ascontiguousarray(input_data)
+            packed[offset:offset + input_data.nbytes] = input_data.reshape(-1).view(np.uint8)
+        packed.flush()
+        del packed
+        os.replace(temp_path, npy_path)
+
+        index = {
+            "source_mtime_ns": source_mtime_ns,
+            "num_problem": num_problem,
+            "filename_list": filename_list,
+            "correct_list": correct_list.tolist(),
+            "items": items,
+        }
+        with open(index_path + ".tmp", "w", encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+        return num_problem
+
+    @staticmethod
+    def indexKey(task_id, data_type:Task.DataType):
+        # 変換後にdataset.jsonか変換結果が更新されたら別物として扱う
+        npy_path, index_path = PackedDataset.paths(task_id, data_type)
+        return (os.stat(dataset_json_path(task_id, data_type)).st_mtime_ns,
+                os.stat(npy_path).st_mtime_ns, os.stat(index_path).st_mtime_ns)
+
+    @staticmethod
+    def read(task_id, data_type:Task.DataType):
+        npy_path, index_path = PackedDataset.paths(task_id, data_type)
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+        if index["source_mtime_ns"] != os.stat(dataset_json_path(task_id, data_type)).st_mtime_ns:
+            # dataset.jsonが変換後に更新されている
+            return None
+
+        return PackedDataset(index, np.load(npy_path, mmap_mode='r'))
+
+
+class DatasetCache:
+    SHM_PREFIX = r"shuggle_"
+    SHM_DIR = r"/dev/shm" # 共有メモリブロックが置かれるディレクトリ(Linux)
+
+    # 評価のメインプロセスが作成・所有する共有メモリ (task_id, DataType) -> (名前, SharedDataset)
+    _owned = {}
+    _owner_pid = None # _ownedのブロックを作成したプロセス(forkしたワーカーは辞書を引き継いでも削除しない)
+    _swept = False # 前回の異常終了で残ったブロックを削除したか
+    # ProcOneUserのワーカーが接続中の共有メモリ (task_id, DataType) -> (名前, SharedDataset)
+    _attached = {}
+    # 開いている変換済みデータセット (task_id, DataType) -> (indexKey, PackedDataset)
+    _packed = {}
+
+    @staticmethod
+    def shmName(task_id, data_type:Task.DataType):
+        # dataset.jsonの更新時刻をキーに含め、更新されたら別のブロックになるようにする
+        mtime_ns = os.stat(dataset_json_path(task_id, data_type)).st_mtime_ns
+        key = f"{task_id}/{data_type.name}/{mtime_ns}"
+        return DatasetCache.SHM_PREFIX + hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def sweep():
+        # 所有していないSHM_PREFIXのブロックを削除する(前回の異常終了で残ったもの。dataset.jsonが更新されると同じ名前では作り直されない)
+        owned = set(name for name, shared in DatasetCache._owned.values())
+        try:
+            names = os.listdir(DatasetCache.SHM_DIR)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(DatasetCache.SHM_PREFIX) and not name in owned:
+                try:
+                    os.remove(os.path.join(DatasetCache.SHM_DIR, name))
+                    print(f"stale shared memory removed: {name}")
+                except OSError:
+                    pass
+
+    @staticmethod
+    def preload(task:Task):
+        # 最初の展開の前に、前回の異常終了で残ったブロックを削除する
+        if not DatasetCache._swept:
+            DatasetCache._swept = True
+            DatasetCache.sweep()
+
+        answer_value_type = answer_type(task)
+        data_types = [Task.DataType.train, Task.DataType.valid]
+        if task.type == Task.TaskType.Contest:
+            data_types.append(Task.DataType.test)
+
+        for data_type in data_types:
+            key = (task.id, data_type)
+            try:
+                name = DatasetCache.shmName(task.id, data_type)
+            except OSError:
+                continue
+
+            # 変換済みのデータセットがあればメモリマップで開くため、共有メモリは不要
+            if DatasetCache.openPacked(task.id, data_type) is not None:
+                if key in DatasetCache._owned:
+                    DatasetCache._owned.pop(key)[1].release(unlink=True)
+                continue
+
+            if key in DatasetCache._owned:
+                if DatasetCache._owned[key][0] == name:
+                    continue
+                # dataset.jsonが更新されたので古いブロックを破棄
+                DatasetCache._owned.pop(key)[1].release(unlink=True)
+
+            num_problem, filename_list, input_data_list, correct_list = read_dataset(
+                dataset_json_path(task.id, data_type), answer_value_type, task.multi_input_data, task.input_data_type)
+            try:
+                DatasetCache._owned[key] = (name, SharedDataset.create(name, num_problem, filename_list, input_data_list, correct_list))
+                DatasetCache._owner_pid = os.getpid()
+                print(f"dataset cached: {task.id} {data_type.name} ({num_problem})")
+            except Exception as e:
+                print(f"共有メモリにデータセットを展開できません({task.id} {data_type.name}): {e}")
+
+    @staticmethod
+    def openPacked(task_id, data_type:Task.DataType) -> PackedDataset:
+        key = (task_id, data_type)
+        try:
+            index_key = PackedDataset.indexKey(task_id, data_type)
+        except OSError:
+            DatasetCache._packed.pop(key, None)
+            return None
+
+        if key in DatasetCache._packed and DatasetCache._packed[key][0] == index_key:
+            return DatasetCache._packed[key][1]
+
+        try:
+            packed = PackedDataset.read(task_id, data_type)
+        except Exception as e:
+            print(f"変換済みデータセットを開けません({task_id} {data_type.name}): {e}")
+            packed = None
+        if packed is None:
+            DatasetCache._packed.pop(key, None)
+            return None
+        DatasetCache._packed[key] = (index_key, packed)
+        return packed
+
+    @staticmethod
+    def load(task_id, data_type:Task.DataType, answer_value_type=int, multi_data:bool=False, input_data_type:Task.InputDataType=Task.InputDataType.Image3ch):
+        # (データ数, ファイル名リスト, 入力データ, 正解値) を返す。入力データは展開済みのリストかDatasetReaderで、stream_inputs()で取り出す
+        # 変換済みのデータセットがあればメモリマップで開く(ページキャッシュを全プロセスで共有する)
+        packed = DatasetCache.openPacked(task_id, data_type)
+        if packed is not None:
+            return packed.num_problem, list(packed.filename_list), list(packed.input_data_list), np.array(packed.correct_list, dtype=answer_value_type)
+
+        key = (task_id, data_type)
+        shared = None
+        try:
+            name = DatasetCache.shmName(task_id, data_type)
+            if key in DatasetCache._owned and DatasetCache._owned[key][0] == name:
+                shared = DatasetCache._owned[key][1]
+            elif key in DatasetCache._attached and DatasetCache._attached[key][0] == name:
+                shared = DatasetCache._attached[key][1]
+            else:
+                if key in DatasetCache._attached:
+                    DatasetCache._attached.pop(key)[1].release()
+                shared = SharedDataset.attach(name)
+                if shared is not None:
+                    DatasetCache._attached[key] = (name, shared)
+        except (OSError, ValueError):
+            shared = None
+
+        if shared is None:
+            # キャッシュが無ければ入力データは評価しながらファイルから読み込む(stream_inputs()で取り出す)
+            reader = DatasetReader(dataset_json_path(task_id, data_type), answer_value_type, multi_data, input_data_type)
+            return reader.num_problem, list(reader.filename_list), reader, reader.correct_list
+
+        # 呼び出し側でシャッフルされるためリストと正解値はコピーを返す(入力データはビューのまま)
+        return shared.num_problem, list(shared.filename_list), list(shared.input_data_list), np.array(shared.correct_list, dtype=answer_value_type)
+
+    @staticmethod
+    def release():
+        for name, shared in DatasetCache._attached.values():
+            shared.release()
+        DatasetCache._attached = {}
+        for name, shared in DatasetCache._owned.values():
+            shared.release(unlink=DatasetCache._owner_pid == os.getpid())
+        DatasetCache._owned = {}
+        DatasetCache._packed = {}
+
+    @staticmethod
+    def releaseOnSignal():
+        # SIGTERM,SIGINTで終了するときも共有メモリを削除する(シグナルで終了するとatexitが呼ばれない)
+        # 削除した後は元の動作に戻して同じシグナルで終了する
+        def handler(signum, frame):
+            DatasetCache.release()
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(signum, handler)
+
+
+atexit.register(DatasetCache.release)
+
+
+if __name__ == "__main__":
+    # データセットをメモリマップ用に変換する: python dataset.py pack [task_id ...]
+    if len(sys.argv) < 2 or sys.argv[1] != "pack":
+        print("usage: python dataset.py pack [task_id ...]")
+        exit()
+
+    task_ids = sys.argv[2:] if len(sys.argv) > 2 else Task.readTasks().keys()
+    for task_id in task_ids:
+        task = Task(task_id)
+        for data_type in Task.DataType:
+            if not os.path.exists(dataset_json_path(task_id, data_type)):
+                continue
+            num_problem = PackedDataset.pack(task, data_type)
+            print(f"packed: {task_id} {data_type.name} ({num_problem})")
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import datetime
+import threading
+import queue
+
+
+class Events:
+    # 評価側から閲覧側へ評価の進み具合を知らせる(追記のみのJSON Linesファイルを介する)
+    EVENTS_PATH = r"./data/events.jsonl"
+    MAX_SIZE = 1024 * 1024 # これを超えたら評価側が作り直す
+
+    QUEUED = "queued" # 評価待ちに積んだ
+    STARTED = "started" # 評価を始めた
+    ITEM = "item" # N件目まで評価した
+    FINISHED = "finished" # 評価が終わった
+    STATE = "state" # 評価側の起動時と作り直したときに、評価中の提出をまとめて知らせる
+
+    @staticmethod
+    def publish(event_type:str, task_id, user_name, **fields) -> bool:
+        event = {"type": event_type, "task_id": task_id, "user_name": user_name, "time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        event.update(fields)
+        return Events._append(Events.EVENTS_PATH, (json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8'))
+
+    @staticmethod
+    def _append(path:str, data:bytes) -> bool:
+        # O_APPENDで開いて1回のwriteで書くので、複数の評価プロセスが書いても行が混ざらない
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            return True
+        except OSError as e:
+            print(f"events: {e}")
+            return False
+
+    @staticmethod
+    def reset(running:list=None):
+        # 評価中の提出だけを書いたファイルに置き換える(閲覧側はinodeが変わったことで読み直す)
+        running = running or []
+        event = {"type": Events.STATE, "running": running, "time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        temp_path = Events.EVENTS_PATH + ".tmp"
+        try:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            if Events._append(temp_path, (json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8')):
+                os.replace(temp_path, Events.EVENTS_PATH)
+        except OSError as e:
+            print(f"events: {e}")
+
+    @staticmethod
+    def size() -> int:
+        try:
+            return os.path.getsize(Events.EVENTS_PATH)
+        except OSError:
+            return 0
+
+
+class EventHub:
+    # 閲覧側: 1つのスレッドがイベントファイルを追いかけ、接続中のクライアントに配る
+    # (タブごとにファイルを見に行かずに済む。評価中の提出もここで把握する)
+    POLL_INTERVAL_SEC = 0.5
+    CLIENT_QUEUE_SIZE = 256
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.running = {} # (task_id, filename) -> 最新のstartedかitemのイベント
+        self.file_id = None
+        self.offset = 0
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        # fork後の子プロセスには追いかけるスレッドが引き継がれないので、プロセスごとに起動する
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.clients = set()
+            self.file_id = None
+            self.offset = 0
+            self.running = {}
+            self.poll()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(EventHub.POLL_INTERVAL_SEC)
+            with self.lock:
+                try:
+                    self.poll()
+                except Exception as e:
+                    print(f"events: {e}")
+
+    def poll(self):
+        # 追記された行を読んで状態に反映し、クライアントに配る(lockを取って呼ぶこと)
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        file_id = (st.st_dev, st.st_ino)
+        if file_id != self.file_id or st.st_size < self.offset:
+            # 評価側が作り直したので先頭から読む
+            self.file_id = file_id
+            self.offset = 0
+            self.running = {}
+        if st.st_size == self.offset:
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(st.st_size - self.offset)
+        end = data.rfind(b"\n") + 1 # 書きかけの行は次回に回す
+        self.offset += end
+        for line in data[:end].decode('utf-8', errors='replace').splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            self.apply(event)
+            self.broadcast(event)
+
+    def apply(self, event:dict):
+        event_type = event.get("type")
+        if event_type == Events.STATE:
+            self.running = {(job["task_id"], job["filename"]): job for job in event.get("running", [])}
+        elif event_type in [Events.STARTED, Events.ITEM]:
+            self.running[(event.get("task_id"), event.get("filename"))] = event
+        elif event_type == Events.FINISHED:
+            self.running.pop((event.get("task_id"), event.get("filename")), None)
+
+    def broadcast(self, event:dict):
+        for client in self.clients:
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                # 受け取りが追いつかないクライアントには取りこぼしたことだけを知らせる
+                try:
+                    while True:
+                        client.get_nowait()
+                except queue.Empty:
+                    pass
+                client.put_nowait({"type": Events.STATE, "running": []})
+
+    def subscribe(self) -> queue.Queue:
+        self.start()
+        client = queue.Queue(EventHub.CLIENT_QUEUE_SIZE)
+        with self.lock:
+            self.clients.add(client)
+        return client
+
+    def unsubscribe(self, client:queue.Queue):
+        with self.lock:
+            self.clients.discard(client)
+
+    def runningJobs(self, task_id) -> list:
+        # task_idで評価中の提出(started/itemのイベント)を開始順に返す
+        self.start()
+        with self.lock:
+            return sorted([job for (job_task_id, _), job in self.running.items() if job_task_id == task_id], key=lambda x: x.get("time", ""))
@@ -1,30 +1,45 @@
-from flask import Flask, render_template, request, redirect, url_for, make_response, Markup, send_from_directory, send_file
+from flask import Flask, render_template, request, redirect, url_for, make_response, Markup, send_from_directory, send_file, Response, stream_with_context, stream_template, get_template_attribute
 from flask_httpauth import HTTPBasicAuth, HTTPDigestAuth
 from werkzeug.utils import secure_filename
 import json
 from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
+import hashlib
 
 import os
 import glob
 import datetime
 from enum import Enum
 import shutil
+import threading
+import queue
 
-from task import Task, Stats, Log
+from task import Task, TASKS, Stats, StatsCsvReader, Log
+from intake import Intake
+from scheduler import Scheduler
+from results_store import ResultsStore
+from events import Events, EventHub
+from metrics import Metrics
 
 
 OUTPUT_DIR_NAME = r"output"
 UPLOAD_DIR_NAME = r"upload"
+UPLOADING_SUFFIX = r".uploading"
 ALLOWED_EXTENSIONS = set(['py'])
-TASK = {}
 SETTING = None
+BOARD_CACHE = {}
+SUBMISSION_SUMMARY = None
 USER_CSV_PATH = r"./data/users.csv"
 SETTING_JSON_PATH = r"./data/setting.json"
 HASH_METHOD = "pbkdf2:sha256:260000"
 USER_MODULE_DIR_NAME = r"user_module"
 COOKIE_KEY = "user"
 COOKIE_AGE_SEC = 60 * 60 * 24 * 365
+LOG_PAGE_SIZE = 100 # 管理者ページで一度に読み込むログの行数
+LOG_PAGE_SIZE_MAX = 1000
+EVENTS_KEEPALIVE_SEC = 15.0 # 評価の進み具合を送る接続で、何も無いときにコメントを送る間隔
+EVENTS_RETRY_MSEC = 3000 # 切断されたときにブラウザが再接続するまでの時間
+STREAM_CHUNK_SIZE = 16 * 1024 # テンプレートを描画しながら送るときに、まとめて送る文字数
 
 
 class UserData():
@@ -100,10 +115,69 @@ def WriteUsersCsv(path:str, users:dict, must_backup:bool=True) -> bool:
                 f.write(f"{user_data.email},{id},{user_data.name},{user_data.key},{user_data.pass_hash}\n")
     except:
         return False
+
+    # 書き込んだ内容をすぐに反映させる
+    if os.path.abspath(path) == os.path.abspath(USERS.path):
+        USERS.reload()
     
     return True
 
 
+class UserRegistry:
+    # users.csvの内容をプロセス内に保持し、ファイルが更新されたときだけ読み直す
+    path: str
+    file_key: tuple # (st_mtime_ns, st_size, st_ino)
+    users: dict # id -> UserData
+    emails: dict # email -> id
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self.file_key = None
+        self.users = {}
+        self.emails = {}
+        self.lock = threading.Lock()
+
+    def fileKey(self) -> tuple:
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            return None
+
+    def reload(self):
+        with self.lock:
+            file_key = self.fileKey()
+            users = ReadUsersCsv(self.path)
+            emails = {}
+            for id, user_data in users.items():
+                # 同じemailが複数あればファイル上で先のユーザを使う
+                emails.setdefault(user_data.email, id)
+            self.users = users
+            self.emails = emails
+            self.file_key = file_key
+
+    def refresh(self):
+        if self.file_key is None or self.fileKey() != self.file_key:
+            self.reload()
+
+    def all(self) -> dict:
+        # 返した辞書とUserDataは書き換えないこと(更新はWriteUsersCsvを使う)
+        self.refresh()
+        return self.users
+
+    def get(self, id) -> UserData:
+        return self.all().get(id)
+
+    def findByEmail(self, email) -> UserData:
+        self.refresh()
+        id = self.emails.get(email)
+        return self.users.get(id) if id is not None else None
+
+
+USERS = UserRegistry(USER_CSV_PATH)
+EVENTS = EventHub(Events.EVENTS_PATH)
+
+
 def AddUsersCsv(path:str, id:str, email:str, name:str, pass_hash:str, key:str) -> bool:
     # ユーザデータを読み込む
     users = ReadUsersCsv(path)
@@ -144,30 +218,17 @@ def UpdateUsersCsv(path:str, id:str, target:str, value:str) -> bool:
     return WriteUsersCsv(path, users)
 
 
-def GetUserStats(task_id) -> {}:
-    # Task情報からmetricを読み込む
-    task = Task(task_id)
-    
-    # ユーザ情報を読み込む
-    users = ReadUsersCsv(USER_CSV_PATH)
-
-    file_paths = glob.glob(os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "user", "*.csv"))
+def GetUserStatsFromCsv(task:Task, users:dict) -> {}:
+    file_paths = glob.glob(os.path.join(Task.TASKS_DIR, task.id, OUTPUT_DIR_NAME, "user", "*.csv"))
     stats = {}
     for file_path in file_paths:
         user_id = os.path.splitext(os.path.basename(file_path))[0]
         if not user_id in users:
             continue
         user_name = users[user_id].name
-        stats[user_id] = []
-        
-        with open(file_path, "r", encoding='utf-8') as csv_file:
-            line = csv_file.readline() # ヘッダ読み飛ばし
-            while True:
-                line = csv_file.readline()
-                if not line:
-                    break
 
-                stats[user_id].append(Stats(line, user_name, task.metric, task.goal, user_id))
+        # 前回から追記された行だけを読む
+        stats[user_id] = StatsCsvReader.read(file_path, user_name, task.metric, task.goal, user_id)
 
         # ひとつもstatsがなかった場合はキーを削除
         if len(stats[user_id]) == 0:
@@ -176,6 +237,41 @@ def GetUserStats(task_id) -> {}:
     return stats
 
 
+def GetUserStats(task_id, user_id=None) -> {}:
+    # Task情報からmetricを読み込む
+    task = TASKS.get(task_id)
+    
+    # ユーザ情報を読み込む(user_idを指定したらそのユーザだけ)
+    users = USERS.all()
+    if user_id is not None:
+        users = {user_id: users[user_id]} if user_id in users else {}
+
+    # 成績DBから読み込む(DBが使えなければCSVを直接読む)
+    try:
+        return ResultsStore.userStats(task, {user_id: user.name for user_id, user in users.items()}, user_id)
+    except Exception as e:
+        print(f"ResultsStore: {e}")
+        return GetUserStatsFromCsv(task, users)
+
+
+def GetBestStatsEveryUser(task:Task, users:dict=None) -> {}:
+    # ユーザ情報を読み込む
+    if users is None:
+        users = USERS.all()
+
+    # 評価のたびに更新されている表示最優先の成績を使う(DBが使えなければ全成績から選ぶ)
+    try:
+        return ResultsStore.bestStats(task, {user_id: user.name for user_id, user in users.items()}, Stats.BestWithTest(task))
+    except Exception as e:
+        print(f"ResultsStore: {e}")
+        best_stats_every_user = {}
+        for user_id, stats in GetUserStatsFromCsv(task, users).items():
+            best_stats = Stats.GetBestStats(stats, task)
+            if best_stats is not None:
+                best_stats_every_user[user_id] = best_stats
+        return best_stats_every_user
+
+
 def menuHTML(page, task_id="", url_from="", admin=False):
     html = """
         <nav class="navbar navbar-expand-lg navbar-dark bg-dark fixed-top">
@@ -203,7 +299,7 @@ def menuHTML(page, task_id="", url_from="", admin=False):
                             <a class="nav-link{4} href="/{5}/upload">提出</a>
                         </li>
         """.format(
-            TASK[task_id].name,
+            TASKS.get(task_id).name,
             " active\" aria-current=\"page\"" if page == Page.TASK else "\"",
             " active\" aria-current=\"page\"" if page == Page.BOARD else "\"",
             " active\" aria-current=\"page\"" if page == Page.LOG else "\"",
@@ -237,15 +333,9 @@ def menuHTML(page, task_id="", url_from="", admin=False):
 
 
 def EvaluatedValueStyle(metric:Task.Metric, evaluated_value, goal) -> str:
-    achieve = False
-    if metric == Task.Metric.Accuracy:
-        if evaluated_value >= goal:
-            achieve = True
-    elif metric == Task.Metric.MAE:
-        if evaluated_value <= goal:
-            achieve = True
+    achieve = Metrics.get(metric).achieve(evaluated_value, goal)
     
-    return ' style="color:#0dcaf0"' if achieve else ''
+    return Markup(' style="color:#0dcaf0"') if achieve else ''
 
 
 def Achieve(task:Task, stats:Stats):
@@ -253,258 +343,230 @@ def Achieve(task:Task, stats:Stats):
     if task.type == Task.TaskType.Contest and datetime.datetime.now() < task.end_date:
         return ''
 
-    result = f'<span style="color:#0dcaf0">{"★" if task.type == Task.TaskType.Contest else "☆"}</span>'
-    if task.metric == Task.Metric.Accuracy:
-        if stats.train < task.goal or stats.valid < task.goal or (task.type == Task.TaskType.Contest and stats.test < task.goal):
-            result = ''
-    elif task.metric == Task.Metric.MAE:
-        if stats.train > task.goal or stats.valid > task.goal or (task.type == Task.TaskType.Contest and stats.test > task.goal):
-            result = ''
+    result = Markup(f'<span style="color:#0dcaf0">{"★" if task.type == Task.TaskType.Contest else "☆"}</span>')
+    if not AchieveGoal(task, stats):
+        result = ''
 
     return result
 
 
-def CreateTableRow(stats, task:Task, test=False, message=False, memo=False, visible_invalid_result=False, unlock=False):
-    html_user = ""
-    html_user += f'<tr>'
-    html_user += f'<td>{stats.username} {Achieve(task, stats)}</td>'
-    if unlock and AchieveGoal(task, stats):
-        html_user += f'<td><a href="/source/{task.id}/{stats.filename}" class="link-info">{stats.datetime}</a></td>'
-    else:
-        html_user += f'<td>{stats.datetime}</td>'
+def SpeedText(task:Task) -> str:
+    # 速度も競うタスクの説明
+    if task.speed_objective is None:
+        return ''
+    name = {"p50": "中央値", "p95": "95パーセンタイル", "max": "最大値"}[task.speed_objective]
+    return f'1データあたり処理時間の{name}(ms)に{task.speed_weight}をかけた値を評価値から差し引いて順位を決めます(目標達成の判定には影響しません)。'
+
+
+def FormatValue(metric:Task.Metric, value, percent_sign:str='%', suffix:bool=False) -> str:
+    # 評価値の表示(百分率の評価指標は%で、それ以外は小数3桁で。suffixなら評価指標の名前を添える)
+    metric = Metrics.get(metric)
+    if metric.percent:
+        return f'{value * 100:.2f} {percent_sign}'
+    return f'{value:.3f}({metric.name})' if suffix else f'{value:.3f}'
+
+
+class BoardTable:
+    # 成績表(参加者ごとの最高成績や提出の履歴)。HTMLはtemplates/tables.htmlのマクロで1行ずつ作る
+    def __init__(self, stats_list, task:Task, test=False, message=False, memo=False, unlock=False, table_id='sortable-table', usage=False) -> None:
+        self.stats_list = stats_list
+        self.task = task
+        self.test = test
+        self.message = message
+        self.memo = memo
+        self.unlock = unlock
+        self.table_id = table_id
+        self.usage = usage
+        self.speed = usage and Stats.Speed(task) is not None # 速度込みの順位の列を出すか
+
+        label = Metrics.get(task.metric).label
+        self.columns = ["参加者", "提出日時", f"train(配布){label}", f"valid{label}"]
+        if test:
+            self.columns.append(f"test{label}")
+        if usage:
+            self.columns += [Markup("処理時間[ms]<br>中央値/95%/最大"), "CPU時間[s]", "メモリ[MB]"]
+            if self.speed:
+                self.columns.append("順位(速度込み)")
+        if memo:
+            self.columns.append("メモ")
+        if message:
+            self.columns.append("メッセージ")
+        self.num_col = len(self.columns)
+
+        # 速度も競うタスクでは、表示最優先の成績と同じ比べ方で順位をつける
+        self.ranks = {}
+        if self.speed:
+            with_test = Stats.BestWithTest(task)
+            speed = Stats.Speed(task)
+            valid_stats = [stats for stats in stats_list if Stats.IsValid(stats)]
+            for rank, stats in enumerate(sorted(valid_stats, key=lambda x: Stats.BestKey(x, with_test, speed), reverse=True)):
+                self.ranks[id(stats)] = rank + 1
+
+    def rows(self):
+        # (成績, 速度込みの順位)を表の順に返す。評価できなかった提出は載せない
+        for stats in self.stats_list:
+            if stats.train < 0:
+                continue
+            yield stats, self.ranks.get(id(stats))
 
-    html_temp = ""
-    if task.metric == Task.Metric.Accuracy:
-        if stats.train < 0:
-            if visible_invalid_result:
-                html_temp += ('<td>-</td><td>-</td><td>-</td>' if test else '<td>-</td><td>-</td>')
-            else:
-                return ""
-        else:
-            html_temp += f'<td{EvaluatedValueStyle(task.metric, stats.train, task.goal)}>{stats.train * 100:.2f} %</td>'
-            html_temp += f'<td{EvaluatedValueStyle(task.metric, stats.valid, task.goal)}>{stats.valid * 100:.2f} %</td>'
-            if test:
-                if task.type == Task.TaskType.Contest:
-                    if unlock:
-                        html_temp += f'<td{EvaluatedValueStyle(task.metric, stats.test, task.goal)}>{stats.test * 100:.2f} %</td>'
-                    else:
-                        html_temp += f'<td>?</td>'
-                else:
-                    html_temp += f'<td>-</td>'
-    
-    elif task.metric == Task.Metric.MAE:
-        if stats.train < 0:
-            if visible_invalid_result:
-                html_temp += ('<td>-</td><td>-</td><td>-</td>' if test else '<td>-</td><td>-</td>')
-            else:
-                return ""
-        else:
-            try:
-                html_temp += f'<td{EvaluatedValueStyle(task.metric, stats.train, task.goal)}>{stats.train:.3f}</td>'
-                html_temp += f'<td{EvaluatedValueStyle(task.metric, stats.valid, task.goal)}>{stats.valid:.3f}</td>'
-                if test:
-                    if task.type == Task.TaskType.Contest:
-                        if unlock:
-                            html_temp += f'<td{EvaluatedValueStyle(task.metric, stats.test, task.goal)}>{stats.test:.3f}</td>'
-                        else:
-                            html_temp += f'<td>?</td>'
-                    else:
-                        html_temp += f'<td>-</td>'
-            except:
-                html_temp += ('<td>-</td><td>-</td><td>-</td>' if test else '<td>-</td><td>-</td>')
 
-    html_user += html_temp
+def StreamTemplate(template_name, **context) -> Response:
+    # テンプレートを描画しながら送る(大きな表でも先頭から送り始め、ページ全体をメモリに持たない)
+    # 描画はリクエストの中で始めておく(stream_templateがリクエストのコンテキストを引き継ぐ)
+    stream = stream_template(template_name, **context)
+    def chunks():
+        buffer = []
+        size = 0
+        for text in stream:
+            buffer.append(text)
+            size += len(text)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+        yield "".join(buffer)
+    return Response(chunks())
 
-    if memo:
-        html_user += f'<td>{stats.memo}</td>'
-    if message:
-        html_user += f'<td>{stats.message}</td>'
-    html_user += f'</tr>'
 
-    return html_user
+def RenderBoardTable(table:BoardTable) -> Markup:
+    # 表全体のHTML(掲示板は評価結果が更新されるまで同じ表を使い回す)
+    return get_template_attribute('tables.html', 'board_table')(table)
 
 
-def CreateBoardTable(stats_list, task:Task, test=False, message=False, memo=False, unlock=False, table_id='sortable-table'):
-    def metricName(metric: Task.Metric):
-        if metric == Task.Metric.Accuracy:
-            return '正解率'
-        elif metric == Task.Metric.MAE:
-            return '平均絶対誤差'
-        else:
-            return ''
-
-    num_col = 0
-    html_table = ""
-    html_table += f"<table class=\"table table-dark\" id=\"{table_id}\">"
-    html_table += "<thead><tr>"
-    html_table += f"<th id=\"th-{num_col}\">参加者</th>"
-    num_col += 1
-    html_table += f"<th id=\"th-{num_col}\">提出日時</th>"
-    num_col += 1
-    html_table += f"<th id=\"th-{num_col}\">train(配布){metricName(task.metric)}</th>"
-    num_col += 1
-    html_table += f"<th id=\"th-{num_col}\">valid{metricName(task.metric)}</th>"
-    num_col += 1
-    if test:
-        html_table += f"<th id=\"th-{num_col}\">test{metricName(task.metric)}</th>"
-        num_col += 1
-    if memo:
-        html_table += f"<th id=\"th-{num_col}\">メモ</th>"
-        num_col += 1
-    if message:
-        html_table += f"<th id=\"th-{num_col}\">メッセージ</th>"
-        num_col += 1
-    html_table += "</tr></thead>"
-    html_table += "<tbody>"
-
-    for stats in stats_list:
-        html_table += CreateTableRow(stats, task, test=test, message=message, memo=memo, unlock=unlock)
-
-    html_table += "</tbody>"
-    html_table += "</table>"
-
-    return html_table, num_col
+def JobKey(filename) -> str:
+    # 評価中の提出をブラウザ側で見分けるためのキー(ファイル名にはユーザIDが含まれるので送らない)
+    return hashlib.sha1(str(filename).encode('utf-8')).hexdigest()[:12]
+
+
+def FormatSec(sec) -> str:
+    sec = int(round(sec))
+    return f"{sec // 60}分{sec % 60:02d}秒" if sec >= 60 else f"{sec}秒"
+
+
+def ProgressText(task:Task, job:dict) -> str:
+    # 評価の進み具合(評価側から届いたitemイベントをもとにする。まだ届いていなければ空)
+    if job.get("total") is None:
+        return ""
+
+    text = f'({job["done"]}/{job["total"]}件'
+    if job.get("split") is not None:
+        text += f'、{job["split"]}を評価中'
+    if job.get("train") is not None:
+        metric = Metrics.get(task.metric)
+        text += f'、trainの{metric.label} ' + (f'{job["train"] * 100:.1f} %' if metric.percent else f'{job["train"]:.3f}')
+    text += f'、経過 {FormatSec(job.get("elapsed_sec", 0))}'
+    if job.get("eta_sec") is not None and job["done"] < job["total"]:
+        text += f'、残り約 {FormatSec(job["eta_sec"])}'
+    return text + ')'
 
 
 def CreateInProcHtml(task_id):
     # ユーザ情報を読み込む
-    users = ReadUsersCsv(USER_CSV_PATH)
+    users = USERS.all()
+    task:Task = TASKS.get(task_id)
 
+    # 評価中の提出(評価側から届いたイベントで把握している)。進み具合はブラウザ側でも書き換える
     inproc_text = ''
-    for user_id in users:
-        if os.path.exists(os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "user", f"{user_id}_inproc")):
-            inproc_text += f"{users[user_id].name} さんの評価を実行中です。<br>"
+    for job in EVENTS.runningJobs(task_id):
+        if job.get("user_name") in users:
+            inproc_text += f'{users[job["user_name"]].name} さんの評価を実行中です<span class="inproc-progress" data-job="{JobKey(job.get("filename"))}">{ProgressText(task, job)}</span>。<br>'
+
+    # 評価待ちの提出の順番と開始予定時刻
+    for job in Scheduler.readStatus().get("pending", []):
+        if job.get("task_id") != task_id or not job.get("user_name") in users:
+            continue
+        inproc_text += f'{users[job["user_name"]].name} さんの提出は評価待ちです({job["position"]}番目、{job["eta"][11:16]}頃に開始予定)。<br>'
 
     return inproc_text + '<br>'
 
 
-def CreateMyTaskTable(user_id) -> str:
-    submits = []
+class SubmissionSummary:
+    key: tuple
+    tasks: dict # user_id -> {task_id: (提出数, 最新の提出日時)}
 
-    # user_idのstatsをTaskごとに取得
-    for task_id, task in TASK.items():
-        task:Task = task
-        user_stats = GetUserStats(task_id)
-        if user_id in user_stats:
-            stats = user_stats[user_id]
+    def __init__(self, key) -> None:
+        self.key = key
+        self.tasks = {}
 
-            # 表示最優先の成績を選択
-            best_stats = Stats.GetBestStats(stats, task)
-            if best_stats is not None:
-                submit:Submit = Submit()
-                submit.stats = best_stats
-                submit.task = task
-                submits.append(submit)
 
-    # 提出日時でソート
-    sorted_submits = sorted(submits, key=lambda x: x.stats.datetime, reverse=True)
-    
-    # 表のHTMLを作成
-    html_table = '<table class="table table-dark">'
-    html_table += "<thead><tr>"
-    html_table += "<th>提出日時</th>"
-    html_table += "<th>Task</th>"
-    html_table += "<th>Goal</th>"
-    html_table += "<th>train</th>"
-    html_table += "<th>valid</th>"
-    html_table += "<th>test</th>"
-    html_table += "</tr></thead>"
-    html_table += "<tbody>"
+def GetSubmissionSummary() -> SubmissionSummary:
+    # 全タスクの評価側のタイムスタンプが同じなら、提出数と最新の提出日時も同じ
+    global SUBMISSION_SUMMARY
+    tasks = TASKS.all()
+    key = tuple((task_id, ReadTimestamp(task_id)) for task_id in tasks)
+    summary:SubmissionSummary = SUBMISSION_SUMMARY
+    if summary is not None and summary.key == key:
+        return summary
 
-    for submit in sorted_submits:
-        html_table += CreateSubmitTableRow(submit, goal=True, test=True, memo=False, message=False)
+    summary = SubmissionSummary(key)
+    for task_id, task in tasks.items():
+        try:
+            task_summary = ResultsStore.summary(task)
+        except Exception as e:
+            print(f"ResultsStore: {e}")
+            task_summary = {}
+            for user_id, stats in GetUserStatsFromCsv(task, USERS.all()).items():
+                task_summary[user_id] = (len(stats), max(item.datetime for item in stats))
 
-    html_table += "</tbody>"
-    html_table += "</table>"
+        for user_id, (num_submit, latest_datetime) in task_summary.items():
+            summary.tasks.setdefault(user_id, {})[task_id] = (num_submit, latest_datetime)
 
-    return html_table
+    SUBMISSION_SUMMARY = summary
+    return summary
 
 
 class Submit:
     stats: Stats
     task: Task
 
+    def testVisible(self) -> bool:
+        # testの評価値を見せるか(Contestで目標を達成していれば、期間終了後に見せる)
+        return AchieveGoal(self.task, self.stats) and datetime.datetime.now() >= self.task.end_date
 
-def CreateSubmitTableRow(submit:Submit, visible_invalid_data:bool=False, goal=False, test=False, memo:bool=True, message:bool=True):
-    try:
-        html_submit = ""
-        html_submit += f'<tr>'
-        html_submit += f'<td><a href="/source/{submit.task.id}/{submit.stats.filename}" class="link-info">{submit.stats.datetime}</a></td>'
-        html_submit += f'<td><a href="/{submit.task.id}/task" class="link-info">{submit.task.name}</a></td>'
-
-        html_temp = ""
-        if submit.task.metric == Task.Metric.Accuracy:
-            if goal:
-                html_temp += f'<td>正解率 <span style="color:#0dcaf0">{submit.task.goal*100:.0f}</span> &percnt; 以上 {Achieve(submit.task, submit.stats)}</td>'
-            if submit.stats.train < 0:
-                if visible_invalid_data:
-                    html_temp += '<td>-</td><td>-</td>' if not test else '<td>-</td><td>-</td><td>-</td>'
-                else:
-                    return ""
-            else:
-                html_temp += f'<td{EvaluatedValueStyle(submit.task.metric, submit.stats.train, submit.task.goal)}>{submit.stats.train * 100:.2f} &percnt;</td>'
-                html_temp += f'<td{EvaluatedValueStyle(submit.task.metric, submit.stats.valid, submit.task.goal)}>{submit.stats.valid * 100:.2f} &percnt;</td>'
-                if test:
-                    if submit.task.type == Task.TaskType.Quest:
-                        html_temp += '<td>-</td>'
-                    elif submit.task.type == Task.TaskType.Contest:
-                        unlock = False
-                        if AchieveGoal(submit.task, submit.stats):
-                            # Questであればいつでも、Contestであれば期間終了後にロック解除
-                            if datetime.datetime.now() >= submit.task.end_date: 
-                                html_temp += f'<td{EvaluatedValueStyle(submit.task.metric, submit.stats.test, submit.task.goal)}>{submit.stats.test * 100:.2f} &percnt;</td>'
-                                unlock = True
-                        if not unlock:
-                            html_temp += f'<td>?</td>'
-
-        elif submit.task.metric == Task.Metric.MAE:
-            if goal:
-                html_temp += f'<td>MAE <span style="color:#0dcaf0">{submit.task.goal:.1f}</span> 以下 {Achieve(submit.task, submit.stats)}</td>'
-            try:
-                if submit.stats.train < 0:
-                    if visible_invalid_data:
-                        html_temp += '<td>-</td><td>-</td>' if not test else '<td>-</td><td>-</td><td>-</td>'
-                    else:
-                        return ""
-                else:
-                    html_temp += f'<td{EvaluatedValueStyle(submit.task.metric, submit.stats.train, submit.task.goal)}>{submit.stats.train:.3f}(MAE)</td>'
-                    html_temp += f'<td{EvaluatedValueStyle(submit.task.metric, submit.stats.valid, submit.task.goal)}>{submit.stats.valid:.3f}(MAE)</td>'
-                    if test:
-                        if submit.task.type == Task.TaskType.Quest:
-                            html_temp += '<td>-</td>'
-                        elif submit.task.type == Task.TaskType.Contest:
-                            unlock = False
-                            if AchieveGoal(submit.task, submit.stats):
-                                # Questであればいつでも、Contestであれば期間終了後にロック解除
-                                if datetime.datetime.now() >= submit.task.end_date: 
-                                    html_temp += f'<td{EvaluatedValueStyle(submit.task.metric, submit.stats.test, submit.task.goal)}>{submit.stats.test:.3f}(MAE)</td>'
-                                    unlock = True
-                            if not unlock:
-                                html_temp += f'<td>?</td>'
-            except:
-                html_temp += '<td>-</td><td>-</td>'
-
-        html_submit += html_temp
 
-        if memo:
-            html_submit += f'<td>{submit.stats.memo}</td>'
-        if message:
-            html_submit += f'<td>{submit.stats.message}</td>'
+class SubmitTable:
+    # 提出の表(提出日時の新しい順)。HTMLはtemplates/tables.htmlのsubmit_rowで1行ずつ作る
+    def __init__(self, submits:list, visible_invalid_data:bool=False, goal=False, test=False, memo:bool=True, message:bool=True) -> None:
+        self.goal = goal
+        self.test = test
+        self.memo = memo
+        self.message = message
+        self.columns = ["提出日時", "Task"] + (["Goal"] if goal else []) + ["train", "valid"] + (["test"] if test else []) + (["メモ"] if memo else []) + (["メッセージ"] if message else [])
 
-        html_submit += f'</tr>'
-    except Exception as e:
-        print(e)
-        return ""
+        # 提出日時でソート(評価できなかった提出はvisible_invalid_dataのときだけ載せる)
+        self.submits = sorted([submit for submit in submits if visible_invalid_data or submit.stats.train >= 0], key=lambda x: x.stats.datetime, reverse=True)
+
+
+def CreateMyTaskTable(user_id) -> SubmitTable:
+    submits = []
+    users = USERS.all()
+    users = {user_id: users[user_id]} if user_id in users else {}
+
+    # user_idの表示最優先の成績を提出のあるTaskごとに取得
+    submitted = GetSubmissionSummary().tasks.get(user_id, {})
+    for task_id, task in TASKS.all().items():
+        task:Task = task
+        if not task_id in submitted:
+            continue
+        best_stats = GetBestStatsEveryUser(task, users).get(user_id)
+        if best_stats is not None:
+            submit:Submit = Submit()
+            submit.stats = best_stats
+            submit.task = task
+            submits.append(submit)
 
-    return html_submit
+    return SubmitTable(submits, goal=True, test=True, memo=False, message=False)
 
 
-def CreateSubmitTable(user_id) -> str:
+def CreateSubmitTable(user_id) -> SubmitTable:
     submits = []
 
-    # user_idのstatsをTaskごとに取得
-    for task_id, task in TASK.items():
-        stats_temp = GetUserStats(task_id)
+    # user_idのstatsを提出のあるTaskごとに取得
+    submitted = GetSubmissionSummary().tasks.get(user_id, {})
+    for task_id, task in TASKS.all().items():
+        if not task_id in submitted:
+            continue
+        stats_temp = GetUserStats(task_id, user_id)
         if user_id in stats_temp:
             for item in stats_temp[user_id]:
                 submit: Submit = Submit()
@@ -512,148 +574,56 @@ def CreateSubmitTable(user_id) -> str:
                 submit.task = task
                 submits.append(submit)
 
-    # 提出日時でソート
-    sorted_submits = sorted(submits, key=lambda x: x.stats.datetime, reverse=True)
-    
-    # 表のHTMLを作成
-    html_table = '<table class="table table-dark">'
-    html_table += "<thead><tr>"
-    html_table += "<th>提出日時</th>"
-    html_table += "<th>Task</th>"
-    html_table += "<th>train</th>"
-    html_table += "<th>valid</th>"
-    html_table += "<th>メモ</th>"
-    html_table += "<th>メッセージ</th>"
-    html_table += "</tr></thead>"
-    html_table += "<tbody>"
-
-    for submit in sorted_submits:
-        html_table += CreateSubmitTableRow(submit, True)
-
-    html_table += "</tbody>"
-    html_table += "</table>"
-
-    return html_table
-
-
-def CreateUserTable() -> str:
-    # 表のHTMLを作成
-    html_table = '<table class="table table-dark">'
-    html_table += "<thead><tr>"
-    html_table += "<th>ID</th>"
-    html_table += "<th>Name</th>"
-    html_table += "<th>Email</th>"
-    html_table += "<th>Num Submit</th>"
-    html_table += "<th>Latest Submit</th>"
-    html_table += "<th>Task</th>"
-    html_table += "</tr></thead>"
-    html_table += "<tbody>"
+    return SubmitTable(submits, True)
 
-    # ユーザ情報を読み込む
-    users = ReadUsersCsv(USER_CSV_PATH)
+
+class UserSummary:
+    # 管理者ページのユーザ一覧の1行
+    user: UserData
+    num_submit: int
+    latest_datetime: datetime.datetime
+    latest_task: Task # 最新の提出のTask(提出が無ければNone)
+
+
+def UserSummaries():
+    # 全ユーザの提出数と最新の提出をユーザごとに返す
+    users = USERS.all()
+    summary = GetSubmissionSummary()
 
     for user_id, user in users.items():
-        user_data:UserData = user
-
-        # 最新の提出を抽出
-        latest_datetime:datetime.datetime = datetime.datetime(1984, 4, 22)
-        latest_submit_task:Task = None
-        num_submit = 0
-        for task_id, task in TASK.items():
-            stats_temp = GetUserStats(task_id)
-            if not user_id in stats_temp:
+        user_summary = UserSummary()
+        user_summary.user = user
+        user_summary.num_submit = 0
+        user_summary.latest_datetime = datetime.datetime(1984, 4, 22)
+        user_summary.latest_task = None
+        submitted = summary.tasks.get(user_id, {})
+        for task_id, task in TASKS.all().items():
+            if not task_id in submitted:
                 continue
-            num_submit += len(stats_temp[user_id])
-            for item in stats_temp[user_id]:
-                stats:Stats = item
-                if stats.datetime > latest_datetime:
-                    latest_datetime = stats.datetime
-                    latest_submit_task = task
-
-        html_table += "<tr>"
-        html_table += f"<td>{user_data.id}</td>"
-        html_table += f"<td>{user_data.name}</td>"
-        html_table += f"<td>{user_data.email}</td>"
-        html_table += f"<td>{num_submit}</td>"
-        html_table += f"<td>{latest_datetime if latest_submit_task is not None else '-'}</td>"
-        if latest_submit_task is not None:
-            html_table += f'<td><a href="/{latest_submit_task.id}/task" class="link-info">{latest_submit_task.name}</a></td>'
-        else:
-            html_table += '<td>-</td>'
-        html_table += "</tr>"
-
-    html_table += "</tbody>"
-    html_table += "</table>"
-
-    return html_table
-
-
-def CreateTaskTable(tasks) -> str:
-    # 表のHTMLを作成
-    html_table = '<table class="table table-dark">'
-    html_table += "<thead><tr>"
-    html_table += "<th>ID</th>"
-    html_table += "<th>Name</th>"
-    html_table += "<th>開始日</th>"
-    html_table += "<th>終了日</th>"
-    html_table += "<th>Type</th>"
-    html_table += "<th>Metric</th>"
-    html_table += "<th>Goal</th>"
-    html_table += "<th>制限時間[s/data]</th>"
-    html_table += "<th>停止</th>"
-    html_table += "<th>変更</th>"
-    html_table += "</tr></thead>"
-    html_table += "<tbody>"
-
-    for task_id, item in tasks.items():
-        task:Task = item
-        html_table += f'<form method="POST">'
-        html_table += f'<input type="hidden" name="task-id" value="{task_id}">'
-        html_table += f"<tr>"
-        html_table += f"<td>{task.id}</td>"
-        html_table += f"<td>{task.name}</td>"
-        html_table += f'<td><input type="date" name="start-date" value="{task.start_date.date()}" class="bg-dark text-white"></td>'
-        html_table += f'<td><input type="date" name="end-date" value="{task.end_date.date()}" class="bg-dark text-white"></td>'
-        html_table += f"<td>{task.type.name}</td>"
-        html_table += f"<td>{task.metric.name}</td>"
-        html_table += f'<td><input type="number" name="goal" value="{task.goal}" step="0.1" class="bg-dark text-white"></td>'
-        html_table += f'<td><input type="number" name="timelimit-per-data" value="{task.timelimit_per_data}" step="0.1" class="bg-dark text-white"></td>'
-        html_table += f'<td>&nbsp;&nbsp;&nbsp;<input type="checkbox" name="suspend" class="form-check-input"{" checked" if task.suspend else ""}>&nbsp;&nbsp;&nbsp;</td>'
-        html_table += f'<td><input type="submit" value="変更" class="btn btn-outline-info"></td>'
-        html_table += f"</tr>"
-        html_table += f'</form>'
-
-    html_table += "</tbody>"
-    html_table += "</table>"
-
-    return html_table
+            user_summary.num_submit += submitted[task_id][0]
+            if submitted[task_id][1] > user_summary.latest_datetime:
+                user_summary.latest_datetime = submitted[task_id][1]
+                user_summary.latest_task = task
+        yield user_summary
 
 
 def VerifyEmailAndPassword(email, password):
-    # ユーザ情報を読み込む
-    users = ReadUsersCsv(USER_CSV_PATH)
-    
     # 認証を行う
     verified = False
-    user_data = None
-    for id, user_data in users.items():
-        if user_data.email == email:
-            pass_hash = user_data.pass_hash
-            if check_password_hash(pass_hash, password):
-                verified = True
-            break
+    user_data = USERS.findByEmail(email)
+    if user_data is not None:
+        pass_hash = user_data.pass_hash
+        if check_password_hash(pass_hash, password):
+            verified = True
     
     return verified, user_data
 
 
 def VerifyIdAndKey(user_id, user_key):
-    # ユーザ情報を読み込む
-    users = ReadUsersCsv(USER_CSV_PATH)
-    
     # 認証を行う
     verified = False
-    if user_id in users:
-        user_data = users[user_id]
+    user_data = USERS.get(user_id)
+    if user_data is not None:
         if user_data.key == user_key:
             verified = True
     else:
@@ -689,17 +659,19 @@ def AchieveGoal(task:Task, stats:Stats):
     if task.type == Task.TaskType.Contest:
         results.append(stats.test)
 
+    metric = Metrics.get(task.metric)
     for result in results:
-        if task.metric == Task.Metric.Accuracy:
-            if result < task.goal:
-                return False
-        elif task.metric == Task.Metric.MAE:
-            if result > task.goal:
-                return False
+        if not metric.achieve(result, task.goal):
+            return False
 
     return True
 
 
+# 表のマクロ(templates/tables.html)から使う関数とクラス
+for template_global in [Achieve, AchieveGoal, EvaluatedValueStyle, FormatValue, Task, Metrics]:
+    app.add_template_global(template_global)
+
+
 @app.route('/')
 def index():
     # ユーザ認証
@@ -710,7 +682,7 @@ def index():
     task_list_open = []
     task_list_closed = []
     task_list_prepare = []
-    for key, value in TASK.items():
+    for key, value in TASKS.all().items():
         task:Task = value
         if task.suspend:
             continue
@@ -784,15 +756,10 @@ def join():
             return render_template(f'join.html', from_url=from_url, message="再入力したパスワードが一致していません。")
         
         # ユーザ情報を読み込む
-        users = ReadUsersCsv(USER_CSV_PATH)
+        users = USERS.all()
 
         # email重複チェック
-        duplicate = False
-        for user_id, user_data in users.items():
-            if email == user_data.email:
-                duplicate = True
-                break
-        if duplicate:
+        if USERS.findByEmail(email) is not None:
             Log.write(f"Failed to create account. the email already exist. email: {email}")
             return render_template(f'join.html', from_url=from_url, message="そのEmail addressは既に登録されています。")
         
@@ -948,10 +915,8 @@ def my_task_table(user_id, user_key):
     if not verified:
         return redirect(url_for('login'))
     
-    # 提出Taskテーブルを作成
-    table_html = CreateMyTaskTable(user_id)
-
-    return table_html
+    # 提出Taskテーブルを作成(1行ずつ送る)
+    return StreamTemplate('submit_table.html', table=CreateMyTaskTable(user_id))
 
 
 @app.route('/submit-table/<user_id>/<user_key>')
@@ -961,10 +926,8 @@ def submit_table(user_id, user_key):
     if not verified:
         return redirect(url_for('login'))
     
-    # 提出テーブルを作成
-    table_html = CreateSubmitTable(user_id)
-
-    return table_html
+    # 提出テーブルを作成(1行ずつ送る)
+    return StreamTemplate('submit_table.html', table=CreateSubmitTable(user_id))
 
 
 @app.route('/source/<task_id>/<filename>')
@@ -999,9 +962,15 @@ def verify(user_id, user_key):
     return "true" if verified else "false"
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # 評価側が出力した提出キューの状態を返す
+    return Intake.readMetrics()
+
+
 @app.route('/<task_id>/')
 def task_index(task_id):
-    if not task_id in TASK:
+    if TASKS.get(task_id) is None:
         return redirect(url_for('index'))
 
     return redirect(url_for('task', task_id=task_id))
@@ -1009,13 +978,50 @@ def task_index(task_id):
 
 @app.route('/<task_id>/timestamp', methods=['GET'])
 def get_timestamp(task_id):
-    try:
-        with open(os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "timestamp.txt"), "r", encoding='utf-8') as f:
-            timestamp = f.read()
-    except:
-        timestamp = ''
+    return ReadTimestamp(task_id)
 
-    return timestamp
+
+@app.route('/<task_id>/inproc', methods=['GET'])
+def get_inproc(task_id):
+    # 評価中と評価待ちの提出の表示(イベントが届いたときにブラウザ側で取り直す)
+    if TASKS.get(task_id) is None:
+        return "", 404
+    return CreateInProcHtml(task_id)
+
+
+@app.route('/<task_id>/events', methods=['GET'])
+def get_events(task_id):
+    # 評価の進み具合をServer-Sent Eventsで送る(ユーザIDとファイル名は送らず表示名に置き換える)
+    if TASKS.get(task_id) is None:
+        return "", 404
+
+    client = EVENTS.subscribe()
+    def stream():
+        try:
+            yield f"retry: {EVENTS_RETRY_MSEC}\n\n"
+            while True:
+                try:
+                    event = client.get(timeout=EVENTS_KEEPALIVE_SEC)
+                except queue.Empty:
+                    yield ": keepalive\n\n" # 切断を検知するため
+                    continue
+
+                if event.get("type") != Events.STATE and event.get("task_id") != task_id:
+                    continue
+                user = USERS.get(event.get("user_name"))
+                data = {"type": event.get("type"), "task_id": event.get("task_id"), "user": user.name if user is not None else ""}
+                for key in ["done", "total", "success"]:
+                    if key in event:
+                        data[key] = event[key]
+                if event.get("type") == Events.ITEM:
+                    data["job"] = JobKey(event.get("filename"))
+                    data["text"] = ProgressText(TASKS.get(task_id), event)
+                yield f"event: {data['type']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            EVENTS.unsubscribe(client)
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route('/<task_id>/card.png')
@@ -1025,14 +1031,14 @@ def get_taskcard(task_id):
 
 @app.route("/<task_id>/task")
 def task(task_id):
-    if not task_id in TASK:
+    if TASKS.get(task_id) is None:
         return redirect(url_for('index'))
 
     # ユーザ認証
     verified, user_data, admin = VerifyByCookie(request)
 
     # タスク情報を読み込む
-    task:Task = Task(task_id)
+    task:Task = TASKS.get(task_id)
 
     return render_template(f'tasks/{task_id}/index.html',
                            menu=menuHTML(Page.TASK, task_id, url_from=f"/{task_id}/task", admin=admin),
@@ -1040,49 +1046,92 @@ def task(task_id):
                            goal=Task.GoalText(task.metric, task.goal))
 
 
-@app.route("/<task_id>/board", methods=['GET'])
-def board(task_id):
-    if not task_id in TASK:
-        return redirect(url_for('index'))
+class BoardCache:
+    key: tuple
+    best_stats: dict # user_id -> 表示最優先の成績
+    sorted_stats_list: list
+    sorted_stats_list_in_contest: list
+    tables: dict # unlock -> (html_table, html_contest_result, num_col)
 
-    # ユーザ認証
-    verified, user_data, admin = VerifyByCookie(request)
-    
-    # タスク情報を読み込む
-    task:Task = Task(task_id)
+    def __init__(self, key) -> None:
+        self.key = key
+        self.best_stats = {}
+        self.sorted_stats_list = []
+        self.sorted_stats_list_in_contest = []
+        self.tables = {}
 
-    # ユーザ成績を読み込む
-    user_stats = GetUserStats(task_id)
 
-    # ユーザごとに表示最優先の成績を選択
-    best_stats_every_user = []
+def ReadTimestamp(task_id) -> str:
+    try:
+        with open(os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "timestamp.txt"), "r", encoding='utf-8') as f:
+            timestamp = f.read()
+    except:
+        timestamp = ''
+
+    return timestamp
+
+
+def BoardCacheKey(task:Task) -> tuple:
+    # 評価側のタイムスタンプ、ユーザ情報とタスク情報の更新時刻、コンテスト終了前後が同じなら表示も同じ
+    mtimes = []
+    for path in [USER_CSV_PATH, os.path.join(Task.TASKS_DIR, task.id, Task.FILENAME_TASK_JSON)]:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(0)
+    ended = datetime.datetime.now() >= task.end_date
+
+    return (ReadTimestamp(task.id), *mtimes, ended)
+
+
+def GetBoardCache(task:Task) -> BoardCache:
+    key = BoardCacheKey(task)
+    cache:BoardCache = BOARD_CACHE.get(task.id)
+    if cache is not None and cache.key == key:
+        return cache
+
+    cache = BoardCache(key)
+
+    # ユーザごとの表示最優先の成績
+    cache.best_stats = GetBestStatsEveryUser(task)
+    best_stats_every_user = list(cache.best_stats.values())
+
+    # コンテスト期間中の各ユーザベスト(コンテスト終了後のみ全成績を読み込む)
     best_stats_in_contest = []
-    my_stats = None
-    for user_name, stats in user_stats.items():
-        best_stats:Stats = Stats.GetBestStats(stats, task)
-        if best_stats is not None:
-            best_stats_every_user.append(best_stats)
-            if verified and best_stats.userid == user_data.id:
-                my_stats = best_stats
-
-        # コンテスト期間中の各ユーザベスト
-        if task.type == Task.TaskType.Contest and datetime.datetime.now() >= task.end_date:
-            stats_in_contest = []
-            for item in stats:
-                one_stats:Stats = item
-                if one_stats.datetime >= task.start_date and one_stats.datetime < task.end_date:
-                    stats_in_contest.append(one_stats)
+    if task.type == Task.TaskType.Contest and datetime.datetime.now() >= task.end_date:
+        user_stats = GetUserStats(task.id)
+        for user_id, stats in user_stats.items():
+            stats_in_contest = stats.between(task.start_date, task.end_date)
             best_stats:Stats = Stats.GetBestStats(stats_in_contest, task)
             if best_stats is not None:
                 best_stats_in_contest.append(best_stats)
 
     # 日付順にソート
-    sorted_stats_list = sorted(best_stats_every_user, key=lambda x: x.datetime, reverse=True)
+    cache.sorted_stats_list = sorted(best_stats_every_user, key=lambda x: x.datetime, reverse=True)
     
     # test成績順にソート
     if len(best_stats_in_contest) > 0:
-        sorted_stats_list_in_contest = sorted(best_stats_in_contest, key=lambda x: x.test, reverse=True)
- 
+        cache.sorted_stats_list_in_contest = sorted(best_stats_in_contest, key=lambda x: x.test, reverse=True)
+
+    BOARD_CACHE[task.id] = cache
+    return cache
+
+
+@app.route("/<task_id>/board", methods=['GET'])
+def board(task_id):
+    if TASKS.get(task_id) is None:
+        return redirect(url_for('index'))
+
+    # ユーザ認証
+    verified, user_data, admin = VerifyByCookie(request)
+    
+    # タスク情報を読み込む
+    task:Task = TASKS.get(task_id)
+
+    # 成績の集計結果(評価結果が更新されていなければ前回のものを使う)
+    cache = GetBoardCache(task)
+    my_stats = cache.best_stats.get(user_data.id) if verified else None
+
     # unlock判定
     unlock = False
     if verified and my_stats is not None:
@@ -1094,18 +1143,25 @@ def board(task_id):
             elif task.type == Task.TaskType.Contest and datetime.datetime.now() >= task.end_date: 
                 unlock = True
 
-    # 表を作成
-    html_table, num_col = CreateBoardTable(sorted_stats_list, task, unlock=unlock, test=True if task.type == Task.TaskType.Contest else False)
+    if not unlock in cache.tables:
+        # 表を作成
+        table = BoardTable(cache.sorted_stats_list, task, unlock=unlock, test=True if task.type == Task.TaskType.Contest else False, usage=True)
+        html_table, num_col = RenderBoardTable(table), table.num_col
 
-    # コンテスト終了時の成績表を作成
-    html_contest_result = None
-    if len(best_stats_in_contest) > 0:
-        html_contest_result, num_col = CreateBoardTable(sorted_stats_list_in_contest, task, unlock=unlock, test=True)
+        # コンテスト終了時の成績表を作成
+        html_contest_result = None
+        if len(cache.sorted_stats_list_in_contest) > 0:
+            table = BoardTable(cache.sorted_stats_list_in_contest, task, unlock=unlock, test=True, usage=True)
+            html_contest_result, num_col = RenderBoardTable(table), table.num_col
+
+        cache.tables[unlock] = (html_table, html_contest_result, num_col)
+
+    html_table, html_contest_result, num_col = cache.tables[unlock]
 
-    return render_template('board.html',
+    return StreamTemplate('board.html',
                            task_name=task.dispname(SETTING["name"]["contest"]),
-                           table_board=Markup(html_table),
-                           table_contest_result=Markup(html_contest_result) if html_contest_result is not None else None,
+                           table_board=html_table,
+                           table_contest_result=html_contest_result,
                            menu=menuHTML(Page.BOARD, task_id, url_from=f"/{task_id}/board", admin=admin),
                            inproc_text=Markup(CreateInProcHtml(task_id)),
                            goal=Task.GoalText(task.metric, task.goal),
@@ -1115,14 +1171,14 @@ def board(task_id):
 
 @app.route("/<task_id>/log")
 def log(task_id):
-    if not task_id in TASK:
+    if TASKS.get(task_id) is None:
         return redirect(url_for('index'))
     
     # ユーザ認証
     verified, user_data, admin = VerifyByCookie(request)
 
     # タスク情報を読み込む
-    task:Task = Task(task_id)
+    task:Task = TASKS.get(task_id)
 
     # ユーザ成績を読み込む
     user_stats = GetUserStats(task_id)
@@ -1142,25 +1198,25 @@ def log(task_id):
 
     sorted_stats_list = sorted(stats_list, key=lambda x: x.datetime, reverse=True)
 
-    # 表を作成
-    html_table, num_col = CreateBoardTable(sorted_stats_list, task, unlock=unlock, test=True if task.type == Task.TaskType.Contest else False)
+    # 表を作成(行は送りながら作る)
+    table = BoardTable(sorted_stats_list, task, unlock=unlock, test=True if task.type == Task.TaskType.Contest else False, usage=True)
 
-    return render_template('log.html',
+    return StreamTemplate('log.html',
                            task_name=task.dispname(SETTING["name"]["contest"]),
-                           table_log=Markup(html_table),
+                           table=table,
                            menu=menuHTML(Page.LOG, task_id, url_from=f"/{task_id}/log", admin=admin), 
                            inproc_text=Markup(CreateInProcHtml(task_id)), 
-                           num_col=num_col,
+                           num_col=table.num_col,
                            task_id=task_id,
                            goal=Task.GoalText(task.metric, task.goal))
 
 
 @app.route('/<task_id>/upload', methods=['GET', 'POST'])
 def upload_file(task_id):
-    if not task_id in TASK:
+    if TASKS.get(task_id) is None:
         return redirect(url_for('index'))
     
-    task:Task = TASK[task_id]
+    task:Task = TASKS.get(task_id)
     
     if task.suspend:
         return redirect(url_for('index'))
@@ -1193,13 +1249,17 @@ def upload_file(task_id):
 
                     if os.path.exists(save_dir):
                         new_filename = secure_filename(file.filename)
-                        file.save(os.path.join(save_dir, new_filename))
-                        msg = f'{file.filename}がアップロードされました。'
 
                         # メモを保存
                         if request.form['memo'] != "":
                             with open(os.path.join(save_dir, new_filename + '.txt'), mode='w', encoding='utf-8') as f:
                                 f.write(request.form['memo'])
+
+                        # 一時ファイルに書き終えてからリネームし、評価側が書き込み途中のファイルを拾わないようにする
+                        temp_path = os.path.join(save_dir, new_filename + UPLOADING_SUFFIX)
+                        file.save(temp_path)
+                        os.replace(temp_path, os.path.join(save_dir, new_filename))
+                        msg = f'{file.filename}がアップロードされました。'
                     else:
                         raise(ValueError("アップロード先のディレクトリが存在しません。"))
                 except:
@@ -1208,12 +1268,12 @@ def upload_file(task_id):
     # ユーザ認証
     verified, user_data, admin = VerifyByCookie(request)
 
-    return render_template('upload.html', task_id=task_id, task_name=task.name, message=msg, menu=menuHTML(Page.UPLOAD, task_id, url_from=f"/{task_id}/upload", admin=admin), url_from=f"/{task_id}/upload", time_limit=task.timelimit_per_data)
+    return render_template('upload.html', task_id=task_id, task_name=task.name, message=msg, menu=menuHTML(Page.UPLOAD, task_id, url_from=f"/{task_id}/upload", admin=admin), url_from=f"/{task_id}/upload", time_limit=task.timelimit_per_data, speed_text=SpeedText(task), inproc_text=Markup(CreateInProcHtml(task_id)))
   
 
 @app.route('/<task_id>/admin')
 def admin(task_id):
-    if not task_id in TASK:
+    if TASKS.get(task_id) is None:
         return redirect(url_for('index'))
     
     # ユーザ認証
@@ -1222,7 +1282,7 @@ def admin(task_id):
         return redirect(url_for('index'))
     
     # タスク情報を読み込む
-    task:Task = Task(task_id)
+    task:Task = TASKS.get(task_id)
 
     # ユーザ成績を読み込む
     user_stats = GetUserStats(task_id)
@@ -1234,16 +1294,16 @@ def admin(task_id):
             stats_list.append(item)
     sorted_stats_list = sorted(stats_list, key=lambda x: x.datetime, reverse=True)
 
-    # 表を作成
-    html_table, num_col = CreateBoardTable(sorted_stats_list, task, test=True, message=True, unlock=True)
+    # 表を作成(行は送りながら作る)
+    table = BoardTable(sorted_stats_list, task, test=True, message=True, unlock=True, usage=True)
 
-    return render_template('log.html',
+    return StreamTemplate('log.html',
                            task_id=task_id,
                            task_name=task.dispname(SETTING["name"]["contest"]),
-                           table_log=Markup(html_table),
+                           table=table,
                            menu=menuHTML(Page.ADMIN, task_id, url_from=f"/{task_id}/admin", admin=admin),
                            inproc_text=Markup(CreateInProcHtml(task_id)),
-                           num_col=num_col)
+                           num_col=table.num_col)
 
 @app.route('/admin', methods=['GET', 'POST'])
 def manage():
@@ -1252,40 +1312,65 @@ def manage():
     if not admin:
         return redirect(url_for('index'))
     
-    # タスク一覧の再読み込み
-    global TASK
-    TASK = Task.readTasks()
-
     # タスク情報の変更
     if request.method == 'POST':
         try:
             target_task_id = request.form["task-id"]
-            if not target_task_id in TASK:
+            if TASKS.get(target_task_id) is None:
                 raise(ValueError())
             
-            # タスク情報の書き換え
+            # タスク情報の書き換え(共有しているTaskは書き換えず、読み直したものを保存する)
             if target_task_id is not None:
-                task:Task = TASK[target_task_id]
+                task:Task = Task(target_task_id)
                 task.start_date = datetime.datetime.strptime(request.form["start-date"], '%Y-%m-%d')
                 task.end_date = datetime.datetime.strptime(request.form["end-date"], '%Y-%m-%d')
                 task.goal = float(request.form["goal"])
                 task.timelimit_per_data = float(request.form["timelimit-per-data"])
                 task.suspend = True if "suspend" in request.form else False
                 
-            # ファイル出力
+            # ファイル出力(タスク一覧は次に参照したときに読み直される)
             success = task.save()
             Log.write(f"{Task.FILENAME_TASK_JSON} of {target_task_id} {'was uplooaded.' if success else 'cannot be uploaded.'}")
 
-            # タスク一覧の再読み込み
-            TASK = Task.readTasks()
-
         except:
             print("Task情報の書き換えに失敗")
    
-    return render_template('admin.html',
-                           user_table=Markup(CreateUserTable()),
-                           task_table=Markup(CreateTaskTable(TASK)),
-                           log_table=Markup(Log.createTable()))
+    return StreamTemplate('admin.html',
+                           user_summaries=UserSummaries(),
+                           tasks=TASKS.all(),
+                           task_ids=list(TASKS.all().keys()))
+
+
+@app.route('/admin/log', methods=['GET'])
+def admin_log():
+    # ログを新しい順に少しずつ返す(管理者ページから呼ばれる)
+    verified, user_data, admin = VerifyByCookie(request)
+    if not admin:
+        return {"error": "forbidden"}, 403
+
+    try:
+        start_date = datetime.datetime.strptime(request.args["from"], '%Y-%m-%d').date() if request.args.get("from") else None
+        end_date = datetime.datetime.strptime(request.args["to"], '%Y-%m-%d').date() if request.args.get("to") else None
+        limit = min(max(int(request.args.get("limit", LOG_PAGE_SIZE)), 1), LOG_PAGE_SIZE_MAX)
+    except ValueError:
+        return {"error": "invalid parameter"}, 400
+
+    # 絞り込み: タスクIDと、ユーザ(ログにはIDで書かれるものとEmailで書かれるものがあるので両方で探す)
+    words = []
+    if request.args.get("task_id"):
+        words.append([request.args["task_id"]])
+    if request.args.get("user"):
+        user = request.args["user"]
+        candidates = [user]
+        target:UserData = USERS.get(user) or USERS.findByEmail(user)
+        if target is not None:
+            candidates += [target.id, target.email]
+        words.append(candidates)
+
+    try:
+        return Log.query(start_date, end_date, words, request.args.get("cursor"), limit)
+    except ValueError:
+        return {"error": "invalid cursor"}, 400
 
 
 if __name__ == "__main__":
@@ -1297,7 +1382,7 @@ if __name__ == "__main__":
         exit()
 
     # タスク一覧
-    TASK = Task.readTasks()
+    TASKS.all()
 
     # アプリ開始
     app.run(debug=False, host='0.0.0.0', port=5000)
@@ -0,0 +1,174 @@
+import os
+import glob
+import json
+import time
+import datetime
+import threading
+import queue
+from task import Task
+
+try:
+    # watchdogがあればOSのファイル変更通知(Linuxではinotify)で提出を検知する
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+UPLOAD_DIR_NAME = r"upload"
+
+
+class Submission:
+    task_id: str
+    user_name: str
+    path: str
+
+    def __init__(self, task_id, user_name, path) -> None:
+        self.task_id = task_id
+        self.user_name = user_name
+        self.path = path
+
+
+class _UploadEventHandler(FileSystemEventHandler):
+    def __init__(self, intake) -> None:
+        super().__init__()
+        self.intake = intake
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.intake.put(event.src_path)
+
+    def on_moved(self, event):
+        # アップロードは一時ファイルからのリネームで完了する
+        if not event.is_directory:
+            self.intake.put(event.dest_path)
+
+
+class Intake:
+    METRICS_JSON_PATH = r"./data/metrics.json"
+    POLL_INTERVAL_SEC = 1.0 # 変更通知が使えない場合の走査間隔
+    RESCAN_INTERVAL_SEC = 60.0 # 変更通知の取りこぼしに備えた走査間隔
+
+    def __init__(self) -> None:
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.observer = None
+        self.metrics = None
+
+    @staticmethod
+    def parsePath(path:str):
+        # tasks/<task_id>/upload/<user_name>/<file>.py の形式のみを提出とみなす
+        if not path.endswith(".py"):
+            return None
+        parts = os.path.relpath(path, Task.TASKS_DIR).split(os.sep)
+        if len(parts) != 4 or parts[1] != UPLOAD_DIR_NAME or parts[0].startswith(".."):
+            return None
+        return Submission(parts[0], parts[2], os.path.join(Task.TASKS_DIR, *parts))
+
+    def put(self, path:str) -> bool:
+        submission = Intake.parsePath(path)
+        if submission is None:
+            return False
+
+        with self.lock:
+            if submission.path in self.queued:
+                return False
+            self.queued.add(submission.path)
+        self.queue.put(submission)
+        return True
+
+    def get(self, timeout=None) -> Submission:
+        try:
+            submission:Submission = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if submission is None:
+            return None
+
+        # 取り出した後は再び検知できるようにする(移動に失敗したファイルを次の走査で拾うため)
+        with self.lock:
+            self.queued.discard(submission.path)
+        return submission
+
+    def wake(self):
+        # 提出が無くても待っているget()を返させる(評価の完了を知らせるため)
+        self.queue.put(None)
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def scan(self):
+        # 全ユーザのアップロードディレクトリを走査し、古い順に登録する
+        paths = glob.glob(os.path.join(Task.TASKS_DIR, '*', UPLOAD_DIR_NAME, '*', '*.py'))
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                continue
+        for path in sorted(mtimes, key=lambda x: mtimes[x]):
+            self.put(path)
+
+    def start(self):
+        # 起動前にアップロードされていたファイルを拾う
+        self.scan()
+
+        interval = Intake.POLL_INTERVAL_SEC
+        if Observer is not None:
+            try:
+                self.observer = Observer()
+                self.observer.schedule(_UploadEventHandler(self), Task.TASKS_DIR, recursive=True)
+                self.observer.start()
+                interval = Intake.RESCAN_INTERVAL_SEC
+                print("intake: watching upload directories")
+            except Exception as e:
+                print(f"ファイル変更通知を使えないため定期走査に切り替えます: {e}")
+                self.observer = None
+        else:
+            print("intake: polling upload directories")
+
+        thread = threading.Thread(target=self._scanLoop, args=(interval,), daemon=True)
+        thread.start()
+
+    def _scanLoop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.scan()
+            except Exception as e:
+                print(f"scan: {e}")
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+    def writeMetrics(self, num_in_evaluation:int, num_pending:int=0):
+        metrics = {
+            "queue_depth": self.depth() + num_pending,
+            "in_evaluation": num_in_evaluation,
+        }
+        if metrics == self.metrics:
+            return
+        self.metrics = metrics
+
+        try:
+            if not os.path.exists(os.path.dirname(Intake.METRICS_JSON_PATH)):
+                os.makedirs(os.path.dirname(Intake.METRICS_JSON_PATH))
+            temp_path = Intake.METRICS_JSON_PATH + ".tmp"
+            with open(temp_path, "w", encoding='utf-8') as f:
+                json.dump(dict(metrics, updated=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')), f)
+            os.replace(temp_path, Intake.METRICS_JSON_PATH)
+        except Exception as e:
+            print(f"metrics: {e}")
+
+    @staticmethod
+    def readMetrics() -> dict:
+        try:
+            with open(Intake.METRICS_JSON_PATH, encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return {}
@@ -0,0 +1,166 @@
+from abc import ABC, abstractmethod
+from enum import Enum
+import numpy as np
+
+
+class Metric(ABC):
+    # 評価指標: 正解値と推定値の配列からまとめて計算する(データごとのループは書かない)
+    # scoreとdetailを実装していないクラスは、Metrics.registerで登録するときにTypeErrorになる
+    name = "" # task.jsonのmetricに書く名前
+    label = "" # 画面に出す名前
+    higher_is_better = True
+    percent = False # 百分率で表示する
+    columns = ["score"] # 集計の列名(最後の列が評価値)
+    detail_column = "" # 詳細(データごとの値)の列名
+
+    @abstractmethod
+    def score(self, correct:np.ndarray, answer:np.ndarray) -> float:
+        pass
+
+    @abstractmethod
+    def detail(self, correct:np.ndarray, answer:np.ndarray) -> np.ndarray:
+        pass
+
+    def summary(self, correct:np.ndarray, answer:np.ndarray) -> list:
+        # 集計の列の値(データが無ければ評価値はNone)
+        return [self.score(correct, answer) if len(correct) > 0 else None]
+
+    def breakdown(self, correct:np.ndarray, answer:np.ndarray):
+        # クラスごとの内訳 (列名のリスト, 行のリスト)。内訳の無い評価指標はNone
+        return None
+
+    def achieve(self, value:float, goal:float) -> bool:
+        return value >= goal if self.higher_is_better else value <= goal
+
+    def sign(self) -> int:
+        # 高い方がよい値となるようにかける値
+        return 1 if self.higher_is_better else -1
+
+
+class Metrics:
+    # 評価指標の登録先(Task.Metricの名前で引く)
+    _metrics = {}
+
+    @staticmethod
+    def register(metric_class):
+        Metrics._metrics[metric_class.name] = metric_class()
+        return metric_class
+
+    @staticmethod
+    def get(metric) -> Metric:
+        return Metrics._metrics.get(metric.name if isinstance(metric, Enum) else metric)
+
+    @staticmethod
+    def names() -> list:
+        return list(Metrics._metrics.keys())
+
+
+def _classes(correct:np.ndarray, answer:np.ndarray):
+    # 正解値と推定値に現れるクラスと、クラスごとの正解数・正解値の数・推定値の数
+    classes, index = np.unique(np.concatenate([correct, answer]), return_inverse=True)
+    index = index.reshape(-1)
+    correct_index = index[:len(correct)]
+    answer_index = index[len(correct):]
+    num_classes = len(classes)
+    num_true = np.bincount(correct_index[correct_index == answer_index], minlength=num_classes)
+    num_correct = np.bincount(correct_index, minlength=num_classes)
+    num_answer = np.bincount(answer_index, minlength=num_classes)
+    return classes, num_true, num_correct, num_answer
+
+
+def _ratio(numerator:np.ndarray, denominator:np.ndarray) -> np.ndarray:
+    # 分母が0のところは0
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator), float), where=denominator > 0)
+
+
+@Metrics.register
+class Accuracy(Metric):
+    name = "Accuracy"
+    label = "正解率"
+    percent = True
+    columns = ["true", "false", "accuracy"]
+    detail_column = "check"
+
+    def score(self, correct, answer):
+        return float(np.count_nonzero(correct == answer) / len(correct))
+
+    def detail(self, correct, answer):
+        return (correct == answer).astype(int)
+
+    def summary(self, correct, answer):
+        num_true = int(np.count_nonzero(correct == answer))
+        return [num_true, len(correct) - num_true, num_true / len(correct) if len(correct) > 0 else None]
+
+
+@Metrics.register
+class MAE(Metric):
+    name = "MAE"
+    label = "平均絶対誤差"
+    higher_is_better = False
+    columns = ["MAE"]
+    detail_column = "abs_error"
+
+    def score(self, correct, answer):
+        return float(np.mean(np.abs(answer - correct)))
+
+    def detail(self, correct, answer):
+        return np.abs(answer - correct)
+
+
+@Metrics.register
+class RMSE(Metric):
+    name = "RMSE"
+    label = "二乗平均平方根誤差"
+    higher_is_better = False
+    columns = ["RMSE"]
+    detail_column = "sq_error"
+
+    def score(self, correct, answer):
+        return float(np.sqrt(np.mean(np.square(answer - correct, dtype=float))))
+
+    def detail(self, correct, answer):
+        return np.square(answer - correct)
+
+
+@Metrics.register
+class F1(Metric):
+    # クラスごとのF1値の平均(マクロ平均)
+    name = "F1"
+    label = "F1値(マクロ平均)"
+    columns = ["F1"]
+    detail_column = "check"
+
+    def score(self, correct, answer):
+        classes, num_true, num_correct, num_answer = _classes(correct, answer)
+        return float(np.mean(_ratio(2 * num_true, num_correct + num_answer)))
+
+    def detail(self, correct, answer):
+        return (correct == answer).astype(int)
+
+    def breakdown(self, correct, answer):
+        classes, num_true, num_correct, num_answer = _classes(correct, answer)
+        rows = zip(classes.tolist(), num_correct.tolist(), _ratio(num_true, num_answer).tolist(), _ratio(num_true, num_correct).tolist(), _ratio(2 * num_true, num_correct + num_answer).tolist())
+        return ["class", "num_data", "precision", "recall", "f1"], list(rows)
+
+
+@Metrics.register
+class ClassAccuracy(Metric):
+    # クラスごとの正解率の平均(正解値に現れるクラスで平均する)
+    name = "ClassAccuracy"
+    label = "クラス別正解率の平均"
+    percent = True
+    columns = ["class_accuracy"]
+    detail_column = "check"
+
+    def score(self, correct, answer):
+        classes, num_true, num_correct, num_answer = _classes(correct, answer)
+        return float(np.mean(num_true[num_correct > 0] / num_correct[num_correct > 0]))
+
+    def detail(self, correct, answer):
+        return (correct == answer).astype(int)
+
+    def breakdown(self, correct, answer):
+        classes, num_true, num_correct, num_answer = _classes(correct, answer)
+        present = num_correct > 0
+        rows = zip(classes[present].tolist(), num_correct[present].tolist(), num_true[present].tolist(), (num_true[present] / num_correct[present]).tolist())
+        return ["class", "num_data", "true", "accuracy"], list(rows)
@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+import glob
+import sqlite3
+import datetime
+import threading
+from task import Task, Stats, StatsTable, StatsCsv
+
+
+OUTPUT_DIR_NAME = r"output"
+
+
+class ResultsStore:
+    DB_PATH = r"./data/results.db"
+    TIMEOUT_SEC = 30.0
+    USAGE_COLUMNS = ["proc_p50_ms", "proc_p95_ms", "proc_max_ms", "cpu_sec", "peak_rss_mb"]
+    # _record()で読む列
+    RECORD_COLUMNS = "datetime, filename, train, valid, test, message, memo, " + ", ".join(USAGE_COLUMNS)
+
+    _local = threading.local()
+
+    @staticmethod
+    def connect() -> sqlite3.Connection:
+        # スレッド(とプロセス)ごとに接続を持つ
+        conn = getattr(ResultsStore._local, "conn", None)
+        if conn is not None and ResultsStore._local.pid == os.getpid():
+            return conn
+
+        if not os.path.exists(os.path.dirname(ResultsStore.DB_PATH)):
+            os.makedirs(os.path.dirname(ResultsStore.DB_PATH))
+
+        conn = sqlite3.connect(ResultsStore.DB_PATH, timeout=ResultsStore.TIMEOUT_SEC, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                datetime TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                train REAL NOT NULL,
+                valid REAL NOT NULL,
+                test REAL NOT NULL,
+                message TEXT NOT NULL,
+                memo TEXT NOT NULL
+            )""")
+        # 処理時間とメモリ(後から追加した列なので、無ければ追加する)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(results)")]
+        for column in ResultsStore.USAGE_COLUMNS:
+            if not column in columns:
+                conn.execute(f"ALTER TABLE results ADD COLUMN {column} REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_task_user_datetime ON results (task_id, user_id, datetime)")
+        # CSVからの取り込みが済んだタスク
+        conn.execute("CREATE TABLE IF NOT EXISTS imported (task_id TEXT PRIMARY KEY, datetime TEXT NOT NULL)")
+        # 1つの提出は1行だけ(CSVからの取り込みと評価直後の記録が重なっても二重にしない)
+        try:
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS results_unique ON results (task_id, user_id, datetime, filename)")
+        except sqlite3.IntegrityError:
+            # すでに二重になっている行を消し、そのタスクはCSVから取り込み直させる(bestも作り直される)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM imported WHERE task_id IN (SELECT task_id FROM results GROUP BY task_id, user_id, datetime, filename HAVING COUNT(*) > 1)")
+                conn.execute("DELETE FROM results WHERE id NOT IN (SELECT MIN(id) FROM results GROUP BY task_id, user_id, datetime, filename)")
+                conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS results_unique ON results (task_id, user_id, datetime, filename)")
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        # ユーザごとの表示最優先の成績(with_test: testの成績も使って選んだか、goal: 選んだときの目標値)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS best (
+                task_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                with_test INTEGER NOT NULL,
+                result_id INTEGER NOT NULL,
+                goal REAL NOT NULL,
+                PRIMARY KEY (task_id, user_id, with_test)
+            )""")
+        # 選んだときの比べ方(目標値と速度の設定)。変わっていたら選び直す
+        if not "rule" in [row[1] for row in conn.execute("PRAGMA table_info(best)")]:
+            conn.execute("ALTER TABLE best ADD COLUMN rule TEXT")
+
+        ResultsStore._local.conn = conn
+        ResultsStore._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def isImported(conn:sqlite3.Connection, task_id) -> bool:
+        return conn.execute("SELECT 1 FROM imported WHERE task_id = ?", (task_id,)).fetchone() is not None
+
+    @staticmethod
+    def importCsv(task:Task, force:bool=False) -> int:
+        # output/user/*.csv の成績をDBに取り込む(取り込み済みのタスクは何もしない)
+        conn = ResultsStore.connect()
+        if not force and ResultsStore.isImported(conn, task.id):
+            return 0
+
+        num_rows = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if force or not ResultsStore.isImported(conn, task.id):
+                conn.execute("DELETE FROM results WHERE task_id = ?", (task.id,))
+                file_paths = glob.glob(os.path.join(Task.TASKS_DIR, task.id, OUTPUT_DIR_NAME, "user", "*.csv"))
+                for file_path in file_paths:
+                    user_id = os.path.splitext(os.path.basename(file_path))[0]
+                    with open(file_path, "r", encoding='utf-8') as csv_file:
+                        lines = csv_file.read().split("\n")[1:] # ヘッダ読み飛ばし
+                    if len(lines) > 0 and lines[-1] == "":
+                        lines.pop()
+                    for stats in StatsCsv.parse(lines, '', task.metric, task.goal, user_id):
+                        ResultsStore._insert(conn, task.id, user_id, stats.datetime, stats.filename,
+                                             stats.train, stats.valid, stats.test, stats.message, stats.memo, stats.usage())
+                        num_rows += 1
+                ResultsStore._rebuildBest(conn, task)
+                conn.execute("INSERT OR REPLACE INTO imported (task_id, datetime) VALUES (?, ?)",
+                             (task.id, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+        return num_rows
+
+    @staticmethod
+    def _insert(conn:sqlite3.Connection, task_id, user_id, submit_datetime:datetime.datetime, filename, train, valid, test, message, memo, usage:list=None) -> int:
+        if usage is None:
+            usage = [None] * len(ResultsStore.USAGE_COLUMNS)
+        key = (task_id, user_id, submit_datetime.strftime('%Y-%m-%d %H:%M:%S'), filename)
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO results (task_id, user_id, datetime, filename, train, valid, test, message, memo, " + ", ".join(ResultsStore.USAGE_COLUMNS) + ") "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (*key, train, valid, test, str(message), str(memo), *usage))
+        if cursor.rowcount == 0:
+            # 記録済みの提出(CSVから先に取り込まれていた)なら、その行を返す
+            return conn.execute("SELECT id FROM results WHERE task_id = ? AND user_id = ? AND datetime = ? AND filename = ?", key).fetchone()[0]
+        return cursor.lastrowid
+
+    @staticmethod
+    def _record(task:Task, row) -> Stats:
+        # RECORD_COLUMNS の行からstatsを作る(表示名は呼び出し側で設定する)
+        submit_datetime, filename, train, valid, test, message, memo = row[:7]
+        return Stats.FromRecord('', task.metric, task.goal, None,
+                                datetime.datetime.fromisoformat(submit_datetime), filename, train, valid, test, message, memo, list(row[7:]))
+
+    @staticmethod
+    def _table(task:Task, user_name, user_id, rows:list) -> StatsTable:
+        # RECORD_COLUMNS の行をまとめて列にする(日時もまとめて変換する)
+        columns = list(zip(*rows))
+        return StatsTable(user_name, task.metric, task.goal, user_id,
+                          list(columns[0]), list(columns[1]), columns[2], columns[3], columns[4],
+                          list(columns[5]), list(columns[6]), list(zip(*columns[7:])))
+
+    @staticmethod
+    def bestRule(task:Task) -> str:
+        return json.dumps([task.goal, Stats.Speed(task)])
+
+    @staticmethod
+    def _rebuildBest(conn:sqlite3.Connection, task:Task):
+        # タスクの全成績を提出順に1回走査して、ユーザごとの表示最優先の成績を選び直す
+        conn.execute("DELETE FROM best WHERE task_id = ?", (task.id,))
+        cursor = conn.execute(
+            "SELECT id, user_id, " + ResultsStore.RECORD_COLUMNS + " FROM results WHERE task_id = ? ORDER BY id",
+            (task.id,))
+
+        speed = Stats.Speed(task)
+        best = {} # (user_id, with_test) -> (key, result_id)
+        for row in cursor:
+            stats = ResultsStore._record(task, row[2:])
+            if not Stats.IsValid(stats):
+                continue
+            for with_test in (True, False):
+                key = Stats.BestKey(stats, with_test, speed)
+                current = best.get((row[1], with_test))
+                if current is None or key >= current[0]:
+                    best[(row[1], with_test)] = (key, row[0])
+
+        rule = ResultsStore.bestRule(task)
+        conn.executemany(
+            "INSERT INTO best (task_id, user_id, with_test, result_id, goal, rule) VALUES (?, ?, ?, ?, ?, ?)",
+            [(task.id, user_id, int(with_test), result_id, task.goal, rule) for (user_id, with_test), (key, result_id) in best.items()])
+
+    @staticmethod
+    def _updateBest(conn:sqlite3.Connection, task:Task, user_id, result_id, stats:Stats):
+        # 追加した成績と現在の表示最優先の成績だけを比べる(同じキーなら新しい成績を優先)
+        if not Stats.IsValid(stats):
+            return
+        rule = ResultsStore.bestRule(task)
+        speed = Stats.Speed(task)
+        for with_test in (True, False):
+            row = conn.execute(
+                "SELECT b.rule, r." + ResultsStore.RECORD_COLUMNS.replace(", ", ", r.") + " FROM best b JOIN results r ON r.id = b.result_id "
+                "WHERE b.task_id = ? AND b.user_id = ? AND b.with_test = ?",
+                (task.id, user_id, int(with_test))).fetchone()
+            if row is not None and row[0] != rule:
+                # 目標値か速度の設定が変わっていたら選び直す
+                ResultsStore._rebuildBest(conn, task)
+                return
+            if row is None or Stats.BestKey(stats, with_test, speed) >= Stats.BestKey(ResultsStore._record(task, row[1:]), with_test, speed):
+                conn.execute(
+                    "INSERT OR REPLACE INTO best (task_id, user_id, with_test, result_id, goal, rule) VALUES (?, ?, ?, ?, ?, ?)",
+                    (task.id, user_id, int(with_test), result_id, task.goal, rule))
+
+    @staticmethod
+    def add(task:Task, user_id, submit_datetime:datetime.datetime, filename, values:dict, message='', memo='', usage:list=None):
+        # 1件の評価結果を記録する。valuesはDataTypeごとの評価値(評価できなかったものは-1)、usageは処理時間とメモリ(USAGE_COLUMNSの順)
+        conn = ResultsStore.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result_id = ResultsStore._insert(conn, task.id, user_id, submit_datetime, filename,
+                                             values[Task.DataType.train], values[Task.DataType.valid], values[Task.DataType.test], message, memo, usage)
+            stats = Stats.FromRecord('', task.metric, task.goal, user_id, submit_datetime, filename,
+                                     values[Task.DataType.train], values[Task.DataType.valid], values[Task.DataType.test], message, memo, usage)
+            ResultsStore._updateBest(conn, task, user_id, result_id, stats)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def invalidate(task_id):
+        # DBがCSVと食い違った可能性があるので、次回の読み込みでCSVから取り込み直させる
+        try:
+            conn = ResultsStore.connect()
+            conn.execute("DELETE FROM imported WHERE task_id = ?", (task_id,))
+        except Exception as e:
+            print(f"ResultsStore.invalidate: {e}")
+
+    @staticmethod
+    def userStats(task:Task, user_names:dict, user_id=None) -> dict:
+        # user_names(user_id -> 表示名)に含まれるユーザの成績を提出順の表(StatsTable)で返す(user_idを指定したらそのユーザだけ)
+        ResultsStore.importCsv(task)
+
+        conn = ResultsStore.connect()
+        if user_id is None:
+            cursor = conn.execute(
+                "SELECT user_id, " + ResultsStore.RECORD_COLUMNS + " FROM results WHERE task_id = ? ORDER BY user_id, id",
+                (task.id,))
+        else:
+            cursor = conn.execute(
+                "SELECT user_id, " + ResultsStore.RECORD_COLUMNS + " FROM results WHERE task_id = ? AND user_id = ? ORDER BY id",
+                (task.id, user_id))
+
+        rows = {}
+        for row in cursor:
+            user_id = row[0]
+            if not user_id in user_names:
+                continue
+            if not user_id in rows:
+                rows[user_id] = []
+            rows[user_id].append(row[1:])
+
+        return {user_id: ResultsStore._table(task, user_names[user_id], user_id, user_rows) for user_id, user_rows in rows.items()}
+
+    @staticmethod
+    def summary(task:Task) -> dict:
+        # ユーザごとの提出数と最新の提出日時: user_id -> (提出数, 最新の提出日時)
+        ResultsStore.importCsv(task)
+
+        conn = ResultsStore.connect()
+        cursor = conn.execute(
+            "SELECT user_id, COUNT(*), MAX(datetime) FROM results WHERE task_id = ? GROUP BY user_id",
+            (task.id,))
+        return {user_id: (num_submit, datetime.datetime.fromisoformat(latest)) for user_id, num_submit, latest in cursor}
+
+    @staticmethod
+    def bestStats(task:Task, user_names:dict, with_test:bool) -> dict:
+        # user_names(user_id -> 表示名)に含まれるユーザの表示最優先の成績を返す(成績のないユーザは含まない)
+        ResultsStore.importCsv(task)
+
+        conn = ResultsStore.connect()
+        stale = conn.execute("SELECT 1 FROM best WHERE task_id = ? AND (rule IS NULL OR rule != ?) LIMIT 1",
+                             (task.id, ResultsStore.bestRule(task))).fetchone() is not None
+        if not stale:
+            # 選び直しが必要なのは、目標値か速度の設定が変わった場合と、表示最優先の成績を記録する前に取り込んだDBの場合
+            stale = conn.execute("SELECT 1 FROM best WHERE task_id = ? LIMIT 1", (task.id,)).fetchone() is None and \
+                    conn.execute("SELECT 1 FROM results WHERE task_id = ? LIMIT 1", (task.id,)).fetchone() is not None
+        if stale:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ResultsStore._rebuildBest(conn, task)
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+
+        cursor = conn.execute(
+            "SELECT r.user_id, r." + ResultsStore.RECORD_COLUMNS.replace(", ", ", r.") + " FROM best b JOIN results r ON r.id = b.result_id "
+            "WHERE b.task_id = ? AND b.with_test = ? ORDER BY b.user_id",
+            (task.id, int(with_test)))
+
+        best_stats = {}
+        for row in cursor:
+            user_id = row[0]
+            if not user_id in user_names:
+                continue
+            stats = ResultsStore._record(task, row[1:])
+            stats.username = user_names[user_id]
+            stats.userid = user_id
+            best_stats[user_id] = stats
+
+        return best_stats
+
+
+if __name__ == "__main__":
+    # 既存のCSVを取り込む: python results_store.py import [task_id ...]
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("usage: python results_store.py import [task_id ...]")
+        exit()
+
+    task_ids = sys.argv[2:] if len(sys.argv) > 2 else Task.readTasks().keys()
+    for task_id in task_ids:
+        num_rows = ResultsStore.importCsv(Task(task_id), force=True)
+        print(f"imported: {task_id} ({num_rows})")
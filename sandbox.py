@@ -0,0 +1,226 @@
+import sys
+import gc
+import time
+import importlib
+import multiprocessing
+from multiprocessing import TimeoutError
+try:
+    import resource
+except ImportError:
+    # Windowsなどではresourceモジュールが無い
+    resource = None
+
+
+# サンドボックスの起動時に読み込んでおくライブラリ(ユーザ処理がよく使うもの)
+PRELOAD_MODULES = ["numpy", "PIL.Image", "cv2"]
+
+
+def _send_error(conn, e:Exception):
+    try:
+        conn.send(("error", e))
+    except Exception:
+        # pickleできない例外はメッセージだけ返す
+        conn.send(("error", RuntimeError(str(e))))
+
+
+def _reset_peak_rss():
+    # Linuxでは/proc/self/clear_refsに5を書くとピークRSS(VmHWM)を現在のRSSに戻せる
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    # ピークRSS(バイト)。戻せない環境ではプロセス起動からのピーク、取得できなければNone
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+    return None
+
+
+def _sandbox_main(conn):
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+
+    func_recognition = None
+    func_recognition_batch = None
+
+    while True:
+        try:
+            command, arg = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        if command == "load":
+            # 1つのプロセスで読み込む提出は1つだけ(提出を入れ替えるときはプロセスごと起動し直す)
+            if func_recognition is not None or func_recognition_batch is not None:
+                conn.send(("error", RuntimeError("別の提出を読み込んだサンドボックスです。")))
+                continue
+
+            # 提出ごとのピークRSSを測るため、読み込む前に戻しておく
+            gc.collect()
+            _reset_peak_rss()
+
+            try:
+                importlib.invalidate_caches()
+                user_module = importlib.import_module(arg)
+            except Exception as e:
+                conn.send(("error", ValueError("モジュールを読み込めません。")))
+                continue
+
+            # recognition_batch()があればまとめて推定に使う(recognition()は無くてもよい)
+            func_recognition = getattr(user_module, "recognition", None)
+            func_recognition_batch = getattr(user_module, "recognition_batch", None)
+            if not callable(func_recognition) and not callable(func_recognition_batch):
+                conn.send(("error", ValueError("関数recognition()を読み込めません。")))
+                continue
+
+            conn.send(("ok", callable(func_recognition_batch)))
+
+        elif command == "call":
+            # 処理時間はデータの受け渡しを含めず、関数の実行だけを測る
+            try:
+                wall_time, cpu_time = time.perf_counter(), time.process_time()
+                answer = func_recognition(arg)
+                wall_time, cpu_time = time.perf_counter() - wall_time, time.process_time() - cpu_time
+            except Exception as e:
+                _send_error(conn, e)
+                continue
+
+            try:
+                conn.send(("ok", (answer, wall_time, cpu_time)))
+            except Exception as e:
+                _send_error(conn, e)
+
+        elif command == "call_batch":
+            try:
+                wall_time, cpu_time = time.perf_counter(), time.process_time()
+                answers = list(func_recognition_batch(arg))
+                wall_time, cpu_time = time.perf_counter() - wall_time, time.process_time() - cpu_time
+            except Exception as e:
+                _send_error(conn, e)
+                continue
+
+            try:
+                conn.send(("ok", (answers, wall_time, cpu_time)))
+            except Exception as e:
+                _send_error(conn, e)
+
+        elif command == "peak_rss":
+            conn.send(("ok", _peak_rss()))
+
+        elif command == "exit":
+            break
+
+
+class Sandbox:
+    # ユーザ処理を実行するプロセス。ライブラリを読み込んだ状態で待たせておき、提出1つの評価に使う
+    # 提出がライブラリやグローバル変数を書き換えたり、スレッドやモジュールを残したりしても次の提出に持ち越さないよう、
+    # 評価を終えたら(タイムアウト時も)強制終了して起動し直す。起動し直したプロセスは次の提出までにライブラリを読み込んでおく
+    process: multiprocessing.Process = None
+    conn = None
+    loaded: bool = False # 提出のモジュールを読み込ませたか(読み込みに失敗した場合も含む)
+    batch: bool = False # 読み込んだモジュールがrecognition_batch()を持つか
+    wall_time: float = 0 # 直前の呼び出しの処理時間(秒)
+    cpu_time: float = 0 # 直前の呼び出しのCPU時間(秒)
+
+    def __init__(self, start:bool=True) -> None:
+        if start:
+            self.start()
+
+    def start(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_sandbox_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.loaded = False
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def kill(self):
+        if self.process is not None:
+            try:
+                self.process.kill()
+                self.process.join()
+            except Exception:
+                pass
+        if self.conn is not None:
+            self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def close(self):
+        if self.alive():
+            try:
+                self.conn.send(("exit", None))
+                self.process.join(timeout=1)
+            except Exception:
+                pass
+        self.kill()
+
+    def request(self, command, arg=None, timeout=None):
+        if not self.alive():
+            self.restart()
+
+        self.conn.send((command, arg))
+        if not self.conn.poll(timeout):
+            # 処理が返ってこないので強制終了し、次の提出に備えて起動し直す
+            self.restart()
+            raise(TimeoutError("推定処理がタイムアウトしました。"))
+
+        try:
+            status, value = self.conn.recv()
+        except (EOFError, OSError):
+            self.restart()
+            raise(RuntimeError("推定処理のプロセスが異常終了しました。"))
+
+        if status == "error":
+            raise(value)
+
+        return value
+
+    def load(self, module_name, timeout=None):
+        # 前の提出を読み込んだプロセスは使わない(unloadを通らなかった場合に備える)
+        if self.loaded:
+            self.restart()
+        self.batch = False
+        self.loaded = True
+        self.batch = self.request("load", module_name, timeout)
+        return self.batch
+
+    def unload(self, timeout=None):
+        # 提出を読み込んだプロセスは破棄し、次の提出のために起動し直す
+        self.batch = False
+        if self.loaded:
+            self.restart()
+
+    def recognition(self, input_data, timeout=None):
+        answer, self.wall_time, self.cpu_time = self.request("call", input_data, timeout)
+        return answer
+
+    def recognitionBatch(self, input_data_list:list, timeout=None) -> list:
+        answers, self.wall_time, self.cpu_time = self.request("call_batch", input_data_list, timeout)
+        return answers
+
+    def peakRss(self, timeout=None):
+        # モジュールを読み込んでからのピークRSS(バイト)。取得できなければNone
+        return self.request("peak_rss", None, timeout)
@@ -0,0 +1,216 @@
+import os
+import json
+import heapq
+import datetime
+from collections import OrderedDict, deque
+from task import Task, TASKS
+from intake import Submission
+
+
+class Job:
+    submission: Submission
+    priority: int
+    received: datetime.datetime
+    started: datetime.datetime = None
+    future = None
+
+    def __init__(self, submission:Submission, priority:int, received:datetime.datetime) -> None:
+        self.submission = submission
+        self.priority = priority
+        self.received = received
+
+
+class Scheduler:
+    # 提出を評価に回す順番を決める
+    # 開催中のコンテストの提出を優先し、同じ優先度の中ではユーザごとに1件ずつ順番に評価する
+    SETTING_JSON_PATH = r"./data/setting.json"
+    STATUS_JSON_PATH = r"./data/queue.json"
+    WORKERS = 4 # 同時に評価する提出数
+    MAX_PENDING = 100 # 評価待ちにできる提出数
+    MAX_PENDING_PER_USER = 3 # 1ユーザが評価待ちにできる提出数
+    DURATION_SEC = 30.0 # 評価時間の実績が無いときの見込み
+    DURATION_WEIGHT = 0.3 # 評価時間の見込みに直近の実績を反映させる重み
+
+    PRIORITY_CONTEST = 0
+    PRIORITY_QUEST = 1
+
+    def __init__(self, workers=WORKERS, max_pending=MAX_PENDING, max_pending_per_user=MAX_PENDING_PER_USER) -> None:
+        self.workers = max(int(workers), 1)
+        self.max_pending = max(int(max_pending), 1)
+        self.max_pending_per_user = max(int(max_pending_per_user), 1)
+        self.queues = {} # priority -> OrderedDict(user_name -> deque[Job])
+        self.pending_paths = set()
+        self.pending_per_user = {}
+        self.running = []
+        self.duration_sec = Scheduler.DURATION_SEC
+        self.overflowed = False
+        self.status = None
+
+    @staticmethod
+    def readSetting() -> dict:
+        # data/setting.json の "evaluation" で設定を上書きできる
+        setting = {}
+        try:
+            with open(Scheduler.SETTING_JSON_PATH, encoding='utf-8') as f:
+                evaluation = json.load(f).get("evaluation", {})
+            for key in ["workers", "max_pending", "max_pending_per_user"]:
+                if key in evaluation:
+                    setting[key] = int(evaluation[key])
+        except Exception as e:
+            print(f"scheduler setting: {e}")
+        return setting
+
+    @staticmethod
+    def priority(task_id) -> int:
+        task = TASKS.get(task_id)
+        now = datetime.datetime.now()
+        try:
+            if task.type == Task.TaskType.Contest and task.start_date <= now < task.end_date:
+                return Scheduler.PRIORITY_CONTEST
+        except AttributeError:
+            pass
+        return Scheduler.PRIORITY_QUEST
+
+    def depth(self) -> int:
+        return len(self.pending_paths)
+
+    def put(self, submission:Submission) -> bool:
+        # 評価待ちに積む。上限を超えた提出はアップロード先に残し、空きができてから拾い直す
+        if submission.path in self.pending_paths:
+            return False
+        if self.depth() >= self.max_pending or self.pending_per_user.get(submission.user_name, 0) >= self.max_pending_per_user:
+            self.overflowed = True
+            return False
+
+        # 提出日時はアップロードが完了した時刻とする(評価待ちの間に締め切りを過ぎても期間内の提出として扱う)
+        try:
+            received = datetime.datetime.fromtimestamp(os.path.getmtime(submission.path))
+        except OSError:
+            return False
+
+        job = Job(submission, Scheduler.priority(submission.task_id), received)
+        queue = self.queues.setdefault(job.priority, OrderedDict())
+        queue.setdefault(submission.user_name, deque()).append(job)
+        self.pending_paths.add(submission.path)
+        self.pending_per_user[submission.user_name] = self.pending_per_user.get(submission.user_name, 0) + 1
+        self.status = None
+        return True
+
+    @staticmethod
+    def _pop(queues:dict) -> Job:
+        for priority in sorted(queues):
+            queue:OrderedDict = queues[priority]
+            if len(queue) == 0:
+                continue
+            # 先頭のユーザから1件取り出し、まだ残っていれば末尾に回す
+            user_name, jobs = queue.popitem(last=False)
+            job = jobs.popleft()
+            if len(jobs) > 0:
+                queue[user_name] = jobs
+            return job
+        return None
+
+    def next(self) -> Job:
+        # 空いたワーカーがあれば次に評価する提出を返す
+        if len(self.running) >= self.workers:
+            return None
+        job = Scheduler._pop(self.queues)
+        if job is None:
+            return None
+
+        self.pending_paths.discard(job.submission.path)
+        self.pending_per_user[job.submission.user_name] -= 1
+        if self.pending_per_user[job.submission.user_name] == 0:
+            self.pending_per_user.pop(job.submission.user_name)
+        self.status = None
+        return job
+
+    def start(self, job:Job, future):
+        job.started = datetime.datetime.now()
+        job.future = future
+        self.running.append(job)
+        self.status = None
+
+    def collect(self) -> int:
+        # 終わった評価を片付け、評価時間の見込みを更新する
+        finished = [job for job in self.running if job.future.done()]
+        for job in finished:
+            self.running.remove(job)
+            duration = (datetime.datetime.now() - job.started).total_seconds()
+            self.duration_sec += (duration - self.duration_sec) * Scheduler.DURATION_WEIGHT
+        if len(finished) > 0:
+            self.status = None
+        return len(finished)
+
+    def order(self) -> list:
+        # 評価待ちの提出を評価される順に並べる
+        queues = {priority: OrderedDict((user_name, deque(jobs)) for user_name, jobs in queue.items()) for priority, queue in self.queues.items()}
+        jobs = []
+        while True:
+            job = Scheduler._pop(queues)
+            if job is None:
+                return jobs
+            jobs.append(job)
+
+    def createStatus(self) -> dict:
+        now = datetime.datetime.now()
+
+        # 各ワーカーが空く時刻を見積もり、評価待ちの提出の開始予定を求める
+        free_at = []
+        for job in self.running:
+            elapsed = (now - job.started).total_seconds()
+            free_at.append(max(self.duration_sec - elapsed, 0))
+        free_at += [0] * max(self.workers - len(free_at), 0)
+        heapq.heapify(free_at)
+
+        pending = []
+        for position, job in enumerate(self.order()):
+            start_sec = heapq.heappop(free_at)
+            heapq.heappush(free_at, start_sec + self.duration_sec)
+            pending.append({
+                "task_id": job.submission.task_id,
+                "user_name": job.submission.user_name,
+                "filename": os.path.basename(job.submission.path),
+                "position": position + 1,
+                "eta": (now + datetime.timedelta(seconds=start_sec)).strftime('%Y-%m-%d %H:%M:%S'),
+            })
+
+        running = []
+        for job in self.running:
+            running.append({
+                "task_id": job.submission.task_id,
+                "user_name": job.submission.user_name,
+                "filename": os.path.basename(job.submission.path),
+                "started": job.started.strftime('%Y-%m-%d %H:%M:%S'),
+            })
+
+        return {
+            "updated": now.strftime('%Y-%m-%d %H:%M:%S'),
+            "workers": self.workers,
+            "running": running,
+            "pending": pending,
+        }
+
+    def writeStatus(self):
+        # 評価待ちか評価中の提出が変わったときだけ書き出す
+        if self.status is not None:
+            return
+        self.status = self.createStatus()
+
+        try:
+            if not os.path.exists(os.path.dirname(Scheduler.STATUS_JSON_PATH)):
+                os.makedirs(os.path.dirname(Scheduler.STATUS_JSON_PATH))
+            temp_path = Scheduler.STATUS_JSON_PATH + ".tmp"
+            with open(temp_path, "w", encoding='utf-8') as f:
+                json.dump(self.status, f, ensure_ascii=False)
+            os.replace(temp_path, Scheduler.STATUS_JSON_PATH)
+        except Exception as e:
+            print(f"queue status: {e}")
+
+    @staticmethod
+    def readStatus() -> dict:
+        try:
+            with open(Scheduler.STATUS_JSON_PATH, encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return {}
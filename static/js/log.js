@@ -0,0 +1,43 @@
+// 管理者ページのログを新しい順に少しずつ読み込む
+var log_filter = "";
+var log_cursor = null;
+var log_loading = false;
+
+function LoadLog(reset) {
+    if (log_loading) {
+        return;
+    }
+    if (reset) {
+        log_filter = $("#log-filter").serialize();
+        log_cursor = null;
+        $("#log-table-body").empty();
+    }
+
+    log_loading = true;
+    var url = "/admin/log?" + log_filter + (log_cursor != null ? "&cursor=" + encodeURIComponent(log_cursor) : "");
+    $.getJSON(url, function(data) {
+        var body = $("#log-table-body");
+        for (const line of data.lines) {
+            // ログの中身はそのまま文字列として表示する
+            var row = $("<tr>");
+            row.append($("<td>").text(line.datetime));
+            row.append($("<td>").text(line.log));
+            body.append(row);
+        }
+        log_cursor = data.next;
+        $("#log-more").toggle(log_cursor != null);
+    }).always(function() {
+        log_loading = false;
+    });
+}
+
+$(document).ready(function() {
+    $("#log-filter").on("submit", function(event) {
+        event.preventDefault();
+        LoadLog(true);
+    });
+    $("#log-more").on("click", function() {
+        LoadLog(false);
+    });
+    LoadLog(true);
+});
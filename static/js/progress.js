@@ -0,0 +1,37 @@
+// 評価中の提出の進み具合を書き換える(評価側から届くitemイベント)
+function ShowProgress(data) {
+    for (const element of document.querySelectorAll(".inproc-progress")) {
+        if (element.dataset.job == data.job) {
+            element.textContent = data.text;
+        }
+    }
+}
+
+// 評価中と評価待ちの表示を取り直す
+function ReloadInProc(task_id) {
+    var request = new XMLHttpRequest()
+    request.open("GET", "/" + task_id + "/inproc", true);
+    request.onreadystatechange = function() {
+        if (request.readyState == 4 && request.status == 200) {
+            document.getElementById("inproc").innerHTML = request.responseText;
+        }
+    }
+    request.send("");
+}
+
+// ページをリロードせずに評価中と評価待ちの表示だけを更新する
+function ListenProgress(task_id) {
+    if (!window.EventSource) {
+        return;
+    }
+
+    var source = new EventSource("/" + task_id + "/events");
+    source.addEventListener("item", function(event) {
+        ShowProgress(JSON.parse(event.data));
+    });
+    for (const type of ["queued", "started", "finished", "state"]) {
+        source.addEventListener(type, function() {
+            ReloadInProc(task_id);
+        });
+    }
+}
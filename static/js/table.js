@@ -57,7 +57,43 @@ $(function() {
 
 var check_box_auto_reload = document.getElementById("CheckBoxAutoReload")
 var current_timestamp = ""
+var event_source = null
 window.addEventListener('DOMContentLoaded', function(){
+    // 評価側から届くイベントで更新を知る(使えなければタイムスタンプを見に行く)
+    if (window.EventSource) {
+        ListenEvents();
+    } else {
+        PollTimestamp();
+    }
+});
+
+function ListenEvents() {
+    // 自動更新がONのときだけ接続する
+    if (!check_box_auto_reload.checked) {
+        return;
+    }
+
+    event_source = new EventSource("/" + task_id + "/events");
+    // 評価待ちに積まれた、評価が始まった、評価が終わった、評価側が再起動したときにリロード
+    for (const type of ["queued", "started", "finished", "state"]) {
+        event_source.addEventListener(type, function() {
+            location.reload();
+        });
+    }
+    // 評価の進み具合はリロードせずに書き換える
+    event_source.addEventListener("item", function(event) {
+        ShowProgress(JSON.parse(event.data));
+    });
+    event_source.onerror = function() {
+        // 再接続をあきらめた場合はタイムスタンプを見に行く
+        if (event_source.readyState == EventSource.CLOSED) {
+            event_source = null;
+            PollTimestamp();
+        }
+    };
+}
+
+function PollTimestamp() {
     // 1秒ごとに実行
     setInterval(() => {
         // 自動更新がONかチェック
@@ -84,7 +120,7 @@ window.addEventListener('DOMContentLoaded', function(){
         }
         request.send("");
     }, 1000);
-});
+}
 
 
 // 自動更新をONにしたときには一度強制リロード
@@ -96,6 +132,10 @@ function checkBoxClick() {
         location.reload();
     } else {
         localStorage.setItem(key_check_box_auto_reload, "0");
+        if (event_source != null) {
+            event_source.close();
+            event_source = null;
+        }
     }
 }
 
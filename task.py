@@ -3,10 +3,21 @@ import os
 import datetime
 from enum import Enum
 import json
-from functools import cmp_to_key
 from flask import Markup
 import glob
 import shutil
+import threading
+import queue
+import time
+import sys
+import atexit
+import array
+import re
+import csv
+import io
+import itertools
+import numpy as np
+from metrics import Metrics
 
 
 class Task:
@@ -24,8 +35,12 @@ class Task:
         test = 3
 
     class Metric(Enum):
+        # 名前はMetricsに登録した評価指標と揃える
         Accuracy = 1
         MAE = 2
+        RMSE = 3
+        F1 = 4
+        ClassAccuracy = 5
 
     class InputDataType(Enum):
         Image1ch = 1
@@ -48,6 +63,10 @@ class Task:
     type: TaskType = TaskType.Quest
     goal = 0
     timelimit_per_data: float = 1.0
+    batch_size: int = 16 # recognition_batch()に一度に渡すデータ数
+    parallel: int = 1 # 1つの提出の評価に同時に使うサンドボックス数(1なら順に評価)
+    speed_objective: str = None # 速度も競う場合に使う処理時間("p50", "p95", "max")
+    speed_weight: float = 0.0 # 処理時間1msあたりに評価値から差し引く値
     suspend: bool = False
 
     def __init__(self, task_id) -> None:
@@ -75,6 +94,14 @@ class Task:
                 self.goal = float(task["goal"])
             if "timelimit_per_data" in task:
                 self.timelimit_per_data = float(task["timelimit_per_data"])
+            if "batch_size" in task:
+                self.batch_size = max(int(task["batch_size"]), 1)
+            if "parallel" in task:
+                self.parallel = max(int(task["parallel"]), 1)
+            if "speed_objective" in task:
+                self.speed_objective = self.speedObjective(task["speed_objective"])
+            if "speed_weight" in task:
+                self.speed_weight = float(task["speed_weight"])
             if "suspend" in task:
                 self.suspend = task["suspend"]
         except Exception as e:
@@ -112,13 +139,20 @@ class Task:
 
     @staticmethod
     def metricType(metric:str) -> Metric:
-        if metric == "Accuracy":
-            return Task.Metric.Accuracy
-        elif metric == "MAE":
-            return Task.Metric.MAE
+        if metric in Task.Metric.__members__ and Metrics.get(metric) is not None:
+            return Task.Metric[metric]
         else:
             raise(ValueError("無効なmetric指定です。"))
 
+    @staticmethod
+    def speedObjective(speed_objective:str) -> str:
+        if speed_objective in ["p50", "p95", "max"]:
+            return speed_objective
+        elif speed_objective is None or speed_objective == "":
+            return None
+        else:
+            raise(ValueError("無効なspeed_objective指定です。"))
+
     @staticmethod
     def inputDataType(input_data_type:str) -> InputDataType:
         if input_data_type == "image-1ch":
@@ -130,10 +164,9 @@ class Task:
 
     @staticmethod
     def GoalText(metric:Metric, goal):
-        if metric == Task.Metric.Accuracy:
-            goal_text = f'正解率 <span style="color:#0dcaf0">{goal*100:.1f}</span> % 以上'
-        elif metric == Task.Metric.MAE:
-            goal_text = f'平均絶対誤差 <span style="color:#0dcaf0">{goal}</span> 以下'
+        metric = Metrics.get(metric)
+        value = f'{goal*100:.1f}</span> %' if metric.percent else f'{goal}</span>'
+        goal_text = f'{metric.label} <span style="color:#0dcaf0">{value} {"以上" if metric.higher_is_better else "以下"}'
         return Markup(goal_text)
 
     def dispname(self, name_contest:str) -> str:
@@ -180,18 +213,92 @@ class Task:
         return True
 
 
+class TaskRegistry:
+    # 各タスクのtask.jsonの内容をプロセス内に保持し、ファイルが更新されたときだけ読み直す
+    # (タスクのディレクトリが増減したときは一覧を作り直す)
+    dir_key: tuple # TASKS_DIRの (st_mtime_ns, st_size, st_ino)
+    file_keys: dict # task_id -> task.jsonの (st_mtime_ns, st_size, st_ino)
+    tasks: dict # task_id -> Task(読み込めたものだけ)
+
+    def __init__(self) -> None:
+        self.dir_key = None
+        self.task_ids = []
+        self.file_keys = {}
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fileKey(path:str) -> tuple:
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            return None
+
+    def refresh(self):
+        with self.lock:
+            dir_key = TaskRegistry.fileKey(Task.TASKS_DIR)
+            if dir_key is None or dir_key != self.dir_key:
+                # Task.readTasks()と同じ順に並べる
+                self.task_ids = [os.path.basename(os.path.dirname(dir)) for dir in glob.glob(Task.TASKS_DIR + '/**/')]
+                self.dir_key = dir_key
+
+            file_keys = {}
+            for task_id in self.task_ids:
+                file_keys[task_id] = TaskRegistry.fileKey(os.path.join(Task.TASKS_DIR, task_id, Task.FILENAME_TASK_JSON))
+            if file_keys == self.file_keys:
+                return
+
+            # 変わったタスクだけ読み直す(返した辞書は書き換えず、新しく作る)
+            tasks = {}
+            for task_id, file_key in file_keys.items():
+                if file_key is None:
+                    continue
+                if task_id in self.tasks and self.file_keys.get(task_id) == file_key:
+                    tasks[task_id] = self.tasks[task_id]
+                    continue
+                task = Task(task_id)
+                if not hasattr(task, "name"): # 読み込めなかった
+                    continue
+                print(f"found task: ({task_id}) {task.name}")
+                tasks[task_id] = task
+            self.tasks = tasks
+            self.file_keys = file_keys
+
+    def all(self) -> dict:
+        # 返した辞書とTaskは書き換えないこと(変更はTask(task_id)で読み直したものを save() する)
+        self.refresh()
+        return self.tasks
+
+    def get(self, task_id) -> Task:
+        return self.all().get(task_id)
+
+
 class Stats:
+    # 成績は数が多くなるので属性を固定してメモリを抑える(多数の成績はStatsTableで列として持つ)
+    __slots__ = ("username", "userid", "datetime", "filename", "train", "valid", "test", "message", "memo", "metric", "goal",
+                 "proc_p50_ms", "proc_p95_ms", "proc_max_ms", "cpu_sec", "peak_rss_mb")
+
     username : str
     userid : str
     datetime : datetime
-    filename : str = ""
-    train : list = []
-    valid : list = []
-    test : list = []
-    message : str = ''
-    memo : str = ''
+    filename : str
+    train : float
+    valid : float
+    test : float
+    message : str
+    memo : str
     metric: Task.Metric
     goal: float
+    # 評価で使った資源(記録が無ければNone)
+    proc_p50_ms: float
+    proc_p95_ms: float
+    proc_max_ms: float
+    cpu_sec: float
+    peak_rss_mb: float
+
+    NUM_USAGE_COLUMNS = 5
+    USAGE_ATTRIBUTES = ["proc_p50_ms", "proc_p95_ms", "proc_max_ms", "cpu_sec", "peak_rss_mb"]
 
     # ユーザ成績のcsvファイルに書かれた1行の成績記録をもとにstatsを読み取る
     def __init__(self, user_stats_line:str, username, metric:Task.Metric, goal:float, userid) -> None:
@@ -199,274 +306,639 @@ class Stats:
         self.userid = userid
         self.metric = metric
         self.goal = goal
+        self.datetime = None
+        self.filename = ''
+        self.train = -1
+        self.valid = -1
+        self.test = -1
+        self.message = ''
+        self.memo = ''
+        self.setUsage()
+
+        if user_stats_line is None:
+            return
+
+        # 書式の読み分けはStatsCsvにまとめてある
+        row = StatsCsv.parse([user_stats_line.rstrip(os.linesep)], username, metric, goal, userid)[0]
+        self.datetime = row.datetime
+        self.filename = row.filename
+        self.train = row.train
+        self.valid = row.valid
+        self.test = row.test
+        self.message = row.message
+        self.memo = row.memo
+        self.setUsage(*row.usage())
+
+    def setUsage(self, proc_p50_ms=None, proc_p95_ms=None, proc_max_ms=None, cpu_sec=None, peak_rss_mb=None):
+        def value(x):
+            try:
+                return float(x) if x is not None else None
+            except:
+                return None
 
-        raw = user_stats_line.rstrip(os.linesep).split(",")
-        
-        try:
-            self.datetime = datetime.datetime.strptime(raw[0] + " " + raw[1], "%Y/%m/%d %H:%M:%S")
-        except:
-            self.datetime = datetime.datetime(1984, 4, 22)
+        self.proc_p50_ms = value(proc_p50_ms)
+        self.proc_p95_ms = value(proc_p95_ms)
+        self.proc_max_ms = value(proc_max_ms)
+        self.cpu_sec = value(cpu_sec)
+        self.peak_rss_mb = value(peak_rss_mb)
 
-        try:
-            self.filename = raw[2]
-        except:
-            self.filename = ''
+    def usage(self) -> list:
+        return [self.proc_p50_ms, self.proc_p95_ms, self.proc_max_ms, self.cpu_sec, self.peak_rss_mb]
 
-        if metric == Task.Metric.Accuracy:
-            try:
-                self.train = float(raw[5])
-            except:
-                self.train = -1
+    # 読み取り済みの値(DBの1行など)からstatsを作る
+    @staticmethod
+    def FromRecord(username, metric:Task.Metric, goal:float, userid, submit_datetime:datetime, filename:str, train:float, valid:float, test:float, message:str='', memo:str='', usage:list=None):
+        stats = Stats(None, username, metric, goal, userid)
+        stats.datetime = submit_datetime
+        stats.filename = filename
+        stats.train = train
+        stats.valid = valid
+        stats.test = test
+        stats.message = message
+        stats.memo = memo
+        if usage is not None:
+            stats.setUsage(*usage)
+        return stats
+
+    # 速度も競うタスクでは (Statsの処理時間の属性名, 1msあたりの重み, 記録が無いときの処理時間ms) を返す
+    @staticmethod
+    def Speed(task:Task):
+        if task.speed_objective is None:
+            return None
+        return (f"proc_{task.speed_objective}_ms", task.speed_weight, task.timelimit_per_data * 1000)
 
-            try:
-                self.valid = float(raw[8])
-            except:
-                self.valid = -1
+    # 表示最優先の成績を選ぶための比較キー(大きいほど優先)
+    # test>valid>trainの順で目標達成していること、次にtest>valid>trainの順で性能が高いこと、最後に提出日時が新しいこと
+    # 速度も競う場合、性能は処理時間に重みをかけた値を差し引いて比べる(目標達成の判定には使わない)
+    @staticmethod
+    def BestKey(stats, with_test:bool=True, speed=None) -> tuple:
+        # 低い方がよい評価指標は、高い方がよい値となるよう反転させる
+        sign = Metrics.get(stats.metric).sign()
+        goal = stats.goal * sign
+        train = stats.train * sign
+        valid = stats.valid * sign
+        test = stats.test * sign
+
+        achieve = (test >= goal, valid >= goal, train >= goal) if with_test else (valid >= goal, train >= goal)
+
+        if speed is not None:
+            attribute, weight, default_ms = speed
+            proc_time_ms = getattr(stats, attribute)
+            penalty = weight * (proc_time_ms if proc_time_ms is not None else default_ms)
+            train -= penalty
+            valid -= penalty
+            test -= penalty
+
+        if with_test:
+            return (*achieve, test, valid, train, stats.datetime)
+        else:
+            return (*achieve, valid, train, stats.datetime)
 
-            try:
-                self.test = float(raw[11])
-            except:
-                self.test = -1
+    # 評価できなかった成績は表示最優先の候補にしない
+    @staticmethod
+    def IsValid(stats) -> bool:
+        return stats.train >= 0 and stats.valid >= 0
 
-            try:
-                self.message = raw[12]
-            except:
-                self.message = ''
+    # コンテスト開催中はtestの成績を使わずに選ぶ
+    @staticmethod
+    def BestWithTest(task:Task) -> bool:
+        in_contest = True if task.type == Task.TaskType.Contest and datetime.datetime.now() < task.end_date else False
+        return not in_contest
 
-            try:
-                self.memo = raw[13]
-            except:
-                self.memo = ''
+    @staticmethod
+    def GetBestStats(stats:list, task:Task):
+        with_test = Stats.BestWithTest(task)
+        speed = Stats.Speed(task)
 
-        elif metric == Task.Metric.MAE:
+        # 列で持っている成績はまとめて比べる
+        if isinstance(stats, StatsTable):
             try:
-                self.train = float(raw[3])
+                return stats.best(with_test, speed)
             except:
-                self.train = -1
+                return None
 
-            try:
-                self.valid = float(raw[4])
-            except:
-                self.valid = -1
+        # 1回の走査で最大のキーを持つ成績を選ぶ(同じキーなら後の成績を優先)
+        best_stats = None
+        best_key = None
+        try:
+            for item in stats:
+                if not Stats.IsValid(item):
+                    continue
+                key = Stats.BestKey(item, with_test, speed)
+                if best_key is None or key >= best_key:
+                    best_stats = item
+                    best_key = key
+        except:
+            return None
 
-            try:
-                self.test = float(raw[5])
-            except:
-                self.test = -1
+        return best_stats
 
-            try:
-                self.message = raw[6]
-            except:
-                self.message = ''
 
-            try:
-                self.memo = raw[7]
-            except:
-                self.memo = ''
+class StatsRow:
+    # StatsTableの1行(Statsと同じ属性で読める)
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index:int) -> None:
+        self.table = table
+        self.index = index
+
+    username = property(lambda self: self.table.username)
+    userid = property(lambda self: self.table.userid)
+    metric = property(lambda self: self.table.metric)
+    goal = property(lambda self: self.table.goal)
+    datetime = property(lambda self: self.table.datetime[self.index].astype(datetime.datetime))
+    filename = property(lambda self: self.table.filename[self.index])
+    train = property(lambda self: float(self.table.train[self.index]))
+    valid = property(lambda self: float(self.table.valid[self.index]))
+    test = property(lambda self: float(self.table.test[self.index]))
+    message = property(lambda self: self.table.message[self.index])
+    memo = property(lambda self: self.table.memo[self.index])
+    proc_p50_ms = property(lambda self: self.table.usageValue(self.index, 0))
+    proc_p95_ms = property(lambda self: self.table.usageValue(self.index, 1))
+    proc_max_ms = property(lambda self: self.table.usageValue(self.index, 2))
+    cpu_sec = property(lambda self: self.table.usageValue(self.index, 3))
+    peak_rss_mb = property(lambda self: self.table.usageValue(self.index, 4))
+
+    def usage(self) -> list:
+        return [self.table.usageValue(self.index, i) for i in range(Stats.NUM_USAGE_COLUMNS)]
+
+
+class StatsTable:
+    # 1ユーザ分の成績を提出順に列(NumPy配列)で持つ。ユーザ名・評価指標・目標値は表で1つだけ持つ
+    # (作った後は書き換えない。行はStatsRowとして読む)
+    def __init__(self, username, metric:Task.Metric, goal:float, userid, submit_datetime=None, filename:list=None, train=None, valid=None, test=None, message:list=None, memo:list=None, usage=None) -> None:
+        self.username = username
+        self.userid = userid
+        self.metric = metric
+        self.goal = goal
+        self.datetime = np.asarray(submit_datetime if submit_datetime is not None else [], "datetime64[s]")
+        self.filename = filename if filename is not None else []
+        self.train = np.asarray(train if train is not None else [], float)
+        self.valid = np.asarray(valid if valid is not None else [], float)
+        self.test = np.asarray(test if test is not None else [], float)
+        self.message = message if message is not None else []
+        self.memo = memo if memo is not None else []
+        self.usage = np.asarray(usage if usage is not None else [], float).reshape(-1, Stats.NUM_USAGE_COLUMNS) # 記録が無ければNaN
+
+    def __len__(self) -> int:
+        return len(self.train)
+
+    def __getitem__(self, index:int) -> StatsRow:
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise(IndexError(index))
+        return StatsRow(self, index)
+
+    def __iter__(self):
+        return (StatsRow(self, i) for i in range(len(self)))
+
+    def usageValue(self, index:int, column:int):
+        value = self.usage[index, column]
+        return None if np.isnan(value) else float(value)
 
+    @staticmethod
+    def FromStats(stats_list:list, username, metric:Task.Metric, goal:float, userid):
+        return StatsTable(username, metric, goal, userid,
+                          [stats.datetime for stats in stats_list],
+                          [stats.filename for stats in stats_list],
+                          [stats.train for stats in stats_list],
+                          [stats.valid for stats in stats_list],
+                          [stats.test for stats in stats_list],
+                          [stats.message for stats in stats_list],
+                          [stats.memo for stats in stats_list],
+                          [[np.nan if value is None else value for value in stats.usage()] for stats in stats_list])
 
     @staticmethod
-    def GetBestStats(stats:list, task:Task):
-        def compare(a:Stats, b:Stats):
-            goal = a.goal
-            train_a = a.train
-            train_b = b.train
-            valid_a = a.valid
-            valid_b = b.valid
-            if a.test >= 0:
-                test = True
-                test_a = a.test
-                test_b = b.test
-            else:
-                test = False
-
-            if a.metric == Task.Metric.MAE:
-                # 高い方がよい値となるよう反転させる
-                goal *= -1
-                train_a *= -1
-                train_b *= -1
-                valid_a *= -1
-                valid_b *= -1
-                if test:
-                    test_a *= -1
-                    test_b *= -1
-            
-            # Goal達成チェック
-            train_a_achieve = True if train_a >= goal else False
-            train_b_achieve = True if train_b >= goal else False
-            valid_a_achieve = True if valid_a >= goal else False
-            valid_b_achieve = True if valid_b >= goal else False
-            if test:
-                test_a_achieve = True if test_a >= goal else False
-                test_b_achieve = True if test_b >= goal else False
-
-            # test>valid>trainの順で目標達成していること
-            if test:
-                if test_a_achieve and not test_b_achieve:
-                    return 1 #a
-                if not test_a_achieve and test_b_achieve:
-                    return -1 #b
-                
-            if valid_a_achieve and not valid_b_achieve:
-                return 1 #a
-            if not valid_a_achieve and valid_b_achieve:
-                return -1 #b
-            
-            if train_a_achieve and not train_b_achieve:
-                return 1 #a
-            if not train_a_achieve and train_b_achieve:
-                return -1 #b
-            
-            # test>valid>trainの順で性能が高い方を優先
-            if test:
-                if test_a > test_b:
-                    return 1 #a
-                if test_a < test_b:
-                    return -1 #b
-                
-            if valid_a > valid_b:
-                return 1 #a
-            if valid_a < valid_b:
-                return -1 #b
-            
-            if train_a > train_b:
-                return 1 #a
-            if train_a < train_b:
-                return -1 #b
-            
-            # 提出日時が新しい方を優先
-            if a.datetime > b.datetime:
-                return 1 #a
-            if a.datetime < b.datetime:
-                return -1 #b
-            
-            return 0 # 引き分け
-        
-        def compare_without_test(a:Stats, b:Stats):
-            goal = a.goal
-            train_a = a.train
-            train_b = b.train
-            valid_a = a.valid
-            valid_b = b.valid
-
-            if a.metric == Task.Metric.MAE:
-                # 高い方がよい値となるよう反転させる
-                goal *= -1
-                train_a *= -1
-                train_b *= -1
-                valid_a *= -1
-                valid_b *= -1
-            
-            # Goal達成チェック
-            train_a_achieve = True if train_a >= goal else False
-            train_b_achieve = True if train_b >= goal else False
-            valid_a_achieve = True if valid_a >= goal else False
-            valid_b_achieve = True if valid_b >= goal else False
-
-            # test>valid>trainの順で目標達成していること
-            if valid_a_achieve and not valid_b_achieve:
-                return 1 #a
-            if not valid_a_achieve and valid_b_achieve:
-                return -1 #b
-            
-            if train_a_achieve and not train_b_achieve:
-                return 1 #a
-            if not train_a_achieve and train_b_achieve:
-                return -1 #b
-            
-            # test>valid>trainの順で性能が高い方を優先
-            if valid_a > valid_b:
-                return 1 #a
-            if valid_a < valid_b:
-                return -1 #b
-            
-            if train_a > train_b:
-                return 1 #a
-            if train_a < train_b:
-                return -1 #b
-            
-            # 提出日時が新しい方を優先
-            if a.datetime > b.datetime:
-                return 1 #a
-            if a.datetime < b.datetime:
-                return -1 #b
-            
-            return 0 # 引き分け
+    def Concat(tables:list):
+        # 表をつなげた新しい表(ユーザ名などは最初の表のもの)
+        first = tables[0]
+        return StatsTable(first.username, first.metric, first.goal, first.userid,
+                          np.concatenate([table.datetime for table in tables]),
+                          [filename for table in tables for filename in table.filename],
+                          np.concatenate([table.train for table in tables]),
+                          np.concatenate([table.valid for table in tables]),
+                          np.concatenate([table.test for table in tables]),
+                          [message for table in tables for message in table.message],
+                          [memo for table in tables for memo in table.memo],
+                          np.concatenate([table.usage for table in tables]))
+
+    def select(self, mask):
+        # maskの行だけの表
+        index = np.flatnonzero(mask)
+        return StatsTable(self.username, self.metric, self.goal, self.userid,
+                          self.datetime[index], [self.filename[i] for i in index],
+                          self.train[index], self.valid[index], self.test[index],
+                          [self.message[i] for i in index], [self.memo[i] for i in index], self.usage[index])
+
+    def between(self, start_date:datetime.datetime, end_date:datetime.datetime):
+        # start_date以降、end_dateより前に提出した成績の表
+        return self.select((self.datetime >= np.datetime64(start_date, "s")) & (self.datetime < np.datetime64(end_date, "s")))
+
+    def best(self, with_test:bool=True, speed=None):
+        # Stats.BestKeyと同じ比べ方で表示最優先の成績を選ぶ(同じキーなら後の成績を優先)
+        candidates = np.flatnonzero((self.train >= 0) & (self.valid >= 0))
+        if len(candidates) == 0:
+            return None
 
-        in_contest = True if task.type == Task.TaskType.Contest and datetime.datetime.now() < task.end_date else False
+        sign = Metrics.get(self.metric).sign()
+        goal = self.goal * sign
+        train = self.train[candidates] * sign
+        valid = self.valid[candidates] * sign
+        test = self.test[candidates] * sign
 
-        target_stats = []
-        for item in stats:
-            if item.train < 0 or item.valid < 0:
-                continue
-            target_stats.append(item)
+        achieve = [test >= goal, valid >= goal, train >= goal] if with_test else [valid >= goal, train >= goal]
 
-        if len(target_stats) == 0:
-            return None
+        if speed is not None:
+            attribute, weight, default_ms = speed
+            proc_time_ms = self.usage[candidates, Stats.USAGE_ATTRIBUTES.index(attribute)]
+            penalty = weight * np.where(np.isnan(proc_time_ms), default_ms, proc_time_ms)
+            train = train - penalty
+            valid = valid - penalty
+            test = test - penalty
+
+        values = [test, valid, train] if with_test else [valid, train]
 
+        # np.lexsortは最後のキーを最優先に並べる
+        order = np.lexsort([candidates, self.datetime[candidates], *reversed(values), *reversed(achieve)])
+        return StatsRow(self, int(candidates[order[-1]]))
+
+
+class StatsCsv:
+    # ユーザ成績のcsvファイルの書式
+    # 各結果は改行から書き始める(前の不正終了を引きずらないため)。1つの結果は必ず1行に収める
+    # 版2: 先頭に版の列を置き、引用符付きで書く(message,memoにカンマが入っても崩れない)
+    # 版1: 版の列が無く、カンマで区切っただけの行(日付から始まるので版2と見分けられる)
+    VERSION = 2
+    DEFAULT_DATETIME = datetime.datetime(1984, 4, 22) # 日時を読めなかった行
+
+    @staticmethod
+    def header(metric:Task.Metric) -> str:
+        columns = ["version", "date", "time", "filename"]
+        for data_type in Task.DataType:
+            columns += [f"{data_type.name}_{column}" for column in Metrics.get(metric).columns]
+        columns += ["message", "memo"] + Stats.USAGE_ATTRIBUTES
+        return ",".join(columns)
+
+    @staticmethod
+    def row(submit_datetime:datetime.datetime, filename, values:list, message, memo, usage:list) -> str:
+        # 1つの結果の行(先頭の改行を含む)。valuesは評価指標の集計の列、usageは処理時間とメモリの列(文字列)
+        fields = [StatsCsv.VERSION, submit_datetime.strftime('%Y/%m/%d'), submit_datetime.strftime('%H:%M:%S'), filename, *values, message, memo, *usage]
+        output = io.StringIO()
+        csv.writer(output, lineterminator="").writerow([re.sub(r"[\r\n]+", " ", str(field)) for field in fields])
+        return "\n" + output.getvalue()
+
+    @staticmethod
+    def parse(lines:list, username, metric:Task.Metric, goal:float, userid) -> StatsTable:
+        # 行(改行を除いた文字列)をまとめて読んで表にする。読めない値は-1(処理時間とメモリはNone)
+        prefix = f"{StatsCsv.VERSION},"
+
+        # 引用符を含む版2の行だけcsvモジュールで読み、それ以外の行はまとめてカンマで分ける
+        text = ",".join(lines)
+        quoted = {}
+        if '"' in text:
+            quoted_index = [i for i, line in enumerate(lines) if line.startswith(prefix) and '"' in line]
+            quoted = {i: fields[1:] for i, fields in zip(quoted_index, csv.reader([lines[i] for i in quoted_index]))}
+        if len(quoted) > 0:
+            lines = ["" if i in quoted else line for i, line in enumerate(lines)]
+            text = ",".join(lines)
+        num = len(lines)
+        version = np.fromiter(map(str.startswith, lines, itertools.repeat(prefix)), bool, num)
+        width = np.fromiter(map(str.count, lines, itertools.repeat(",")), int, num) + 1
+        fields = text.split(",")
+        fields.append("") # 足りない列の代わり
+        starts = np.cumsum(width) - width + version # 各行の(版の列を除いた)最初の列の位置
+        num_fields = width - version # 版の列を除いた列数
+        for i, quoted_fields in quoted.items():
+            num_fields[i] = len(quoted_fields)
+
+        uniform = len(quoted) == 0 and num > 0 and np.all(width == width[0]) and np.all(version == version[0]) # 全行が同じ列数(ふつうはこちら)
+
+        def column(index, available) -> list:
+            if uniform:
+                return fields[index[0]::width[0]][:num] if available[0] else [""] * num
+            values = [fields[i] for i in np.where(available, np.clip(index, 0, len(fields) - 1), len(fields) - 1).tolist()] # 引用符を含む行は後で置き換える
+            for i, quoted_fields in quoted.items():
+                values[i] = quoted_fields[index[i] - starts[i]] if available[i] else ""
+            return values
+
+        # 日付,時刻,ファイル名に続き、train,valid,testそれぞれ評価指標の集計の列が並ぶ(最後の列が評価値)
+        def nth(n):
+            return column(starts + n, num_fields > n)
+
+        # 処理時間とメモリはmemoの後に記録されている(記録する前の行には無い)。版1ではmessageのカンマで列がずれるので後ろから数える
+        num_metric_columns = len(Metrics.get(metric).columns)
+        num_columns = 5 + num_metric_columns * 3
+        def usage(n):
+            return column(starts + num_fields - Stats.NUM_USAGE_COLUMNS + n, num_fields >= num_columns + Stats.NUM_USAGE_COLUMNS)
+
+        return StatsTable(username, metric, goal, userid,
+                          StatsCsv._datetimes(nth(0), nth(1)),
+                          nth(2),
+                          StatsCsv._floats(nth(2 + num_metric_columns), -1),
+                          StatsCsv._floats(nth(2 + num_metric_columns * 2), -1),
+                          StatsCsv._floats(nth(2 + num_metric_columns * 3), -1),
+                          nth(3 + num_metric_columns * 3),
+                          nth(4 + num_metric_columns * 3),
+                          np.stack([StatsCsv._floats(usage(n), np.nan) for n in range(Stats.NUM_USAGE_COLUMNS)], axis=1) if num > 0 else None)
+
+    @staticmethod
+    def _floats(values:list, default:float) -> np.ndarray:
+        # "-"と空欄はdefaultにしてまとめて変換し、読めない値があったときだけ1つずつ変換する
+        replace = {"-": repr(default), "": repr(default)}
         try:
-            if in_contest:
-                sorted_list = sorted(target_stats, key=cmp_to_key(compare_without_test))
-            else:
-                sorted_list = sorted(target_stats, key=cmp_to_key(compare))
-            best_stats = sorted_list[-1]
-        except:
-            return None
+            return np.fromiter(map(float, map(replace.get, values, values)), float, len(values))
+        except ValueError:
+            def value(x):
+                try:
+                    return float(x)
+                except ValueError:
+                    return default
+            return np.array([value(x) for x in values], float)
 
-        return best_stats
+    @staticmethod
+    def _datetimes(dates:list, times:list) -> np.ndarray:
+        # "YYYY/mm/dd"と"HH:MM:SS"の固定書式は数字の位置から計算し、それ以外の行だけstrptimeで読む
+        num = len(dates)
+        values = np.full(num, "NaT", "datetime64[s]")
+        fixed = (np.fromiter(map(len, dates), int, num) == 10) & (np.fromiter(map(len, times), int, num) == 8)
+        index = np.flatnonzero(fixed)
+        if len(index) > 0:
+            def digits(texts, width):
+                # 1文字1バイトの行列にする(ASCII以外の文字は?になり、書式の確認で外れる)
+                text = "".join(itertools.compress(texts, fixed)).encode("ascii", "replace")
+                return np.frombuffer(text, np.uint8).reshape(-1, width).astype(int) - ord("0")
+            def number(d, begin, end):
+                return d[:, begin:end] @ (10 ** np.arange(end - begin - 1, -1, -1))
+            date = digits(dates, 10)
+            time = digits(times, 8)
+            year, month, day = number(date, 0, 4), number(date, 5, 7), number(date, 8, 10)
+            hour, minute, second = number(time, 0, 2), number(time, 3, 5), number(time, 6, 8)
+            digit_columns = np.concatenate([date[:, [0, 1, 2, 3, 5, 6, 8, 9]], time[:, [0, 1, 3, 4, 6, 7]]], axis=1)
+            valid = np.all((0 <= digit_columns) & (digit_columns <= 9), axis=1)
+            valid &= (date[:, 4] == ord("/") - ord("0")) & (date[:, 7] == ord("/") - ord("0"))
+            valid &= (time[:, 2] == ord(":") - ord("0")) & (time[:, 5] == ord(":") - ord("0"))
+            valid &= (year >= 1) & (1 <= month) & (month <= 12) & (hour < 24) & (minute < 60) & (second < 60)
+            months = np.where(valid, (year - 1970) * 12 + month - 1, 0).astype("datetime64[M]")
+            first = months.astype("datetime64[D]")
+            valid &= (1 <= day) & (day <= ((months + 1).astype("datetime64[D]") - first).astype(int))
+            seconds = first.astype("datetime64[s]") + (((day - 1) * 24 + hour) * 60 + minute) * 60 + second
+            values[index[valid]] = seconds[valid]
+        for i in np.flatnonzero(np.isnat(values)):
+            try:
+                values[i] = datetime.datetime.strptime(dates[i] + " " + times[i], "%Y/%m/%d %H:%M:%S")
+            except ValueError:
+                values[i] = StatsCsv.DEFAULT_DATETIME
+        return values
+
+
+class StatsCsvReader:
+    # ユーザ成績のcsvファイルを読んだ位置と読み取ったstatsを覚えておき、追記された分だけを読む
+    # (評価システムは追記しかしないので、ファイルが縮んだか置き換えられたときだけ先頭から読み直す)
+    _cache = {} # path -> _Entry
+    _lock = threading.Lock()
+
+    class _Entry:
+        def __init__(self, file_id, rule) -> None:
+            self.file_id = file_id
+            self.rule = rule
+            self.size = 0
+            self.offset = 0 # 改行まで読み終えた位置
+            self.table = None # offsetまでの行の成績
+            self.tail = None # offset以降の改行で終わっていない行の表(各結果は改行から書き始めるので最後の行は常にここに入る)
+            self.result = None # tableにtailを加えた、返す表
+
+    @staticmethod
+    def read(path:str, username, metric:Task.Metric, goal:float, userid) -> StatsTable:
+        # pathの成績を提出順の表で返す(返した表は書き換えないこと)
+        try:
+            st = os.stat(path)
+        except OSError:
+            with StatsCsvReader._lock:
+                StatsCsvReader._cache.pop(path, None)
+            return StatsTable(username, metric, goal, userid)
+        file_id = (st.st_dev, st.st_ino)
+        rule = (metric, goal)
+
+        with StatsCsvReader._lock:
+            entry = StatsCsvReader._cache.get(path)
+            if entry is None or entry.file_id != file_id or entry.rule != rule or st.st_size < entry.size:
+                entry = StatsCsvReader._Entry(file_id, rule)
+                entry.table = StatsTable(username, metric, goal, userid)
+                entry.result = entry.table
+                StatsCsvReader._cache[path] = entry
+
+            if st.st_size != entry.size:
+                with open(path, "rb") as csv_file:
+                    csv_file.seek(entry.offset)
+                    data = csv_file.read(st.st_size - entry.offset)
+                # 改行まで読めた行はまとめて読み、最後の行は書きかけかもしれないので次回も読み直す
+                end = data.rfind(b"\n") + 1
+                lines = [line.rstrip("\r") for line in data[:end].decode('utf-8').split("\n")[:-1]]
+                tail = data[end:]
+                if entry.offset == 0 and len(lines) > 0:
+                    lines = lines[1:] # ヘッダ読み飛ばし
+                header = entry.offset == 0 and end == 0
+                entry.offset += end
+                if len(lines) > 0:
+                    entry.table = StatsTable.Concat([entry.table, StatsCsv.parse(lines, username, metric, goal, userid)])
+                entry.tail = None
+                if not header and len(tail) > 0:
+                    entry.tail = StatsCsv.parse([tail.rstrip(b"\r").decode('utf-8', errors='replace')], username, metric, goal, userid)
+                entry.result = entry.table
+                if entry.tail is not None:
+                    entry.result = StatsTable.Concat([entry.table, entry.tail])
+                entry.size = st.st_size
+
+            # 表示名は変わることがあるので返すたびに合わせる
+            entry.result.username = username
+            entry.result.userid = userid
+            return entry.result
 
 
 class Log:
     LOG_DIR = r"./data/log"
+    FILE_NAME_FORMAT = 'log_%Y%m%d.log'
+    READ_LINES = 256 # 閲覧時に一度に読む行数
+    RETRY = 3 # 書き込みに失敗したときに試し直す回数
+    RETRY_INTERVAL_SEC = 0.1
+
+    # プロセスごとに1つの書き込みスレッドがまとめて書き出す
+    _queue = queue.Queue()
+    _lock = threading.Lock()
+    _thread = None
+    _pid = None
+    # 閲覧用の索引: path -> ((st_dev, st_ino), 各行の先頭位置)
+    _index = {}
+    _index_lock = threading.Lock()
 
     @staticmethod
     def write(log:str) -> bool:
-        if not os.path.exists(Log.LOG_DIR):
-            os.makedirs(Log.LOG_DIR)
-
+        # ログを書き込み待ちに積む(日時は呼ばれた時点のもの)
         now = datetime.datetime.now()
-        log_file_neme = now.strftime('log_%Y%m%d.log')
+        success = Log._start()
+        Log._queue.put((now.strftime(Log.FILE_NAME_FORMAT), now.strftime('%Y-%m-%d %H:%M:%S,') + log + '\n'))
+        return success
 
-        success = False
-        for i in range(1000):
-            try:
-                with open(os.path.join(Log.LOG_DIR, log_file_neme), "a", encoding='utf-8') as f:
-                    f.write(now.strftime('%Y-%m-%d %H:%M:%S,'))
-                    f.write(log + '\n')
-                    success = True
-            except:
-                print("Retry write log")
-                continue
-            break
+    @staticmethod
+    def flush():
+        # 積まれたログが書き出されるまで待つ
+        if Log._pid == os.getpid() and Log._thread is not None and Log._thread.is_alive():
+            Log._queue.join()
 
-        return success
+    @staticmethod
+    def _start() -> bool:
+        # fork後の子プロセスには書き込みスレッドが引き継がれないので、プロセスごとに起動する
+        with Log._lock:
+            if Log._thread is None or Log._pid != os.getpid() or not Log._thread.is_alive():
+                if Log._pid != os.getpid():
+                    Log._queue = queue.Queue()
+                try:
+                    Log._thread = threading.Thread(target=Log._run, args=(Log._queue,), daemon=True)
+                    Log._thread.start()
+                    Log._pid = os.getpid()
+                except RuntimeError as e: # インタプリタ終了中
+                    print(f"log: {e}")
+                    return False
+        return True
 
+    @staticmethod
+    def _run(log_queue:queue.Queue):
+        while True:
+            # 溜まっている分をまとめて取り出し、ファイルごとに1回で書き出す
+            items = [log_queue.get()]
+            while True:
+                try:
+                    items.append(log_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = {}
+            for log_file_name, line in items:
+                lines.setdefault(log_file_name, []).append(line)
+            for log_file_name, file_lines in lines.items():
+                Log._append(os.path.join(Log.LOG_DIR, log_file_name), ''.join(file_lines).encode('utf-8'))
+
+            for _ in items:
+                log_queue.task_done()
 
     @staticmethod
-    def createTable() -> str:
-        # 表のHTMLを作成
-        html_table = '<table class="table table-dark">'
-        html_table += "<thead><tr>"
-        html_table += "<th>Datetime</th>"
-        html_table += "<th>Log</th>"
-        html_table += "</tr></thead>"
-        html_table += "<tbody>"
-
-        paths = glob.glob(os.path.join(Log.LOG_DIR, "*.log"))
-        for path in paths:
-            lines = []
+    def _append(path:str, data:bytes):
+        # O_APPENDで開いて1回のwriteで書くので、他のプロセスの書き込みと行が混ざらない
+        for i in range(Log.RETRY):
             try:
-                with open(path, encoding="utf-8") as f:
-                    lines = f.readlines()
-            except:
-                print(f"cannot open {path}")
+                if not os.path.exists(Log.LOG_DIR):
+                    os.makedirs(Log.LOG_DIR, exist_ok=True)
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    written = os.write(fd, data)
+                    while written < len(data): # 途中までしか書けなかった場合(通常は起きない)
+                        written += os.write(fd, data[written:])
+                finally:
+                    os.close(fd)
+                return
+            except OSError as e:
+                error = e
+                if i < Log.RETRY - 1:
+                    time.sleep(Log.RETRY_INTERVAL_SEC)
+
+        # 書けなかったログは標準エラー出力に残す
+        print(f"cannot write log: {error}", file=sys.stderr)
+        sys.stderr.write(data.decode('utf-8'))
 
-            for line in lines:
-                datetime = line.split(',')[0]
-                html_table += f"<tr><td>{datetime}</td><td>{line.replace(datetime+',', '')}</td></tr>"
 
-        html_table += "</tbody>"
-        html_table += "</table>"
+    @staticmethod
+    def _lines(path:str) -> array.array:
+        # ログファイルの各行の先頭位置(と最後の行の終わり)を返す。追記された分だけ読み足す
+        st = os.stat(path)
+        file_id = (st.st_dev, st.st_ino)
+        with Log._index_lock:
+            index = Log._index.get(path)
+            if index is None or index[0] != file_id or st.st_size < index[1][-1]:
+                index = (file_id, array.array('q', [0]))
+                Log._index[path] = index
+            offsets = index[1]
+
+            if st.st_size > offsets[-1]:
+                with open(path, "rb") as f:
+                    f.seek(offsets[-1])
+                    data = f.read(st.st_size - offsets[-1])
+                # 改行で終わっている行だけを数える
+                base = offsets[-1]
+                pos = data.find(b"\n")
+                while pos >= 0:
+                    offsets.append(base + pos + 1)
+                    pos = data.find(b"\n", pos + 1)
+            return offsets
+
+    @staticmethod
+    def _match(line:str, words:list) -> bool:
+        # wordsのそれぞれについて、どれかひとつが単語として含まれているか(IDの一部やメールアドレスの一部には一致させない)
+        for candidates in words:
+            if not any(re.search(r"(?<![0-9A-Za-z.@-])" + re.escape(word) + r"(?![0-9A-Za-z.@-])", line) for word in candidates):
+                return False
+        return True
+
+    @staticmethod
+    def query(start_date:datetime.date=None, end_date:datetime.date=None, words:list=None, cursor:str=None, limit:int=100) -> dict:
+        # 新しい順にlimit行を返す。続きはnextをcursorに渡して取得する
+        # words: 候補のリストのリスト(すべての候補リストについて、いずれかの単語を含む行だけを返す)
+        if words is None:
+            words = []
+
+        paths = []
+        for path in glob.glob(os.path.join(Log.LOG_DIR, "log_*.log")):
+            try:
+                date = datetime.datetime.strptime(os.path.basename(path), Log.FILE_NAME_FORMAT).date()
+            except ValueError:
+                continue
+            if (start_date is None or start_date <= date) and (end_date is None or date <= end_date):
+                paths.append((date, path))
+        paths.sort(reverse=True)
+
+        # cursorは「日付:その日の何行目より前から」
+        cursor_date = None
+        cursor_line = None
+        if cursor:
+            cursor_date, cursor_line = cursor.split(":")
+            cursor_date = datetime.datetime.strptime(cursor_date, '%Y%m%d').date()
+            cursor_line = int(cursor_line)
+
+        lines = []
+        for date, path in paths:
+            if cursor_date is not None and date > cursor_date:
+                continue
+            try:
+                offsets = Log._lines(path)
+            except OSError as e:
+                print(f"cannot open {path}: {e}")
+                continue
 
-        return html_table
-        
\ No newline at end of file
+            last = len(offsets) - 1 # 行数
+            if cursor_date is not None and date == cursor_date:
+                last = min(last, cursor_line)
+
+            with open(path, "rb") as f:
+                # 後ろからまとめて読む
+                while last > 0:
+                    first = max(last - Log.READ_LINES, 0)
+                    f.seek(offsets[first])
+                    block = f.read(offsets[last] - offsets[first]).decode('utf-8', errors='replace').split("\n")[:-1]
+                    for i in range(len(block) - 1, -1, -1):
+                        line = block[i]
+                        if not Log._match(line, words):
+                            continue
+                        if len(lines) >= limit:
+                            return {"lines": lines, "next": f"{date.strftime('%Y%m%d')}:{first + i + 1}"}
+                        datetime_text, _, log = line.partition(",")
+                        lines.append({"datetime": datetime_text, "log": log})
+                    last = first
+
+        return {"lines": lines, "next": None}
+
+
+# 終了時に書き込み待ちのログを書き出す
+atexit.register(Log.flush)
+
+# プロセス内で共有するタスク一覧
+TASKS = TaskRegistry()
@@ -8,11 +8,21 @@ import shutil
 import datetime
 import time
 from enum import Enum
-from multiprocessing import Pool, TimeoutError
+from multiprocessing import TimeoutError
 import traceback
+import threading
+import queue
+import itertools
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import json
-from task import Task, Log
+from task import Task, TASKS, Log, StatsCsv
+from dataset import read_dataset, stream_inputs, DatasetCache, FILENAME_DATASET_JSON
+from sandbox import Sandbox
+from intake import Intake
+from scheduler import Scheduler
+from results_store import ResultsStore
+from events import Events
+from metrics import Metrics
 import chardet
 import random
 
@@ -21,8 +31,12 @@ UPLOAD_DIR_NAME = r"upload"
 OUTPUT_DIR_NAME = r"output"
 USER_MODULE_DIR_NAME = r"user_module"
 TIMESTAMP_FILE_NAME = r"timestamp.txt"
-FILENAME_DATASET_JSON = r"dataset.json"
 PROC_TIMEOUT_SEC = 1
+FIRST_CALL_MARGIN = 20 # モジュール読み込みと初回呼び出しに与える猶予(timelimit_per_dataの倍数)
+SANDBOX = None
+SANDBOXES = [] # 並列評価のために追加で立ち上げたサンドボックス
+METRICS_INTERVAL_SEC = 1.0
+PROGRESS_INTERVAL_SEC = 0.5 # 評価の進み具合を知らせる間隔
 
 
 def UpdateTtimestamp(task_id):
@@ -34,198 +48,377 @@ def UpdateTtimestamp(task_id):
         f.write(datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f'))
 
 
-def read_dataset(path_json, answer_value_type=int, multi_data:bool=False, data_type:Task.InputDataType=Task.InputDataType.Image3ch):
-    json_open = open(path_json, 'r', encoding='utf-8')
-    dataset = json.load(json_open)
+def GetSandbox() -> Sandbox:
+    # ワーカープロセスごとに常駐のサンドボックスを1つ持つ
+    global SANDBOX
+    if SANDBOX is None:
+        SANDBOX = Sandbox()
+    return SANDBOX
 
-    filename_list = []
-    input_data_list = [] #入力データ
-    correct_list = [] #正解値
-    num_problem = 0
 
-    for item in dataset["data"]:
-        try:
-            # 正解値
-            correct_list.append(answer_value_type(item["gt"]))
-
-            # 入力データ
-            data = []
-            filename = []
-            if multi_data:
-                for path in item["path"]:
-                    # 画像読み込み
-                    filename.append(path)
-                    data.append(np.array(Image.open(os.path.join(os.path.dirname(path_json), path))))
-            else:
-                # 画像読み込み
-                filename = item["path"]
-                data = np.array(Image.open(os.path.join(os.path.dirname(path_json), item["path"])))
+def GetSandboxes(num) -> list:
+    # 並列評価に使うサンドボックス(追加分は一度立ち上げたら使い回す)
+    while len(SANDBOXES) < num - 1:
+        SANDBOXES.append(Sandbox())
+    return [GetSandbox()] + SANDBOXES[:num - 1]
+
 
-            input_data = np.array(data, dtype=data[0].dtype)
-            input_data_list.append(input_data)
-            filename_list.append(filename)
+def InitWorker():
+    # ワーカー起動時にサンドボックスを立ち上げておき、最初の提出から温まった状態で使う
+    GetSandbox()
 
-            num_problem += 1
-        except:
-            print(f"入力データ({num_problem})の読み込みに失敗しました。")
-            continue
 
-    # 正解値リストをnumpyに変換
-    correct_list = np.array(correct_list, dtype=answer_value_type)
+def answer_time_limit(input_data, timelimit_per_data, first_call=False):
+    num_input_data = input_data.shape[0]
+    return timelimit_per_data * (num_input_data + FIRST_CALL_MARGIN) if first_call else timelimit_per_data * num_input_data # 初回のみユーザ処理の初期化を考慮してゆるめ
 
-    return num_problem, filename_list, input_data_list, correct_list
 
+def cast_answer(answer, answer_value_type):
+    # 返り値の型を矯正
+    answer = answer_value_type(answer)
+    if type(answer) is not answer_value_type:
+        print(f"Type error answer:{type(answer)} answer_value_type:{answer_value_type}")
+        raise(ValueError("推定処理の返り値の型が適切ではありません。"))
+    return answer
 
-def evaluate(num_problem, input_data_list, func_recognition, answer_value_type, timelimit_per_data=PROC_TIMEOUT_SEC):
+
+def evaluate(num_problem, input_data_list, sandbox:Sandbox, answer_value_type, timelimit_per_data=PROC_TIMEOUT_SEC, first_call=False, batch_size=1, progress=None):
     total_proc_time = 0
     try:
         # ユーザ作成の処理にかける
         answer_list = np.zeros((num_problem), answer_value_type)
-        with Pool(processes=1) as p:
-            for i in range(num_problem):
-                num_input_data = input_data_list[i].shape[0]
-                time_limit = timelimit_per_data * (num_input_data + 20) if i == 0 else timelimit_per_data * num_input_data # 初回のみオーバーヘッドを考慮してゆるめ
-
-                start_time = time.time()
-                apply_result = p.apply_async(func_recognition, (input_data_list[i],))
-                answer = apply_result.get(timeout=time_limit)
-
-                # 返り値の型を矯正
-                answer = answer_value_type(answer)
-                if type(answer) is not answer_value_type:
-                    print(f"Type error answer:{type(answer)} answer_value_type:{answer_value_type}")
-                    raise(ValueError("推定処理の返り値の型が適切ではありません。"))
-                
-                end_time = time.time()
-                total_proc_time += end_time - start_time
-                #print(f'proc time: {end_time - start_time} s')
-                if end_time - start_time > time_limit:
-                    raise(TimeoutError("推定処理がタイムアウトしました。"))
-
-                answer_list[i] = answer
+        wall_time_list = np.zeros((num_problem), float) # サンドボックス内で測ったデータごとの処理時間(秒)
+        cpu_time_list = np.zeros((num_problem), float) # データごとのCPU時間(秒)
+
+        # recognition_batch()があればbatch_size件ずつまとめて渡す(入力データは順に取り出せればよい)
+        chunk_size = batch_size if sandbox.batch else 1
+        input_data_iter = iter(input_data_list)
+        for begin in range(0, num_problem, chunk_size):
+            chunk = list(itertools.islice(input_data_iter, chunk_size))
+            if len(chunk) == 0:
+                raise(ValueError("入力データが不足しています。"))
+            time_limit = 0
+            for i, input_data in enumerate(chunk):
+                time_limit += answer_time_limit(input_data, timelimit_per_data, first_call and begin + i == 0)
+
+            start_time = time.time()
+            if sandbox.batch:
+                answers = sandbox.recognitionBatch(chunk, timeout=time_limit)
+                if len(answers) != len(chunk):
+                    raise(ValueError("recognition_batch()の返り値の個数が入力データの個数と一致しません。"))
+            else:
+                answers = [sandbox.recognition(chunk[0], timeout=time_limit)]
+
+            answers = [cast_answer(answer, answer_value_type) for answer in answers]
+
+            end_time = time.time()
+            total_proc_time += end_time - start_time
+            #print(f'proc time: {end_time - start_time} s')
+            if end_time - start_time > time_limit:
+                raise(TimeoutError("推定処理がタイムアウトしました。"))
+
+            answer_list[begin:begin + len(answers)] = answers
+            # まとめて処理した場合はデータ数で等分する
+            wall_time_list[begin:begin + len(answers)] = sandbox.wall_time / len(answers)
+            cpu_time_list[begin:begin + len(answers)] = sandbox.cpu_time / len(answers)
+
+            # 評価し終えたデータを知らせる
+            if progress is not None:
+                progress(begin, answers)
     except TimeoutError:
         print("推定処理がタイムアウトしました。")
         raise(TimeoutError("推定処理がタイムアウトしました。"))
     except Exception as e:
         raise(e)
     
-    return answer_list, total_proc_time
-
-
-class Result:
-    data_type = Task.DataType.train
-    filename = ""
-    correct = 0
-    answer = 0
+    return answer_list, total_proc_time, wall_time_list, cpu_time_list
+
+
+class Results:
+    # 評価結果をデータごとの列(NumPy配列)で持つ
+    def __init__(self, data_type=None, filename=None, correct=None, answer=None, wall_time=None, cpu_time=None) -> None:
+        self.data_type = data_type if data_type is not None else np.zeros((0), np.int8) # Task.DataTypeの値
+        self.filename = filename if filename is not None else []
+        self.correct = correct if correct is not None else np.zeros((0))
+        self.answer = answer if answer is not None else np.zeros((0))
+        self.wall_time = wall_time if wall_time is not None else np.zeros((0), float) # 処理時間(秒)
+        self.cpu_time = cpu_time if cpu_time is not None else np.zeros((0), float) # CPU時間(秒)
+
+    def __len__(self) -> int:
+        return len(self.data_type)
+
+    def split(self, data_type:Task.DataType):
+        # data_typeのデータの (正解値, 推定値)
+        mask = self.data_type == data_type.value
+        return self.correct[mask], self.answer[mask]
+
+    def detailCsv(self, metric) -> str:
+        # 詳細(1データ1行)をまとめて文字列にする
+        if len(self) == 0:
+            return ""
+        names = np.array([data_type.name for data_type in Task.DataType])[self.data_type - 1]
+        columns = [
+            names,
+            [str(filename).replace(',', '-') for filename in self.filename],
+            self.correct.astype(str),
+            self.answer.astype(str),
+            metric.detail(self.correct, self.answer).astype(str),
+            np.char.mod("%.3f", self.wall_time * 1000),
+            np.char.mod("%.3f", self.cpu_time * 1000),
+        ]
+        return "\n".join(map(",".join, zip(*columns))) + "\n"
+
+
+class Usage:
+    # 1つの提出の評価で使った資源(取得できなかった値はNone)
+    CSV_HEADER = "proc_p50_ms,proc_p95_ms,proc_max_ms,cpu_sec,peak_rss_mb"
+
+    proc_p50_ms = None
+    proc_p95_ms = None
+    proc_max_ms = None
+    cpu_sec = None
+    peak_rss_mb = None
+
+    def __init__(self, results:Results=None, peak_rss=None) -> None:
+        if results is not None and len(results) > 0:
+            wall_time_ms = results.wall_time * 1000
+            self.proc_p50_ms = float(np.percentile(wall_time_ms, 50))
+            self.proc_p95_ms = float(np.percentile(wall_time_ms, 95))
+            self.proc_max_ms = float(np.max(wall_time_ms))
+            self.cpu_sec = float(np.sum(results.cpu_time))
+        if peak_rss is not None:
+            self.peak_rss_mb = peak_rss / (1024 * 1024)
+
+    def values(self) -> list:
+        return [self.proc_p50_ms, self.proc_p95_ms, self.proc_max_ms, self.cpu_sec, self.peak_rss_mb]
+
+    def fields(self) -> list:
+        return ["-" if value is None else f"{value:.3f}" for value in self.values()]
+
+    def csv(self) -> str:
+        return ",".join(self.fields())
+    
 
-    def __init__(self, data_type, filename, correct, answer) -> None:
-        self.data_type = data_type
+class Progress:
+    # 評価の進み具合を数え、間引いて閲覧側に知らせる(trainの成績だけは途中経過も見せる)
+    def __init__(self, task_id, task:Task, user_name, filename) -> None:
+        self.task_id = task_id
+        self.task = task
+        self.user_name = user_name
         self.filename = filename
-        self.correct = correct
-        self.answer = answer
-    
+        self.num_total = 0
+        self.num_done = 0
+        self.data_type = None # 最後に評価し終えたデータの種類
+        self.metric = Metrics.get(task.metric)
+        self.train_correct = [] # 評価し終えたtrainの正解値と推定値(知らせるときにまとめて評価値を計算する)
+        self.train_answers = []
+        self.start_time = time.time()
+        self.published = 0
+
+    def begin(self, num_total):
+        self.num_total = num_total
+        self.start_time = time.time()
+        self.publish(True)
+
+    def add(self, data_type:Task.DataType, correct_list, answers):
+        self.num_done += len(answers)
+        self.data_type = data_type
+        if data_type == Task.DataType.train and len(answers) > 0:
+            self.train_correct.append(np.asarray(correct_list))
+            self.train_answers.append(np.asarray(answers))
+        self.publish()
+
+    def publish(self, force:bool=False):
+        now = time.time()
+        if not force and self.num_done < self.num_total and now - self.published < PROGRESS_INTERVAL_SEC:
+            return
+        self.published = now
+
+        elapsed_sec = now - self.start_time
+        eta_sec = elapsed_sec * (self.num_total - self.num_done) / self.num_done if self.num_done > 0 else None
+        train = None
+        if len(self.train_correct) > 0:
+            train = self.metric.score(np.concatenate(self.train_correct), np.concatenate(self.train_answers))
+        Events.publish(Events.ITEM, self.task_id, self.user_name, filename=self.filename,
+                       split=self.data_type.name if self.data_type is not None else None,
+                       done=self.num_done, total=self.num_total,
+                       train=train,
+                       elapsed_sec=round(elapsed_sec, 1), eta_sec=round(eta_sec, 1) if eta_sec is not None else None)
+
+
+def load_split(task_id, data_type:Task.DataType, answer_value_type, multi_data, input_data_type, seed, shuffle:bool):
+    num, filename_list, input_source, correct_list = DatasetCache.load(
+        task_id, data_type, answer_value_type, multi_data, input_data_type)
+
+    # シャッフル(入力データは並べ替えず、評価する順番だけを決める)
+    if shuffle:
+        order = np.random.default_rng(seed).permutation(num)
+        filename_list = [filename_list[i] for i in order]
+        correct_list = correct_list[order]
+    else:
+        order = np.arange(num)
+
+    return num, filename_list, input_source, correct_list, order
+
+
+def evaluate3data(task_id, module_name, user_name, answer_value_type=int, multi_data:bool=False, data_type:Task.InputDataType=Task.InputDataType.Image3ch, contest:bool=False, timelimit_per_data=PROC_TIMEOUT_SEC, batch_size=1, parallel=1, progress=None):
+    # ユーザ作成の処理をサンドボックスに読み込む(並列評価ではサンドボックスごとに読み込む)
+    sandboxes = GetSandboxes(max(parallel, 1))
+    def load(sandbox:Sandbox):
+        try:
+            sandbox.load(f"{Task.TASKS_DIR}.{task_id}.{USER_MODULE_DIR_NAME}.{module_name}", timeout=timelimit_per_data * FIRST_CALL_MARGIN)
+        except TimeoutError:
+            raise(ValueError("モジュールを読み込めません。"))
 
-def evaluate3data(task_id, module_name, user_name, answer_value_type=int, multi_data:bool=False, data_type:Task.InputDataType=Task.InputDataType.Image3ch, contest:bool=False, timelimit_per_data=PROC_TIMEOUT_SEC):
-    try:
-        # ユーザ作成の処理を読み込む
-        user_module = importlib.import_module(f"{Task.TASKS_DIR}.{task_id}.{USER_MODULE_DIR_NAME}.{module_name}")
-    except:
-        raise(ValueError("モジュールを読み込めません。"))
-    
-    try:
-        # ユーザ作成の処理を読み込む
-        func_recognition = user_module.recognition
-    except:
-        raise(ValueError("関数recognition()を読み込めません。"))
-    
-    # 結果のリスト
-    result_list = []
-    
     start = time.time()
 
-    try:    
-        # train
-        num_train, filename_list, input_data_list, correct_list = read_dataset(
-            os.path.join(Task.TASKS_DIR, task_id, "train", FILENAME_DATASET_JSON), answer_value_type, multi_data, data_type)
-
-        answer_list, total_proc_time = evaluate(num_train, input_data_list, func_recognition, answer_value_type, timelimit_per_data)
-        if num_train == 0:
-            return []
-        for i in range(num_train):
-            result = Result(Task.DataType.train, filename_list[i], correct_list[i], answer_list[i])
-            result_list.append(result)
-        print(f'Train({user_name}) average proc time: {total_proc_time / num_train : .1f}s, total: {total_proc_time : .1f} s')
-
-        # valid
-        num_valid, filename_list, input_data_list, correct_list = read_dataset(
-            os.path.join(Task.TASKS_DIR, task_id, "valid", FILENAME_DATASET_JSON), answer_value_type, multi_data, data_type)
-        
-        # シャッフル
-        rng = np.random.default_rng(int(start))
-        rng.shuffle(input_data_list)
-        rng = np.random.default_rng(int(start))
-        rng.shuffle(correct_list)
-        rng = np.random.default_rng(int(start))
-        rng.shuffle(filename_list)
-
-        answer_list, total_proc_time = evaluate(num_valid, input_data_list, func_recognition, answer_value_type, timelimit_per_data)
-        if num_valid == 0:
-            return []
-        for i in range(num_valid):
-            result = Result(Task.DataType.valid, filename_list[i], correct_list[i], answer_list[i])
-            result_list.append(result)
-        print(f'Valid({user_name}) average proc time: {total_proc_time / num_valid : .1f}s, total: {total_proc_time : .1f} s')
-
-        # test
+    try:
+        if len(sandboxes) == 1:
+            load(sandboxes[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(sandboxes)) as executor:
+                list(executor.map(load, sandboxes))
+
+        # 評価するデータ(valid,testはシャッフルする)
+        data_types = [Task.DataType.train, Task.DataType.valid]
         if contest:
-            num_test, filename_list, input_data_list, correct_list = read_dataset(
-                os.path.join(Task.TASKS_DIR, task_id, "test", FILENAME_DATASET_JSON), answer_value_type, multi_data, data_type)
-        
-            # シャッフル
-            rng = np.random.default_rng(int(start))
-            rng.shuffle(input_data_list)
-            rng = np.random.default_rng(int(start))
-            rng.shuffle(correct_list)
-            rng = np.random.default_rng(int(start))
-            rng.shuffle(filename_list)
-
-            answer_list, total_proc_time = evaluate(num_test, input_data_list, func_recognition, answer_value_type, timelimit_per_data)
-            if num_test == 0:
-                return []
-            for i in range(num_test):
-                result = Result(Task.DataType.test, filename_list[i], correct_list[i], answer_list[i])
-                result_list.append(result)
-            print(f'Test({user_name}) average proc time: {total_proc_time / num_test : .1f}s, total: {total_proc_time : .1f} s')
+            data_types.append(Task.DataType.test)
+        splits = {}
+        for split_type in data_types:
+            splits[split_type] = load_split(task_id, split_type, answer_value_type, multi_data, data_type,
+                                            int(start), split_type != Task.DataType.train)
+            if splits[split_type][0] == 0:
+                return Results(), Usage()
+
+        # 各データをサンドボックス数で分割し、train,valid,testの順に空いたサンドボックスが評価する
+        jobs = queue.Queue()
+        job_index = 0
+        for split_type in data_types:
+            num = splits[split_type][0]
+            shard_size = -(-num // len(sandboxes))
+            for begin in range(0, num, shard_size):
+                jobs.put((job_index, split_type, begin, min(begin + shard_size, num)))
+                job_index += 1
+
+        answer_lists = {split_type: np.zeros((splits[split_type][0]), answer_value_type) for split_type in data_types}
+        wall_time_lists = {split_type: np.zeros((splits[split_type][0]), float) for split_type in data_types}
+        cpu_time_lists = {split_type: np.zeros((splits[split_type][0]), float) for split_type in data_types}
+        proc_times = {split_type: 0 for split_type in data_types}
+        errors = []
+        failed = threading.Event()
+        lock = threading.Lock()
+
+        # 評価の進み具合(全データ数)
+        if progress is not None:
+            progress.begin(sum(splits[split_type][0] for split_type in data_types))
+
+        def run(sandbox:Sandbox):
+            first_call = True # サンドボックスごとの初回呼び出しは初期化を考慮してゆるめ
+            while not failed.is_set():
+                try:
+                    index, split_type, begin, end = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                input_data_list = stream_inputs(splits[split_type][2], splits[split_type][4][begin:end])
+                def progress_chunk(chunk_begin, answers, split_type=split_type, begin=begin):
+                    # 評価し終えたデータを正解と合わせて知らせる
+                    if progress is None:
+                        return
+                    with lock:
+                        progress.add(split_type, splits[split_type][3][begin + chunk_begin:begin + chunk_begin + len(answers)], answers)
+                try:
+                    answer_list, total_proc_time, wall_time_list, cpu_time_list = evaluate(end - begin, input_data_list, sandbox, answer_value_type, timelimit_per_data, first_call=first_call, batch_size=batch_size, progress=progress_chunk)
+                except Exception as e:
+                    # 1つでも失敗したら残りは評価しない
+                    with lock:
+                        errors.append((index, e))
+                    failed.set()
+                    return
+                finally:
+                    input_data_list.close()
+                first_call = False
+                answer_lists[split_type][begin:end] = answer_list
+                wall_time_lists[split_type][begin:end] = wall_time_list
+                cpu_time_lists[split_type][begin:end] = cpu_time_list
+                with lock:
+                    proc_times[split_type] += total_proc_time
+
+        if len(sandboxes) == 1:
+            run(sandboxes[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(sandboxes)) as executor:
+                list(executor.map(run, sandboxes))
+
+        if len(errors) > 0:
+            # 順に評価した場合と同じく、最初のデータでの失敗を返す
+            raise(min(errors, key=lambda x: x[0])[1])
+
+        # モジュールを破棄する前に、サンドボックスのピークRSSを取得する(並列評価では最大のもの)
+        peak_rss = None
+        for sandbox in sandboxes:
+            try:
+                rss = sandbox.peakRss(timeout=timelimit_per_data * FIRST_CALL_MARGIN)
+            except Exception as e:
+                print(f"peak rss: {e}")
+                rss = None
+            if rss is not None:
+                peak_rss = rss if peak_rss is None else max(peak_rss, rss)
+
+        # 結果(train,valid,testの順につなげる)
+        results = Results(
+            np.concatenate([np.full((splits[split_type][0]), split_type.value, np.int8) for split_type in data_types]),
+            list(itertools.chain.from_iterable(splits[split_type][1] for split_type in data_types)),
+            np.concatenate([splits[split_type][3] for split_type in data_types]),
+            np.concatenate([answer_lists[split_type] for split_type in data_types]),
+            np.concatenate([wall_time_lists[split_type] for split_type in data_types]),
+            np.concatenate([cpu_time_lists[split_type] for split_type in data_types]))
+        for split_type in data_types:
+            num = splits[split_type][0]
+            print(f'{split_type.name.capitalize()}({user_name}) average proc time: {proc_times[split_type] / num : .1f}s, total: {proc_times[split_type] : .1f} s')
 
     except Exception as e:
         raise(e)
+    finally:
+        # 次の提出に持ち越さないよう、提出を読み込んだサンドボックスは起動し直す
+        for sandbox in sandboxes:
+            sandbox.unload(timeout=timelimit_per_data * FIRST_CALL_MARGIN)
 
     print(f'Proc Time({user_name}): {time.time()-start : .1f} s')
 
-    return result_list
+    return results, Usage(results, peak_rss)
+
+
+def CsvValues(values) -> list:
+    # 集計の値をcsvの列にする(値が無ければ-)
+    return ["-" if value is None else str(value) for value in values]
 
 
 def ProcOneUser(task_id, user_name, new_filename, now, memo=''):
     # タスク情報の読み込み
-    task:Task = Task(task_id)
+    task:Task = TASKS.get(task_id)
     if task is None:
-        print("タスク情報を読み込めません: {task_id}")
+        print(f"タスク情報を読み込めません: {task_id}")
+        Events.publish(Events.FINISHED, task_id, user_name, filename=new_filename, success=False)
         return
 
+    # 評価の進み具合を知らせる
+    progress = Progress(task_id, task, user_name, new_filename)
+
     # 処理と評価を実行
     proc_success = False
     message = ''
+    usage = Usage()
     try:
         if task.answer_value_type == Task.AnswerValueType.integer:
             answer_value_type = int
         elif task.answer_value_type == Task.AnswerValueType.real:
             answer_value_type = float
 
-        result_list = evaluate3data(
+        results, usage = evaluate3data(
             task_id, os.path.splitext(new_filename)[0], # 拡張子を除く
             user_name, answer_value_type, task.multi_input_data,
             task.input_data_type, True if task.type == Task.TaskType.Contest else False,
-            task.timelimit_per_data)
+            task.timelimit_per_data, task.batch_size, task.parallel, progress)
 
         proc_success = True
     except Exception as e:
@@ -233,111 +426,92 @@ def ProcOneUser(task_id, user_name, new_filename, now, memo=''):
         message = e
         print(f'evaluate3data: {e}')
 
+    # 評価結果を集計(データの種類ごとに、評価指標の集計の列を配列のままで計算する)
+    metric = Metrics.get(task.metric)
+    summaries = {}
     if proc_success:
-        # 評価結果を集計
-        if task.metric == Task.Metric.Accuracy:
-            num_true = {}
-            num_false = {}
-            for data_type in Task.DataType:
-                num_true[data_type] = 0
-                num_false[data_type] = 0
-
-            for result in result_list:
-                if result.correct == result.answer:
-                    num_true[result.data_type] += 1
-                else:
-                    num_false[result.data_type] += 1
-        elif task.metric == Task.Metric.MAE:
-            abs_errors = {}
-            for result in result_list:
-                if not result.data_type in abs_errors:
-                    abs_errors[result.data_type] = []
-                abs_errors[result.data_type].append(np.abs(result.answer - result.correct))
-
-        # 評価結果の詳細を出力
-        output_csv_filename = user_name + "_" + now.strftime('%Y%m%d_%H%M%S') + ".csv"
+        splits = {data_type: results.split(data_type) for data_type in Task.DataType}
+        for data_type in Task.DataType:
+            summaries[data_type] = metric.summary(*splits[data_type])
+
+        # 評価結果の詳細を出力(まとめて1回で書く)
+        lines = []
+        lines.append(f"filename,{os.path.basename(new_filename)}\n\n")
+        lines.append("type,num_data," + ",".join(metric.columns) + "\n")
+        for data_type in Task.DataType:
+            lines.append(f"{data_type.name},{len(splits[data_type][0])},{','.join(CsvValues(summaries[data_type]))}\n")
+
+        # クラスごとの内訳(内訳のある評価指標のみ)
+        breakdown_lines = []
+        for data_type in Task.DataType:
+            breakdown = metric.breakdown(*splits[data_type]) if len(splits[data_type][0]) > 0 else None
+            if breakdown is None:
+                continue
+            columns, rows = breakdown
+            if len(breakdown_lines) == 0:
+                breakdown_lines.append("\ntype," + ",".join(columns) + "\n")
+            breakdown_lines.extend(f"{data_type.name},{','.join(CsvValues(row))}\n" for row in rows)
+        lines.extend(breakdown_lines)
+
+        # 処理時間とメモリ
+        lines.append("\n")
+        lines.append(Usage.CSV_HEADER + "\n")
+        lines.append(usage.csv() + "\n")
+
+        # 詳細
+        lines.append("\n")
+        lines.append(f"type,filename,correct,answer,{metric.detail_column},wall_ms,cpu_ms\n")
+        lines.append(results.detailCsv(metric))
+
+        output_csv_filename = os.path.splitext(os.path.basename(new_filename))[0] + ".csv" # 移動したモジュールと同じ名前(同時に評価する提出どうしで重ならない)
         with open(os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "detail", output_csv_filename), "w", encoding='utf-8') as output_csv_file:
-            # 集計
-            output_csv_file.write(f"filename,{os.path.basename(new_filename)}\n\n")
-            output_csv_file.write("type,num_data,{0}\n".format(
-                    "true,false,accuracy" if task.metric == Task.Metric.Accuracy else ("MAE" if task.metric == Task.Metric.MAE else "")
-                ))
-            for data_type in Task.DataType:
-                if task.metric == Task.Metric.Accuracy:
-                    num_data = num_true[data_type] + num_false[data_type]
-                    output_csv_file.write(f"{data_type.name},{num_data},{num_true[data_type]},{num_false[data_type]},{num_true[data_type]/num_data if num_data > 0 else '-'}\n")
-                    # print(f"{data_type.name},{num_data},{num_true[data_type]},{num_false[data_type]},{num_true[data_type]/num_data if num_data > 0 else '-'}")
-                elif task.metric == Task.Metric.MAE:
-                    if data_type in abs_errors:
-                        num_data = len(abs_errors[data_type])
-                        output_csv_file.write(f"{data_type.name},{num_data},{np.average(np.array(abs_errors[data_type], float))}\n")
-
-            # 詳細
-            output_csv_file.write("\n")
-            if task.metric == Task.Metric.Accuracy:
-                output_csv_file.write("type,filename,correct,answer,check\n")
-                for result in result_list:
-                    output_csv_file.write(f"{result.data_type.name},{result.filename.replace(',', '-')},{result.correct},{result.answer},{1 if result.correct == result.answer else 0}\n")
-            elif task.metric == Task.Metric.MAE:
-                output_csv_file.write("type,filename,correct,answer,abs_error\n")
-                for result in result_list:
-                    output_csv_file.write(f"{result.data_type.name},{str(result.filename).replace(',', '-')},{result.correct},{result.answer},{np.abs(result.answer - result.correct)}\n")
+            output_csv_file.write("".join(lines))
+
+    # 成績DBへの記録に備え、既存のCSVを取り込んでおく
+    try:
+        ResultsStore.importCsv(task)
+    except Exception as e:
+        print(f"ResultsStore: {e}")
 
     # ユーザ毎の結果出力
     csv_path = os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "user", user_name + ".csv")
     if not os.path.exists(csv_path):
         # ファイルが無いのでヘッダを付ける
         with open(csv_path, "w", encoding='utf-8') as output_csv_file:
-            output_csv_file.write("date,time,filename,")
-
-            for data_type in Task.DataType:
-                if task.metric == Task.Metric.Accuracy:
-                    output_csv_file.write(f"{data_type.name}_true,{data_type.name}_false,{data_type.name}_accuracy,")
-                elif task.metric == Task.Metric.MAE:
-                    output_csv_file.write(f"{data_type.name}_MAE,")
-
-            output_csv_file.write("message,memo")
-
+            output_csv_file.write(StatsCsv.header(task.metric))
+
+    # 1つの結果を1行で書く(書式はStatsCsvを参照)
+    values = []
+    for data_type in Task.DataType:
+        if proc_success:
+            values += CsvValues(summaries[data_type])
+        else:
+            values += ["-"] * len(metric.columns)
     with open(csv_path, "a", encoding='utf-8') as output_csv_file:
-        output_csv_file.write('\n') # 各結果の最初に改行を入れる。前の不正終了を引きずらないため
-        output_csv_file.write(now.strftime('%Y/%m/%d,%H:%M:%S,'))                    
-        output_csv_file.write(os.path.basename(new_filename) + ",")
-        for data_type in Task.DataType:
-            if task.metric == Task.Metric.Accuracy:
-                if proc_success:
-                    if data_type in num_true and data_type in num_false:
-                        num_data = num_true[data_type] + num_false[data_type]
-                        output_csv_file.write(f"{num_true[data_type]},{num_false[data_type]},{num_true[data_type]/num_data if num_data > 0 else '-'},")
-                    else:
-                        output_csv_file.write(f"-,-,-,")
-                else:
-                    output_csv_file.write(f"-,-,-,")
-            elif task.metric == Task.Metric.MAE:
-                if proc_success:
-                    if data_type in abs_errors:
-                        num_data = len(abs_errors[data_type])
-                        if num_data > 0:
-                            output_csv_file.write(f"{np.average(np.array(abs_errors[data_type], float))},")
-                        else:
-                            output_csv_file.write("-,")
-                    else:
-                        output_csv_file.write("-,")
-                else:
-                    output_csv_file.write("-,")
-
-        output_csv_file.write(f"{message},{memo}")
-
-    # 処理中であることを示すファイルを削除
+        output_csv_file.write(StatsCsv.row(now, os.path.basename(new_filename), values, message, memo, usage.fields()))
+
+    # 成績DBに記録(評価できなかったデータは-1)
+    values = {}
+    for data_type in Task.DataType:
+        values[data_type] = -1
+        if proc_success and summaries[data_type][-1] is not None:
+            values[data_type] = summaries[data_type][-1]
     try:
-        os.remove(os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "user", f"{user_name}_inproc"))
-    except:
-        print(f"{user_name}_inproc を削除できませんでした。")
+        ResultsStore.add(task, user_name, now, os.path.basename(new_filename), values, message, memo, usage.values())
+    except Exception as e:
+        print(f"ResultsStore: {e}")
+        ResultsStore.invalidate(task_id)
+
+    # 評価が終わったことを知らせる
+    Events.publish(Events.FINISHED, task_id, user_name, filename=new_filename, success=proc_success)
 
     # タイムスタンプ更新
     UpdateTtimestamp(task_id)
 
     # Log
     Log.write(f'{new_filename} on {task_id} {"was" if proc_success else "was not" } completed.')
+    # 評価用のプロセスは終了時の後片付けをしないので、ここで書き出しておく
+    Log.flush()
 
 
 def GetEncodingType(file):
@@ -346,88 +520,131 @@ def GetEncodingType(file):
     return chardet.detect(rawdata)['encoding']
 
 
+def ModuleFilename(task_id, user_name, path, now:datetime.datetime) -> str:
+    # 評価のために移動した提出のファイル名
+    return user_name + "_" + task_id + "_" + now.strftime('%Y%m%d_%H%M%S_') + os.path.basename(path)
+
+
+def RunningJobs(scheduler:Scheduler) -> list:
+    # 評価中の提出(イベントファイルを作り直すときに書いておく)
+    return [{"type": Events.STARTED, "task_id": job.submission.task_id, "user_name": job.submission.user_name,
+             "filename": ModuleFilename(job.submission.task_id, job.submission.user_name, job.submission.path, job.received),
+             "time": job.started.strftime('%Y-%m-%d %H:%M:%S')} for job in scheduler.running]
+
+
+def AcceptSubmission(proccess:ProcessPoolExecutor, task_id, user_name, path, now:datetime.datetime=None):
+    # モジュール移動先が無ければ生成(新規Taskの実行時)
+    dir_user_module = os.path.join(Task.TASKS_DIR, task_id, USER_MODULE_DIR_NAME)
+    if not os.path.exists(dir_user_module):
+        os.makedirs(dir_user_module)
+
+    # ファイルを読み込んで移動先に保存、元ファイルの削除を試みる
+    if now is None:
+        now = datetime.datetime.now()
+    new_filename = ModuleFilename(task_id, user_name, path, now)
+    try:
+        encoding = GetEncodingType(path)
+        with open(path, 'r', encoding=encoding) as f:
+            content = f.read()
+        with open(os.path.join(dir_user_module, new_filename), 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.remove(path)
+    except:
+        return None
+
+    # メモもあれば読み込んで移動
+    memo = ''
+    if os.path.exists(path + '.txt'):
+        try:
+            with open(path + '.txt', encoding='utf-8') as f:
+                memo = f.read()
+
+            shutil.move(path + '.txt', os.path.join(Task.TASKS_DIR, task_id, USER_MODULE_DIR_NAME, new_filename + '.txt'))
+        except Exception as e:
+            print(f"read {path + '.txt'}: {e}")
+    
+    # 移動に成功したら評価
+    print(f"pcoccess start: {user_name}")
+    print(f"{path} -> {new_filename}")
+
+    # 出力先ディレクトリが存在しない場合は生成(新規Taskの実行時)
+    dir_output_user = os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "user")
+    if not os.path.exists(dir_output_user):
+        os.makedirs(dir_output_user)
+
+    dir_output_detail = os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "detail")
+    if not os.path.exists(dir_output_detail):
+        os.makedirs(dir_output_detail)
+
+    # 評価を始めたことを知らせる
+    Events.publish(Events.STARTED, task_id, user_name, filename=new_filename)
+
+    # タイムスタンプ更新
+    UpdateTtimestamp(task_id)
+
+    # Log
+    Log.write(f'{user_name} submit {new_filename} to {task_id}, file movement succeeded, then the proccess started.')
+
+    # データセットを共有メモリに展開(展開済みで更新が無ければ何もしない)
+    task:Task = TASKS.get(task_id)
+    if task is not None:
+        DatasetCache.preload(task)
+
+    # ファイルの移動に成功したらプロセス生成して処理開始
+    return proccess.submit(ProcOneUser, task_id, user_name, new_filename, now, memo)
+
+
 def main():
-    with ProcessPoolExecutor(max_workers=4) as proccess:
+    # アップロードを検知して提出キューに積む
+    intake = Intake()
+    intake.start()
+
+    # 評価の順番を決める
+    scheduler = Scheduler(**Scheduler.readSetting())
+    print(f"scheduler: workers={scheduler.workers}, max_pending={scheduler.max_pending}, max_pending_per_user={scheduler.max_pending_per_user}")
+
+    # 前回の評価の進み具合は捨てる
+    Events.reset()
+
+    # 終了シグナルを受けても共有メモリのデータセットを残さない
+    DatasetCache.releaseOnSignal()
+
+    with ProcessPoolExecutor(max_workers=scheduler.workers, initializer=InitWorker) as proccess:
         while True:
-            # ディレクトリの一覧を作成して走査
-            dir_list_tasks = glob.glob(os.path.join(Task.TASKS_DIR, '**/'))
-            for dir_task in dir_list_tasks:                    
-                # ディレクトリ名を取得→タスクIDとして使う
-                task_id = os.path.basename(os.path.dirname(dir_task))
-
-                # ディレクトリの一覧を作成して走査
-                dir_list_users = glob.glob(os.path.join(dir_task, UPLOAD_DIR_NAME, '**/'))
-                for dir_user in dir_list_users:  
-                    # ディレクトリ名を取得→ユーザ名として使う
-                    user_name = os.path.basename(os.path.dirname(dir_user))
-
-                    # ユーザのディレクトリ内の.pyファイルの一覧を作成して走査
-                    py_files = glob.glob(os.path.join(dir_user, "*.py"))
-
-                    if len(py_files) == 0:
-                        continue
-                    
-                    path = py_files[0] # 最初に発見したファイルのみを対象とする
-
-                    # モジュール移動先が無ければ生成(新規Taskの実行時)
-                    dir_user_module = os.path.join(Task.TASKS_DIR, task_id, USER_MODULE_DIR_NAME)
-                    if not os.path.exists(dir_user_module):
-                        os.makedirs(dir_user_module)
-
-                    # ファイルを読み込んで移動先に保存、元ファイルの削除を試みる
-                    now = datetime.datetime.now()
-                    new_filename = user_name + "_" + task_id + "_" + now.strftime('%Y%m%d_%H%M%S_') + os.path.basename(path)
-                    try:
-                        encoding = GetEncodingType(path)
-                        with open(path, 'r', encoding=encoding) as f:
-                            content = f.read()
-                        with open(os.path.join(dir_user_module, new_filename), 'w', encoding='utf-8') as f:
-                            f.write(content)
-                        os.remove(path)
-                    except:
-                        continue
-
-                    # メモもあれば読み込んで移動
-                    memo = ''
-                    if os.path.exists(path + '.txt'):
-                        try:
-                            with open(path + '.txt', encoding='utf-8') as f:
-                                memo = f.read()
-
-                            shutil.move(path + '.txt', os.path.join(Task.TASKS_DIR, task_id, USER_MODULE_DIR_NAME, new_filename + '.txt'))
-                        except Exception as e:
-                            print(f"read {path + '.txt'}: {e}")
-                    
-                    # 移動に成功したら評価
-                    print(f"pcoccess start: {user_name}")
-                    print(f"{path} -> {new_filename}")
-
-                    # 出力先ディレクトリが存在しない場合は生成(新規Taskの実行時)
-                    dir_output_user = os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "user")
-                    if not os.path.exists(dir_output_user):
-                        os.makedirs(dir_output_user)
-
-                    dir_output_detail = os.path.join(Task.TASKS_DIR, task_id, OUTPUT_DIR_NAME, "detail")
-                    if not os.path.exists(dir_output_detail):
-                        os.makedirs(dir_output_detail)
-
-                    # 評価中であることを示すファイルを生成
-                    with open(os.path.join(dir_output_user, f"{user_name}_inproc"), "w", encoding='utf-8') as f:
-                        pass
-
-                    # タイムスタンプ更新
-                    UpdateTtimestamp(task_id)
-
-                    # Log
-                    Log.write(f'{user_name} submit {new_filename} to {task_id}, file movement succeeded, then the proccess started.')
-
-                    # ファイルの移動に成功したらプロセス生成して処理開始
-                    proccess.submit(ProcOneUser, task_id, user_name, new_filename, now, memo)
-
-
-            # 少し待つ
-            time.sleep(1.0)
-            print(".")
+            # 提出か評価の完了を待つ
+            submission = intake.get(timeout=METRICS_INTERVAL_SEC)
+            while submission is not None:
+                if scheduler.put(submission):
+                    Events.publish(Events.QUEUED, submission.task_id, submission.user_name, filename=os.path.basename(submission.path))
+                    UpdateTtimestamp(submission.task_id)
+                submission = intake.get(timeout=0)
+
+            # 終わった評価を片付け、空いたワーカーに次の提出を割り当てる
+            scheduler.collect()
+            dispatched = False
+            while True:
+                job = scheduler.next()
+                if job is None:
+                    break
+                submission = job.submission
+                future = AcceptSubmission(proccess, submission.task_id, submission.user_name, submission.path, job.received)
+                dispatched = True
+                if future is not None:
+                    scheduler.start(job, future)
+                    future.add_done_callback(lambda _: intake.wake())
+
+            # 上限を超えて見送った提出があれば、評価待ちに空きができたので拾い直す
+            if scheduler.overflowed and dispatched:
+                scheduler.overflowed = False
+                intake.scan()
+
+            # 評価待ちの順番とキューの深さ、評価中の件数を出力
+            scheduler.writeStatus()
+            intake.writeMetrics(len(scheduler.running), scheduler.depth())
+
+            # イベントファイルが大きくなったら、評価中の提出だけを残して作り直す
+            if Events.size() > Events.MAX_SIZE:
+                Events.reset(RunningJobs(scheduler))
 
 if __name__ == "__main__":
     main()